@@ -1,9 +1,19 @@
 from flask import Flask, request, jsonify, render_template, session, redirect, url_for, flash
 from database import Database
-from whatsapp_handler import WhatsAppHandler
+from whatsapp_handler import WhatsAppHandler, MediaRejected
+from send_queue import SendQueue
 from config import Config
+from jobs import JobRunner
+from invoices import InvoiceCache
+from availability import SlotIndex
+from scheduling import services_duration
+from responses import templates
+import thumbnails
+from uploads import UploadStore
+from dedup import ProcessedMessages
+from ratelimit import SenderLimiter
+import exports
 import os
-import json
 from datetime import datetime, timedelta
 from werkzeug.utils import secure_filename
 
@@ -12,7 +22,34 @@ app.config.from_object(Config)
 
 # Initialize
 db = Database()
-whatsapp = WhatsAppHandler()
+whatsapp = WhatsAppHandler(db)
+
+# Replies are queued and sent by background dispatchers so the webhook
+# can return before the Graph API calls are made
+outbox = SendQueue(db, whatsapp)
+outbox.start()
+
+# Abandoned conversations are swept out of the sessions table
+db.sessions.start()
+
+# Reports and invoices are generated in worker processes, not in the request
+job_runner = JobRunner(db)
+
+# Message IDs already handled, so Meta's webhook retries are not processed twice
+processed_messages = ProcessedMessages(db)
+
+# Per-customer flood protection for the webhook
+sender_limiter = SenderLimiter(db)
+
+# Payment screenshots: sharded on disk, archived and expired by 'flask maintain-uploads'
+upload_store = UploadStore(db)
+
+# Free slots for the booking window are served from memory
+slot_index = SlotIndex(db)
+
+# Re-printing an unchanged booking sends the cached PDF
+invoice_cache = InvoiceCache(db)
+db.booking_listeners.append(invoice_cache.invalidate)
 
 # Ensure upload folder exists
 os.makedirs(Config.UPLOAD_FOLDER, exist_ok=True)
@@ -32,17 +69,25 @@ def get_next_7_days():
 
 def format_service_list():
     """Format service list for display"""
-    text = "*📋 Our Services:*\n\n"
-    for key, service in Config.SERVICES.items():
-        text += f"{key}. {service['name']}\n"
-        text += f"   💰 ₹{service['price']} | ⏱️ {service['duration']}\n\n"
-    return text
-
-def get_available_slots(date):
-    """Get available time slots for a date"""
-    booked_slots = db.get_booked_slots(date)
-    available = [slot for slot in Config.TIME_SLOTS if slot not in booked_slots]
-    return available
+    return templates.service_list()
+
+def get_available_slots(date, phone=None, services=()):
+    """Start times on a date with a chair free for the chosen services (`phone`'s own hold is ignored)"""
+    return slot_index.available_slots(date, phone, services_duration(services))
+
+# Steps during which the customer's chosen slot is held for them
+SLOT_HOLD_STEPS = {'confirm_without_payment', 'confirm_with_payment', 'show_payment', 'waiting_payment_screenshot', 'verifying_payment'}
+
+def format_slot_list(date, available_slots):
+    """Format available time slots for display"""
+    response = f"📅 *Date:* {date}\n\n"
+    response += "*⏰ Available Time Slots:*\n\n"
+    for i, slot in enumerate(available_slots, 1):
+        response += f"{i}. {slot}\n"
+    
+    response += f"\n💡 Reply with slot number (1-{len(available_slots)})\n"
+    response += "Or type *Back* to change date"
+    return response
 
 def is_valid_service_input(message):
     """Validate service selection format"""
@@ -76,72 +121,187 @@ def webhook():
     try:
         data = request.get_json()
         
-        if not data.get('entry'):
-            return jsonify({'status': 'ok'}), 200
-        
-        entry = data['entry'][0]
-        changes = entry.get('changes', [])
-        
-        if not changes:
-            return jsonify({'status': 'ok'}), 200
-        
-        change = changes[0]
-        value = change.get('value', {})
-        messages = value.get('messages', [])
-        
-        if not messages:
-            return jsonify({'status': 'ok'}), 200
-        
-        message = messages[0]
-        from_phone = message['from']
-        
-       # if message.get("from") == config.WHATSAPP_PHONE_ID:
-             #return jsonify({'status':'ok'}),200
-             
-        # Handle different message types
-        message_type = message.get('type')
-        
-        if message_type == 'text':
-            text = message['text']['body']
-            handle_text_message(from_phone, text)
-        
-        elif message_type == 'interactive':
-            interactive = message['interactive']
-            if interactive['type'] == 'button_reply':
-                button_text = interactive['button_reply']['title']
-                handle_text_message(from_phone, button_text)
-            elif interactive['type'] == 'list_reply':
-                list_text = interactive['list_reply']['title']
-                handle_text_message(from_phone, list_text)
-        
-        elif message_type == 'image':
-            media_id = message['image']['id']
-            handle_payment_screenshot(from_phone, media_id)
+        for phone, messages in group_messages_by_sender(data).items():
+            # Retried deliveries carry the same message IDs; handle each only once
+            messages = [m for m in messages if not m.get('id') or processed_messages.claim(m['id'])]
+            if not messages:
+                continue
+            # Claims of messages not handled (or queued) are released so a redelivery is not ignored
+            unhandled = messages
+            try:
+                now, later, delay = throttle_sender(phone, messages)
+                unhandled = now + later
+                failed = handle_sender_messages(phone, now) if now else []
+                unhandled = failed + later
+                # Queued after the replies to `now` (and the notice), which the send queue keeps in order
+                if later:
+                    if sender_limiter.should_notify(phone):
+                        outbox.send_message(phone, templates.render('slow_down'))
+                    outbox.enqueue(phone, 'handle_deferred_messages', phone, later, delay=delay)
+                unhandled = failed
+            except Exception as e:
+                # One bad conversation must not drop the rest of the batch
+                print(f"Webhook error for {phone}: {e}")
+            release_messages(unhandled)
         
         return jsonify({'status': 'ok'}), 200
     
     except Exception as e:
+        # Still acknowledge: an error reply only makes Meta redeliver the same batch
         print(f"Webhook error: {e}")
-        return jsonify({'status': 'error', 'message': str(e)}), 500
+        return jsonify({'status': 'error'}), 200
+
+def group_messages_by_sender(payload):
+    """Collect every message in a (possibly batched) webhook payload, grouped by sender in arrival order"""
+    grouped = {}
+    for entry in (payload or {}).get('entry') or []:
+        for change in entry.get('changes') or []:
+            for message in change.get('value', {}).get('messages') or []:
+                if message.get('from'):
+                    grouped.setdefault(message['from'], []).append(message)
+    return grouped
+
+def throttle_sender(phone, messages):
+    """Split a sender's batch into (handle now, handle later, seconds until later).
+    
+    Over their rate, the rest of the batch is put off in order, never
+    reordered or skipped, since each answer moves the conversation one step.
+    Messages behind ones already put off wait as well. Only a sender more
+    than SENDER_MAX_BACKLOG_SECONDS behind loses text messages; payment
+    screenshots are always kept.
+    """
+    allowed, delay = sender_limiter.admit(phone, len(messages))
+    if allowed and db.has_pending_outbound(phone, 'handle_deferred_messages'):
+        allowed = 0
+    now, later = messages[:allowed], messages[allowed:]
+    
+    if later and delay > Config.SENDER_MAX_BACKLOG_SECONDS:
+        dropped = [m for m in later if m.get('type') != 'image']
+        later = [m for m in later if m.get('type') == 'image']
+        print(f"Rate limit: dropping {len(dropped)} messages from {phone}")
+        sender_limiter.refund(phone, len(dropped))
+        release_messages(dropped)
+    
+    return now, later, delay
+
+def release_messages(messages):
+    """Forget that these messages were received, so a redelivery is handled again"""
+    for message in messages:
+        if message.get('id'):
+            processed_messages.release(message['id'])
+
+def handle_deferred_messages(phone, messages):
+    """Send queue job: messages put off by the sender's rate limit.
+    
+    Never retried once started, since a retry would replay replies already
+    sent; messages that failed are logged and their claims released instead.
+    """
+    try:
+        failed = handle_sender_messages(phone, messages)
+    except Exception as e:
+        print(f"Error handling deferred messages from {phone}: {e}")
+        # Not an 'error' result, which the queue would retry
+        return {'lost': [m.get('id') for m in messages], 'reason': str(e)}
+    
+    release_messages(failed)
+    return {'handled': len(messages) - len(failed), 'failed': [m.get('id') for m in failed]}
+
+def deferred_messages_lost(phone, messages):
+    """Send queue gave up on deferred messages; log them and let a redelivery through"""
+    print(f"Gave up on {len(messages)} deferred messages from {phone}: "
+          f"{', '.join(str(m.get('id')) for m in messages)}")
+    release_messages(messages)
 
 # =================== MESSAGE HANDLER ===================
 
-def handle_text_message(phone, message):
-    """Process text messages"""
+def handle_sender_messages(phone, messages):
+    """Process all messages from one sender, loading and saving the session once.
+    
+    A message that fails is skipped; the state reached by the others is
+    still saved, since their replies are already on the way. Returns the
+    messages that failed.
+    """
     user_session = db.get_session(phone)
     step = user_session['step']
     data = user_session['data']
+    failed = []
     
+    for message in messages:
+        try:
+            step, data = handle_message(phone, step, data, message)
+        except Exception as e:
+            print(f"Error handling message {message.get('id')} from {phone}: {e}")
+            failed.append(message)
+    
+    # Only if nothing (e.g. the screenshot job) moved the conversation on meanwhile
+    if not db.save_session(phone, step, data, user_session['rev']):
+        print(f"Session for {phone} changed while handling messages; kept the newer state")
+    return failed
+
+def handle_message(phone, step, data, message):
+    """Dispatch a single message by type and return the updated session"""
+    message_type = message.get('type')
+    
+    if message_type == 'text':
+        return handle_text_message(phone, step, data, message['text']['body'])
+    
+    elif message_type == 'interactive':
+        interactive = message['interactive']
+        if interactive['type'] == 'button_reply':
+            return handle_text_message(phone, step, data, interactive['button_reply']['title'])
+        elif interactive['type'] == 'list_reply':
+            return handle_text_message(phone, step, data, interactive['list_reply']['title'])
+    
+    elif message_type == 'image':
+        return handle_payment_screenshot(phone, step, data, message['image']['id'])
+    
+    return step, data
+
+def handle_text_message(phone, step, data, message):
+    """Process text messages"""
     new_step, new_data, response = process_bot_logic(phone, step, data, message)
     
-    db.save_session(phone, new_step, new_data)
+    # Leaving the confirm/payment steps by any route (cancel, menu, back) frees the slot
+    if step in SLOT_HOLD_STEPS and new_step not in SLOT_HOLD_STEPS:
+        db.release_hold(phone)
     
     send_bot_response(phone, new_step, new_data, response)
+    
+    return new_step, new_data
+
+# =================== CONVERSATION STATES ===================
+
+# What customers type or tap, normalized to an intent once per message
+INTENT_PHRASES = {
+    'menu': ['menu', 'main menu', 'start', 'restart', 'back to menu'],
+    'greet': ['hi', 'hello', 'hey', 'namaste'],
+    'new_booking': ["📅 New Booking", "Book Now", "New Booking"],
+    'my_bookings': ["📋 My Bookings", "My Bookings", "Bookings"],
+    'contact': ["📞 Contact Us", "Contact", "Contact Us"],
+    'confirm': ["✅ Confirm Now", "Confirm", "Yes"],
+    'proceed': ["💳 Proceed to Payment", "Proceed", "Pay"],
+    'paid': ["✅ I Have Paid", "Paid", "Done"],
+    'back': ["🔙 Back", "Back"],
+    'cancel': ["❌ Cancel", "Cancel"],
+}
+INTENTS = {phrase.lower(): intent for intent, phrases in INTENT_PHRASES.items() for phrase in phrases}
+
+# (step, intent) -> handler(phone, step, data, message) returning (step, data, response).
+# A step of None matches any step and an intent of None matches any message.
+STATE_HANDLERS = {}
+
+def state(step, *intents):
+    """Register a handler for a step and intents (no intents = anything else)"""
+    def register(handler):
+        for intent in intents or (None,):
+            STATE_HANDLERS[(step, intent)] = handler
+        return handler
+    return register
 
 def process_bot_logic(phone, step, data, message):
-    """Main bot logic with improved error handling"""
-    if step is None or step =="":
-        step="menu"
+    """Route a text message to the handler for the current step and intent"""
+    if step not in STATE_STEPS:
+        step = 'menu'
     if not data:
         data = {
             'services': [],
@@ -151,355 +311,413 @@ def process_bot_logic(phone, step, data, message):
             'name': None
         }
     
-    response = ""
+    # A step's own handlers win over the global ones
+    intent = INTENTS.get(message.strip().lower())
+    handler = (STATE_HANDLERS.get((step, intent))
+               or STATE_HANDLERS.get((None, intent))
+               or STATE_HANDLERS.get((step, None))
+               or STATE_HANDLERS[(None, None)])
+    return handler(phone, step, data, message)
+
+def welcome_text(phone):
+    user = db.get_user(phone)
+    if user and user.get('name'):
+        response = f"👋 Welcome back *{user['name']}*!\n\n"
+    else:
+        response = f"👋 Welcome to *{Config.SALON_NAME}*!\n\n"
+    response += "How can I help you today?"
+    return response
+
+# Universal menu command
+@state(None, 'menu')
+def show_menu(phone, step, data, message):
+    return 'menu', {}, welcome_text(phone)
+
+# Menu
+@state('menu', 'greet')
+def greet(phone, step, data, message):
+    return 'menu', {}, welcome_text(phone)
+
+# New Booking
+@state(None, 'new_booking')
+def new_booking(phone, step, data, message):
+    user = db.get_user(phone)
+    if not user or not user.get('name'):
+        return 'get_name', data, "Please enter your name:"
+    
+    data['name'] = user['name']
+    return 'select_services', data, templates.render('choose_services', menu_action="go back")
+
+# Get Name
+@state('get_name', 'menu')
+def cancel_get_name(phone, step, data, message):
+    return 'menu', {}, "Returning to main menu..."
+
+@state('get_name')
+def get_name(phone, step, data, message):
+    name = message.strip()
+    if len(name) < 2:
+        response = "❌ Please enter a valid name (at least 2 characters):"
+        return step, data, response
     
-    # Universal menu command
-    if message.lower() in ['menu', 'main menu', 'start', 'restart', 'back to menu']:
-        user = db.get_user(phone)
-        if user and user.get('name'):
-            response = f"👋 Welcome back *{user['name']}*!\n\n"
-        else:
-            response = f"👋 Welcome to *{Config.SALON_NAME}*!\n\n"
-        response += "How can I help you today?"
-        return 'menu', response
-    
-    # Menu
-    if step == 'menu' and message.lower() in ['hi', 'hello', 'hey', 'namaste']:
-        user = db.get_user(phone)
-        if user and user.get('name'):
-            response = f"👋 Welcome back *{user['name']}*!\n\n"
-        else:
-            response = f"👋 Welcome to *{Config.SALON_NAME}*!\n\n"
-        
-        response += "How can I help you today?"
-        step = 'menu'
-        data = {}
-    
-    # New Booking
-    elif message in ["📅 New Booking", "Book Now", "New Booking"]:
-        user = db.get_user(phone)
-        if not user or not user.get('name'):
-            response = "Please enter your name:"
-            step = 'get_name'
-        else:
-            data['name'] = user['name']
-            response = format_service_list()
-            response += "📝 *How to select:*\n"
-            response += "Reply with service numbers separated by commas\n"
-            response += "Example: 1,3,5\n\n"
-            response += "Type *Menu* to go back"
-            step = 'select_services'
-    
-    # Get Name
-    elif step == 'get_name':
-        name = message.strip()
-        if len(name) < 2:
-            response = "❌ Please enter a valid name (at least 2 characters):"
-            return step, data, response
-        
-        if name.lower() == 'menu':
-            return 'menu', {}, "Returning to main menu..."
-        
-        data['name'] = name
-        db.save_user(phone, name)
-        
-        response = f"Nice to meet you, *{name}*! 😊\n\n"
-        response += format_service_list()
-        response += "📝 *How to select:*\n"
-        response += "Reply with service numbers separated by commas\n"
-        response += "Example: 1,3,5\n\n"
-        response += "Type *Menu* to cancel"
-        step = 'select_services'
-    
-    # Select Services - THIS WAS MISSING SECTION
-    elif step == 'select_services':
-        if message.lower() in ['cancel', 'back']:
-            return 'menu', {}, "❌ Booking cancelled. Returning to main menu..."
-        
-        if not is_valid_service_input(message):
-            response = "❌ *Invalid format!*\n\n"
-            response += "Please enter service numbers separated by commas.\n"
-            response += "Example: 1,3,5\n\n"
-            response += format_service_list()
-            response += "Or type *Menu* to cancel"
-            return step, data, response
-        
-        try:
-            # Parse service numbers
-            service_nums = [s.strip() for s in message.replace(' ', '').split(',')]
-            data['services'] = service_nums
-            
-            # Calculate total
-            total = sum([Config.SERVICES[s]['price'] for s in service_nums])
-            data['total'] = total
-            
-            # Show selected services summary
-            service_names = [Config.SERVICES[s]['name'] for s in service_nums]
-            response = "✅ *Selected Services:*\n\n"
-            for i, s_num in enumerate(service_nums):
-                service = Config.SERVICES[s_num]
-                response += f"{i+1}. {service['name']}\n"
-                response += f"   💰 ₹{service['price']} | ⏱️ {service['duration']}\n\n"
-            
-            response += f"*Total Amount:* ₹{total}\n\n"
-            
-            if total >= Config.ADVANCE_PAYMENT_THRESHOLD:
-                advance = int(total * Config.ADVANCE_PERCENTAGE)
-                data['advance_required'] = advance
-                response += f"💳 *Advance Payment Required:* ₹{advance} (50%)\n\n"
-            
-            response += "📅 *Select your preferred date:*"
-            step = 'select_date'
-            
-        except Exception as e:
-            print(f"Service selection error: {e}")
-            response = "❌ Something went wrong. Please try again.\n\n"
-            response += "Type *Menu* to start over"
-            step = 'menu'
+    data['name'] = name
+    db.save_user(phone, name)
     
-    # Select Date
-    elif step == 'select_date':
-        if message.lower() in ['cancel', 'menu']:
-            return 'menu', {}, "❌ Booking cancelled."
-        
-        # Check if it's a valid date
-        dates = get_next_7_days()
-        valid_dates = [d['value'] for d in dates]
-        
-        if message not in valid_dates:
-            response = "❌ Invalid date selected.\n\n"
-            response += "Please select a date from the list."
-            return step, data, response
-        
-        data['date'] = message
-        
-        # Get available slots for this date
-        available_slots = get_available_slots(message)
+    return 'select_services', data, templates.render('greet_and_choose_services', name=name)
+
+# Select Services
+@state('select_services', 'cancel', 'back')
+def cancel_select_services(phone, step, data, message):
+    return 'menu', {}, "❌ Booking cancelled. Returning to main menu..."
+
+@state('select_services')
+def select_services(phone, step, data, message):
+    if not is_valid_service_input(message):
+        return step, data, templates.render('invalid_services')
+    
+    try:
+        # Parse service numbers
+        service_nums = [s.strip() for s in message.replace(' ', '').split(',')]
+        data['services'] = service_nums
         
-        if not available_slots:
-            response = "😔 Sorry! No slots available on this date.\n\n"
-            response += "Please select another date:"
-            return step, data, response
+        # Calculate total
+        total = sum([Config.SERVICES[s]['price'] for s in service_nums])
+        data['total'] = total
         
-        # Show available time slots
-        response = f"📅 *Date:* {message}\n\n"
-        response += "*⏰ Available Time Slots:*\n\n"
-        for i, slot in enumerate(available_slots, 1):
-            response += f"{i}. {slot}\n"
+        advance_note = ""
+        if total >= Config.ADVANCE_PAYMENT_THRESHOLD:
+            advance = int(total * Config.ADVANCE_PERCENTAGE)
+            data['advance_required'] = advance
+            advance_note = templates.render('advance_note', advance=advance)
         
-        response += f"\n💡 Reply with slot number (1-{len(available_slots)})\n"
-        response += "Or type *Back* to change date"
+        # Show selected services summary
+        response = templates.render(
+            'selected_services',
+            service_details=templates.service_details(service_nums),
+            total=total,
+            advance_note=advance_note
+        )
+        return 'select_date', data, response
+    
+    except Exception as e:
+        print(f"Service selection error: {e}")
+        response = "❌ Something went wrong. Please try again.\n\n"
+        response += "Type *Menu* to start over"
+        return 'menu', data, response
+
+# Select Date
+@state('select_date', 'cancel', 'menu')
+def cancel_select_date(phone, step, data, message):
+    return 'menu', {}, "❌ Booking cancelled."
+
+@state('select_date')
+def select_date(phone, step, data, message):
+    # Check if it's a valid date
+    dates = get_next_7_days()
+    valid_dates = [d['value'] for d in dates]
+    
+    if message not in valid_dates:
+        response = "❌ Invalid date selected.\n\n"
+        response += "Please select a date from the list."
+        return step, data, response
+    
+    data['date'] = message
+    
+    # Get available slots for this date
+    available_slots = get_available_slots(message, phone, data.get('services', []))
+    
+    if not available_slots:
+        response = "😔 Sorry! No slots available on this date.\n\n"
+        response += "Please select another date:"
+        return step, data, response
+    
+    # Show available time slots
+    response = format_slot_list(message, available_slots)
+    
+    data['available_slots'] = available_slots
+    return 'select_time', data, response
+
+# Select Time
+@state('select_time', 'back')
+def back_to_select_date(phone, step, data, message):
+    return 'select_date', data, "📅 *Select your preferred date:*"
+
+@state('select_time', 'menu')
+def cancel_select_time(phone, step, data, message):
+    return 'menu', {}, "❌ Booking cancelled."
+
+@state('select_time')
+def select_time(phone, step, data, message):
+    try:
+        slot_num = int(message.strip())
+        available_slots = data.get('available_slots', [])
         
-        data['available_slots'] = available_slots
-        step = 'select_time'
-    
-    # Select Time
-    elif step == 'select_time':
-        if message.lower() == 'back':
-            response = "📅 *Select your preferred date:*"
-            step = 'select_date'
+        if slot_num < 1 or slot_num > len(available_slots):
+            response = f"❌ Please enter a valid slot number (1-{len(available_slots)})"
             return step, data, response
         
-        if message.lower() == 'menu':
-            return 'menu', {}, "❌ Booking cancelled."
+        selected_time = available_slots[slot_num - 1]
         
-        try:
-            slot_num = int(message.strip())
-            available_slots = data.get('available_slots', [])
-            
-            if slot_num < 1 or slot_num > len(available_slots):
-                response = f"❌ Please enter a valid slot number (1-{len(available_slots)})"
-                return step, data, response
-            
-            selected_time = available_slots[slot_num - 1]
-            data['time'] = selected_time
-            
-            # Show booking summary
-            service_names = [Config.SERVICES[s]['name'] for s in data['services']]
-            response = "*📋 Booking Summary:*\n\n"
-            response += f"👤 *Name:* {data['name']}\n"
-            response += f"📅 *Date:* {data['date']}\n"
-            response += f"⏰ *Time:* {data['time']}\n\n"
-            response += "*Services:*\n"
-            for s in data['services']:
-                response += f"• {Config.SERVICES[s]['name']} - ₹{Config.SERVICES[s]['price']}\n"
-            response += f"\n💰 *Total:* ₹{data['total']}\n\n"
+        # Reserve the slot now so nobody else can book it while this customer confirms
+        duration = services_duration(data['services'])
+        if not db.hold_slot(phone, data['date'], selected_time, Config.SLOT_HOLD_SECONDS, duration):
+            available_slots = get_available_slots(data['date'], phone, data['services'])
+            data['available_slots'] = available_slots
+            if not available_slots:
+                response = f"😔 Sorry! *{selected_time}* was just taken and no other slots are left on this date.\n\n"
+                response += "Please select another date:"
+                return 'select_date', data, response
             
-            # Check if advance payment required
-            if data['total'] >= Config.ADVANCE_PAYMENT_THRESHOLD:
-                advance = data.get('advance_required', 0)
-                response += f"💳 *Advance Required:* ₹{advance}\n\n"
-                response += "Click *Proceed to Payment* to continue"
-                step = 'confirm_with_payment'
-            else:
-                response += "✅ No advance payment required!\n\n"
-                response += "Click *Confirm Now* to book your appointment"
-                step = 'confirm_without_payment'
-            
-        except ValueError:
-            response = "❌ Please enter a valid number"
-            return step, data, response
-        except Exception as e:
-            print(f"Time selection error: {e}")
-            response = "❌ Something went wrong. Please try again."
+            response = f"😔 Sorry! *{selected_time}* was just taken by someone else.\n\n"
+            response += format_slot_list(data['date'], available_slots)
             return step, data, response
-    
-    # Confirm without payment
-    elif step == 'confirm_without_payment':
-        if message in ["✅ Confirm Now", "Confirm", "Yes"]:
-            # Create booking
-            booking_id = db.save_booking(
-                phone=phone,
-                name=data['name'],
-                services=data['services'],
-                date=data['date'],
-                time=data['time'],
-                total=data['total'],
-                advance_required=0,
-                status='confirmed'
-            )
-            
-            service_names = [Config.SERVICES[s]['name'] for s in data['services']]
-            response = "🎉 *Booking Confirmed!*\n\n"
-            response += f"*Booking ID:* #{booking_id}\n"
-            response += f"*Name:* {data['name']}\n"
-            response += f"*Date:* {data['date']}\n"
-            response += f"*Time:* {data['time']}\n"
-            response += f"*Services:* {', '.join(service_names)}\n"
-            response += f"*Total:* ₹{data['total']}\n\n"
-            response += f"✨ See you at *{Config.SALON_NAME}*!\n\n"
-            response += f"📍 {Config.SALON_ADDRESS}\n"
-            response += f"📞 {Config.SALON_PHONE}\n\n"
-            response += "Type *Menu* for more options"
-            
-            step = 'menu'
-            data = {}
         
-        elif message in ["❌ Cancel", "Cancel"]:
-            response = "❌ Booking cancelled.\n\nType *Menu* to start over"
-            step = 'menu'
-            data = {}
-        else:
-            response = "Please click *Confirm Now* or *Cancel*"
-            return step, data, response
-    
-    # Confirm with payment
-    elif step == 'confirm_with_payment':
-        if message in ["💳 Proceed to Payment", "Proceed", "Pay"]:
-            response = "📱 *Payment Information*\n\n"
-            response += f"*Amount to Pay:* ₹{data.get('advance_required', 0)}\n"
-            response += f"*UPI ID:* {Config.UPI_ID}\n\n"
-            response += "I'll send you the QR code in the next message. 👇"
-            step = 'show_payment'
+        data['time'] = selected_time
         
-        elif message in ["❌ Cancel", "Cancel"]:
-            response = "❌ Booking cancelled.\n\nType *Menu* to start over"
-            step = 'menu'
-            data = {}
+        # Check if advance payment required
+        if data['total'] >= Config.ADVANCE_PAYMENT_THRESHOLD:
+            next_step = 'confirm_with_payment'
+            next_action = templates.render('summary_with_payment', advance=data.get('advance_required', 0))
         else:
-            response = "Please click *Proceed to Payment* or *Cancel*"
-            return step, data, response
-    
-    # Show payment and wait for screenshot
-    elif step == 'show_payment':
-        if message in ["✅ I Have Paid", "Paid", "Done"]:
-            response = "📸 *Please upload your payment screenshot*\n\n"
-            response += "Take a screenshot of your payment confirmation and send it here.\n\n"
-            response += "We'll verify and confirm your booking within *1 hour*. ⏰"
-            step = 'waiting_payment_screenshot'
+            next_step = 'confirm_without_payment'
+            next_action = templates.render('summary_without_payment')
         
-        elif message in ["🔙 Back", "Back"]:
-            service_names = [Config.SERVICES[s]['name'] for s in data['services']]
-            response = "*📋 Booking Summary:*\n\n"
-            response += f"👤 *Name:* {data['name']}\n"
-            response += f"📅 *Date:* {data['date']}\n"
-            response += f"⏰ *Time:* {data['time']}\n\n"
-            response += f"💰 *Total:* ₹{data['total']}\n"
-            response += f"💳 *Advance:* ₹{data.get('advance_required', 0)}\n\n"
-            response += "Click *Proceed to Payment* to continue"
-            step = 'confirm_with_payment'
-        else:
-            response = "Please click *I Have Paid* after completing payment,\nor click *Back* to review your booking."
-            return step, data, response
+        # Show booking summary
+        response = templates.render(
+            'booking_summary',
+            name=data['name'],
+            date=data['date'],
+            time=data['time'],
+            service_items=templates.service_items(data['services']),
+            total=data['total'],
+            next_action=next_action
+        )
+        return next_step, data, response
     
-    # Waiting for payment screenshot
-    elif step == 'waiting_payment_screenshot':
-        if message.lower() == 'menu':
-            response = "⚠️ *Booking In Progress*\n\n"
-            response += "Please upload your payment screenshot to complete the booking.\n\n"
-            response += "Type *Cancel* if you want to cancel this booking."
-            return step, data, response
-        
-        elif message.lower() == 'cancel':
-            response = "❌ Booking cancelled.\n\nType *Menu* to start over"
-            step = 'menu'
-            data = {}
-        else:
-            response = "📸 Please send the *payment screenshot* as an image.\n\n"
-            response += "Or type *Cancel* to cancel this booking."
-            return step, data, response
+    except ValueError:
+        response = "❌ Please enter a valid number"
+        return step, data, response
+    except Exception as e:
+        print(f"Time selection error: {e}")
+        response = "❌ Something went wrong. Please try again."
+        return step, data, response
+
+# Confirm without payment
+@state('confirm_without_payment', 'confirm')
+def confirm_booking(phone, step, data, message):
+    booking_id = db.save_booking(
+        phone=phone,
+        name=data['name'],
+        services=data['services'],
+        date=data['date'],
+        time=data['time'],
+        total=data['total'],
+        advance_required=0,
+        status='confirmed'
+    )
     
-    # My Bookings
-    elif message in ["📋 My Bookings", "My Bookings", "Bookings"]:
-        bookings = db.get_bookings(phone=phone)
+    if booking_id is None:
+        response = f"😔 Sorry! *{data['time']}* on {data['date']} is no longer available.\n\n"
+        response += "📅 *Please select another date:*"
+        return 'select_date', data, response
+    
+    service_names = [Config.SERVICES[s]['name'] for s in data['services']]
+    response = templates.render(
+        'booking_confirmed',
+        booking_id=booking_id,
+        name=data['name'],
+        date=data['date'],
+        time=data['time'],
+        service_names=', '.join(service_names),
+        total=data['total']
+    )
+    return 'menu', {}, response
+
+@state('confirm_without_payment', 'cancel')
+@state('confirm_with_payment', 'cancel')
+@state('waiting_payment_screenshot', 'cancel')
+@state('verifying_payment', 'cancel')
+def cancel_booking(phone, step, data, message):
+    return 'menu', {}, "❌ Booking cancelled.\n\nType *Menu* to start over"
+
+@state('confirm_without_payment')
+def confirm_without_payment(phone, step, data, message):
+    return step, data, "Please click *Confirm Now* or *Cancel*"
+
+# Confirm with payment
+@state('confirm_with_payment', 'proceed')
+def proceed_to_payment(phone, step, data, message):
+    response = "📱 *Payment Information*\n\n"
+    response += f"*Amount to Pay:* ₹{data.get('advance_required', 0)}\n"
+    response += f"*UPI ID:* {Config.UPI_ID}\n\n"
+    response += "I'll send you the QR code in the next message. 👇"
+    return 'show_payment', data, response
+
+@state('confirm_with_payment')
+def confirm_with_payment(phone, step, data, message):
+    return step, data, "Please click *Proceed to Payment* or *Cancel*"
+
+# Show payment and wait for screenshot
+@state('show_payment', 'paid')
+def payment_done(phone, step, data, message):
+    response = "📸 *Please upload your payment screenshot*\n\n"
+    response += "Take a screenshot of your payment confirmation and send it here.\n\n"
+    response += "We'll verify and confirm your booking within *1 hour*. ⏰"
+    return 'waiting_payment_screenshot', data, response
+
+@state('show_payment', 'back')
+def back_to_summary(phone, step, data, message):
+    response = "*📋 Booking Summary:*\n\n"
+    response += f"👤 *Name:* {data['name']}\n"
+    response += f"📅 *Date:* {data['date']}\n"
+    response += f"⏰ *Time:* {data['time']}\n\n"
+    response += f"💰 *Total:* ₹{data['total']}\n"
+    response += f"💳 *Advance:* ₹{data.get('advance_required', 0)}\n\n"
+    response += "Click *Proceed to Payment* to continue"
+    return 'confirm_with_payment', data, response
+
+@state('show_payment')
+def show_payment(phone, step, data, message):
+    response = "Please click *I Have Paid* after completing payment,\nor click *Back* to review your booking."
+    return step, data, response
+
+# Waiting for payment screenshot
+@state('waiting_payment_screenshot', 'menu')
+def booking_in_progress(phone, step, data, message):
+    response = "⚠️ *Booking In Progress*\n\n"
+    response += "Please upload your payment screenshot to complete the booking.\n\n"
+    response += "Type *Cancel* if you want to cancel this booking."
+    return step, data, response
+
+@state('waiting_payment_screenshot')
+def waiting_payment_screenshot(phone, step, data, message):
+    response = "📸 Please send the *payment screenshot* as an image.\n\n"
+    response += "Or type *Cancel* to cancel this booking."
+    return step, data, response
+
+# Screenshot is being downloaded and checked by the send queue
+@state('verifying_payment', 'menu', 'new_booking')
+@state('verifying_payment')
+def verifying_payment(phone, step, data, message):
+    response = "⏳ We're checking your payment screenshot.\n\n"
+    response += "You'll get a message in a moment.\n\n"
+    response += "Type *Cancel* to cancel this booking."
+    return step, data, response
+
+# My Bookings
+@state('menu', 'my_bookings')
+def my_bookings(phone, step, data, message):
+    bookings = db.get_bookings(phone=phone)
+    
+    if bookings:
+        response = f"*📋 Your Bookings ({len(bookings)}):*\n\n"
         
-        if bookings:
-            response = f"*📋 Your Bookings ({len(bookings)}):*\n\n"
-            
-            for i, booking in enumerate(bookings[:5], 1):  # Show first 5
-                services = json.loads(booking['services'])
-                service_names = [Config.SERVICES[s]['name'] for s in services]
-                
-                response += f"*#{booking['id']}* - {booking['date']} at {booking['time']}\n"
-                response += f"💇 {', '.join(service_names)}\n"
-                response += f"💰 ₹{booking['total']}\n"
-                response += f"Status: {booking['status'].replace('_', ' ').title()}\n\n"
-            
-            if len(bookings) > 5:
-                response += f"...and {len(bookings)-5} more\n\n"
-        else:
-            response = "📭 You don't have any bookings yet.\n\n"
-            response += "Book your first appointment now!"
+        for i, booking in enumerate(bookings[:5], 1):  # Show first 5
+            response += f"*#{booking['id']}* - {booking['date']} at {booking['time']}\n"
+            response += f"💇 {booking['service_names']}\n"
+            response += f"💰 ₹{booking['total']}\n"
+            response += f"Status: {booking['status'].replace('_', ' ').title()}\n\n"
         
-        response += "\nType *Menu* to go back"
-        step = 'menu'
-    
-    # Contact
-    elif message in ["📞 Contact Us", "Contact", "Contact Us"]:
-        response = f"*📞 Contact {Config.SALON_NAME}*\n\n"
-        response += f"📍 *Address:*\n{Config.SALON_ADDRESS}\n\n"
-        response += f"📱 *Phone:*\n{Config.SALON_PHONE}\n\n"
-        response += f"💳 *UPI ID:*\n{Config.UPI_ID}\n\n"
-        response += "*🕐 Working Hours:*\n"
-        response += "Monday - Sunday\n"
-        response += "10:00 AM - 8:00 PM\n\n"
-        response += "Type *Menu* to go back"
-        step = 'menu'
-    
-    # Default
+        if len(bookings) > 5:
+            response += f"...and {len(bookings)-5} more\n\n"
     else:
-        response = "❓ I didn't understand that.\n\n"
-        response += "Type *Menu* to see all options\n"
-        response += "or choose from:\n"
-        response += "• *New Booking* - Book appointment\n"
-        response += "• *My Bookings* - View bookings\n"
-        response += "• *Contact Us* - Get contact info"
+        response = "📭 You don't have any bookings yet.\n\n"
+        response += "Book your first appointment now!"
     
+    response += "\nType *Menu* to go back"
+    return 'menu', data, response
+
+# Contact
+@state('menu', 'contact')
+def contact(phone, step, data, message):
+    return 'menu', data, templates.render('contact')
+
+# Default
+@state(None)
+def not_understood(phone, step, data, message):
+    response = "❓ I didn't understand that.\n\n"
+    response += "Type *Menu* to see all options\n"
+    response += "or choose from:\n"
+    response += "• *New Booking* - Book appointment\n"
+    response += "• *My Bookings* - View bookings\n"
+    response += "• *Contact Us* - Get contact info"
     return step, data, response
 
-def handle_payment_screenshot(phone, media_id):
-    """Handle payment screenshot upload"""
-    user_session = db.get_session(phone)
-    step = user_session['step']
-    data = user_session['data']
-    
+STATE_STEPS = {step for step, _ in STATE_HANDLERS if step}
+
+def handle_payment_screenshot(phone, step, data, media_id):
+    """Handle payment screenshot upload; it is downloaded and checked in the background"""
     if step == 'waiting_payment_screenshot':
-        filename = f"payment_{phone}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jpg"
-        save_path = os.path.join(Config.UPLOAD_FOLDER, filename)
+        outbox.enqueue(phone, 'process_payment_screenshot', phone, media_id, data)
+        return 'verifying_payment', data
+    
+    if step == 'verifying_payment':
+        outbox.send_message(phone, "⏳ We're still checking the screenshot you sent.\n\n"
+                                   "If it turns out unreadable we'll ask you to send it again.")
+    
+    return step, data
+
+def process_payment_screenshot(phone, media_id, data):
+    """Send queue job: download and verify a screenshot, then record the booking.
+    
+    Returns None on a download error so the queue retries it.
+    """
+    if db.get_session(phone)['step'] != 'verifying_payment':
+        # The customer cancelled while the job was waiting
+        return {'cancelled': True}
+    
+    filename = f"payment_{phone}_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}.jpg"
+    save_path = os.path.join(Config.UPLOAD_FOLDER, filename)
+    
+    try:
+        media = whatsapp.download_media(media_id, save_path)
+    except MediaRejected as e:
+        print(f"Rejected payment screenshot from {phone}: {e}")
+        finish_verification(phone, 'waiting_payment_screenshot', data)
+        outbox.send_message(phone, "❌ That file doesn't look like a payment screenshot.\n\n"
+                                   f"Please send it as a JPEG or PNG image (max {Config.MAX_CONTENT_LENGTH // (1024 * 1024)}MB).")
+        return {'rejected': str(e)}
+    
+    if not media:
+        return None
+    
+    filename = upload_store.store(media['path'], media['sha256'])
+    notes = []
+    is_new = db.save_screenshot(media['sha256'], filename, phone, media['size'])
+    if is_new:
+        thumbnails.make_thumbnail(filename)
+    else:
+        # Identical content was received before; keep one copy of the file
+        existing = db.get_screenshot(media['sha256'])
+        if existing['filename'] != filename:
+            upload_store.remove(filename)
+        filename = existing['filename']
         
-        downloaded = whatsapp.download_media(media_id, save_path)
+        if existing['phone'] == phone and existing['booking_id']:
+            finish_verification(phone, 'menu', {})
+            outbox.send_message(phone, f"✅ We already have this screenshot for booking *#{existing['booking_id']}*.\n\n"
+                                       "Type *Menu* for more options")
+            return {'duplicate_of': existing['booking_id']}
+        if existing['phone'] != phone:
+            notes.append(f"Same screenshot was sent by {existing['phone']}"
+                         + (f" for booking #{existing['booking_id']}" if existing['booking_id'] else ""))
+    
+    # A retry after the booking was saved must not book the slot a second time
+    booking_id = db.find_pending_booking(phone, data['date'], data['time'])
+    if booking_id is None:
+        booking_id = db.save_booking(
+            phone=phone,
+            name=data['name'],
+            services=data['services'],
+            date=data['date'],
+            time=data['time'],
+            total=data['total'],
+            advance_required=data.get('advance_required', 0),
+            status='payment_pending'
+        )
         
-        if downloaded:
+        if booking_id is None:
+            # The customer has already paid, so record the booking and let the admin reschedule
             booking_id = db.save_booking(
                 phone=phone,
                 name=data['name'],
@@ -508,30 +726,54 @@ def handle_payment_screenshot(phone, media_id):
                 time=data['time'],
                 total=data['total'],
                 advance_required=data.get('advance_required', 0),
-                status='payment_pending'
+                status='payment_pending',
+                check_slot=False
             )
-            
-            db.update_booking(booking_id, payment_screenshot=filename)
-            
-            response = "✅ *Payment Screenshot Received!*\n\n"
-            response += f"*Booking ID:* #{booking_id}\n\n"
-            response += "🔍 *Under Review*\n"
-            response += "Our team will verify your payment and confirm within *1 hour*.\n\n"
-            response += "You'll receive a confirmation message once approved. 🎉\n\n"
-            response += "Type *Menu* for more options"
-            
-            whatsapp.send_message(phone, response)
-            
-            db.save_session(phone, 'menu', {})
-        else:
-            whatsapp.send_message(phone, "❌ Failed to receive image. Please try uploading again.")
+            notes.append('Slot was taken while payment was pending - please reschedule')
+    
+    if notes:
+        db.update_booking(booking_id, admin_notes=' / '.join(notes))
+    db.update_booking(booking_id, payment_screenshot=filename)
+    if is_new or existing['phone'] == phone:
+        db.link_screenshot(media['sha256'], booking_id)
+    
+    response = "✅ *Payment Screenshot Received!*\n\n"
+    response += f"*Booking ID:* #{booking_id}\n\n"
+    response += "🔍 *Under Review*\n"
+    response += "Our team will verify your payment and confirm within *1 hour*.\n\n"
+    response += "You'll receive a confirmation message once approved. 🎉\n\n"
+    response += "Type *Menu* for more options"
+    
+    finish_verification(phone, 'menu', {})
+    outbox.send_message(phone, response)
+    return {'booking_id': booking_id}
+
+def finish_verification(phone, step, data):
+    """Move the customer on from 'verifying_payment', unless they already moved on; True if moved"""
+    # Compare-and-set on the revision just read; retry if a webhook wrote in between
+    for _ in range(3):
+        current = db.get_session(phone)
+        if current['step'] != 'verifying_payment':
+            return False
+        if db.save_session(phone, step, data, current['rev']):
+            return True
+    return False
+
+def payment_screenshot_failed(phone, media_id, data):
+    """Send queue gave up on a screenshot; ask for it again rather than leave the customer waiting"""
+    if finish_verification(phone, 'waiting_payment_screenshot', data):
+        outbox.send_message(phone, "⚠️ We couldn't read your payment screenshot.\n\n"
+                                   "Please send it again, or type *Cancel* to cancel this booking.")
+
+outbox.register('process_payment_screenshot', process_payment_screenshot, on_give_up=payment_screenshot_failed)
+outbox.register('handle_deferred_messages', handle_deferred_messages, on_give_up=deferred_messages_lost)
 
 def send_bot_response(phone, step, data, text_response):
     """Send appropriate response based on step"""
     
     if step == 'menu':
         buttons = ["📅 New Booking", "📋 My Bookings", "📞 Contact Us"]
-        whatsapp.send_interactive_buttons(phone, text_response, buttons)
+        outbox.send_interactive_buttons(phone, text_response, buttons)
     
     elif step == 'select_date':
         dates = get_next_7_days()
@@ -539,13 +781,13 @@ def send_bot_response(phone, step, data, text_response):
             "title": "Available Dates",
             "rows": [{"id": d['value'], "title": d['label']} for d in dates]
         }]
-        whatsapp.send_interactive_list(phone, text_response, "📅 Choose Date", sections)
+        outbox.send_interactive_list(phone, text_response, "📅 Choose Date", sections)
     
     elif step == 'confirm_without_payment':
-        whatsapp.send_interactive_buttons(phone, text_response, ["✅ Confirm Now", "❌ Cancel"])
+        outbox.send_interactive_buttons(phone, text_response, ["✅ Confirm Now", "❌ Cancel"])
     
     elif step == 'confirm_with_payment':
-        whatsapp.send_interactive_buttons(phone, text_response, ["💳 Proceed to Payment", "❌ Cancel"])
+        outbox.send_interactive_buttons(phone, text_response, ["💳 Proceed to Payment", "❌ Cancel"])
     
     elif step == 'show_payment':
         advance = data.get('advance_required', 0)
@@ -555,12 +797,12 @@ def send_bot_response(phone, step, data, text_response):
         caption += "📱 Scan the QR code above to pay.\n\n"
         caption += "After payment, click *I Have Paid* button"
         
-        whatsapp.send_image(phone, Config.QR_CODE_PATH, caption)
-        whatsapp.send_interactive_buttons(phone, "Have you completed the payment?", ["✅ I Have Paid", "🔙 Back"])
+        outbox.send_image(phone, Config.QR_CODE_PATH, caption)
+        outbox.send_interactive_buttons(phone, "Have you completed the payment?", ["✅ I Have Paid", "🔙 Back"])
     
     else:
         if text_response:
-            whatsapp.send_message(phone, text_response)
+            outbox.send_message(phone, text_response)
 
 # =================== ADMIN PANEL ===================
 
@@ -583,20 +825,58 @@ def admin_dashboard():
     if 'admin_logged_in' not in session:
         return redirect(url_for('admin_login'))
     
-    bookings = db.get_bookings()
+    filters = get_booking_filters()
+    bookings, next_cursor = get_bookings_page(filters)
     
+    summary = db.get_booking_summary()
     stats = {
-        'total': len(bookings),
-        'confirmed': len([b for b in bookings if b['status'] == 'confirmed']),
-        'pending': len([b for b in bookings if b['status'] == 'payment_pending']),
-        'cancelled': len([b for b in bookings if b['status'] in ['cancelled', 'rejected']])
+        'total': summary['total_bookings'],
+        'confirmed': summary['confirmed'],
+        'pending': summary['pending'],
+        'cancelled': summary['cancelled']
     }
     
     return render_template('admin.html', 
                          page='dashboard', 
                          bookings=bookings, 
                          stats=stats,
-                         services=Config.SERVICES)
+                         filters=filters,
+                         next_cursor=next_cursor)
+
+@app.route('/admin/api/bookings')
+def admin_bookings_api():
+    """Booking table as JSON, one keyset page at a time"""
+    if 'admin_logged_in' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    bookings, next_cursor = get_bookings_page(get_booking_filters())
+    return jsonify({'bookings': bookings, 'next_cursor': next_cursor})
+
+def get_booking_filters():
+    """Status and date filters from the query string"""
+    return {
+        'status': request.args.get('status') or None,
+        'start_date': request.args.get('start_date') or None,
+        'end_date': request.args.get('end_date') or None
+    }
+
+def get_bookings_page(filters, page_size=None):
+    """Fetch the page after ?cursor= and return it with the cursor for the next one"""
+    limit = max(1, min(request.args.get('limit', page_size or Config.DASHBOARD_PAGE_SIZE, type=int), 500))
+    before = None
+    cursor = request.args.get('cursor')
+    if cursor and '|' in cursor:
+        created_at, booking_id = cursor.rsplit('|', 1)
+        before = (created_at, int(booking_id)) if booking_id.isdigit() else None
+    
+    # Fetch one extra row to know whether another page exists
+    bookings = db.get_bookings(before=before, limit=limit + 1, **filters)
+    next_cursor = None
+    if len(bookings) > limit:
+        bookings = bookings[:limit]
+        last = bookings[-1]
+        next_cursor = f"{last['created_at']}|{last['id']}"
+    return bookings, next_cursor
 
 @app.route('/admin/booking/<int:booking_id>/approve', methods=['POST'])
 def approve_booking(booking_id):
@@ -607,21 +887,18 @@ def approve_booking(booking_id):
     if booking:
         db.update_booking(booking_id, status='confirmed')
         
-        services = json.loads(booking['services'])
-        service_names = [Config.SERVICES[s]['name'] for s in services]
-        
         message = "🎉 *Payment Verified - Booking Confirmed!*\n\n"
         message += f"*Booking ID:* #{booking_id}\n"
         message += f"*Name:* {booking['name']}\n"
         message += f"*Date:* {booking['date']}\n"
         message += f"*Time:* {booking['time']}\n"
-        message += f"*Services:* {', '.join(service_names)}\n"
+        message += f"*Services:* {booking['service_names']}\n"
         message += f"*Total:* ₹{booking['total']}\n\n"
         message += f"✨ See you at *{Config.SALON_NAME}*!\n\n"
         message += f"📍 {Config.SALON_ADDRESS}\n"
         message += f"📞 {Config.SALON_PHONE}"
         
-        whatsapp.send_message(booking['phone'], message)
+        outbox.send_message(booking['phone'], message)
         
         flash(f'Booking #{booking_id} approved and customer notified!', 'success')
     
@@ -645,7 +922,7 @@ def reject_booking(booking_id):
         message += f"📞 {Config.SALON_PHONE}\n\n"
         message += "You can rebook by typing *New Booking*"
         
-        whatsapp.send_message(booking['phone'], message)
+        outbox.send_message(booking['phone'], message)
         
         flash(f'Booking #{booking_id} rejected!', 'warning')
     
@@ -658,189 +935,110 @@ def admin_logout():
 
 # =================== EXPORT & PRINT FEATURES ===================
 
-@app.route('/admin/export/excel')
-def export_excel():
-    """Export all bookings to Excel"""
+def run_export(kind, params, filename):
+    """Send a cached artifact straight away, otherwise show the job's progress page"""
+    job = job_runner.submit(kind, params, filename)
+    if job['status'] == 'done':
+        return redirect(url_for('download_job', job_id=job['id']))
+    return redirect(url_for('job_status', job_id=job['id']))
+
+@app.route('/admin/jobs/<int:job_id>')
+def job_status(job_id):
+    """Progress page for a background export; add ?format=json to poll"""
     if 'admin_logged_in' not in session:
         return redirect(url_for('admin_login'))
     
-    from openpyxl import Workbook
-    from openpyxl.styles import Font, Alignment, PatternFill
-    from io import BytesIO
-    from flask import send_file
+    job = db.get_export_job(job_id)
+    if not job:
+        flash('Export not found!', 'error')
+        return redirect(url_for('admin_dashboard'))
     
-    # Get all bookings
-    bookings = db.get_bookings()
-    
-    # Create workbook
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Salon Bookings"
-    
-    # Headers
-    headers = ['Booking ID', 'Date', 'Time', 'Customer Name', 'Phone', 'Services', 
-               'Total Amount', 'Advance', 'Status', 'Payment Screenshot', 'Created At', 'Admin Notes']
-    
-    # Style headers
-    header_fill = PatternFill(start_color="667eea", end_color="667eea", fill_type="solid")
-    header_font = Font(bold=True, color="FFFFFF")
-    
-    for col, header in enumerate(headers, 1):
-        cell = ws.cell(row=1, column=col)
-        cell.value = header
-        cell.fill = header_fill
-        cell.font = header_font
-        cell.alignment = Alignment(horizontal='center', vertical='center')
-    
-    # Data rows
-    for row_idx, booking in enumerate(bookings, 2):
-        services = json.loads(booking['services'])
-        service_names = ', '.join([Config.SERVICES[s]['name'] for s in services])
-        
-        ws.cell(row=row_idx, column=1, value=booking['id'])
-        ws.cell(row=row_idx, column=2, value=booking['date'])
-        ws.cell(row=row_idx, column=3, value=booking['time'])
-        ws.cell(row=row_idx, column=4, value=booking['name'])
-        ws.cell(row=row_idx, column=5, value=booking['phone'])
-        ws.cell(row=row_idx, column=6, value=service_names)
-        ws.cell(row=row_idx, column=7, value=booking['total'])
-        ws.cell(row=row_idx, column=8, value=booking['advance_required'] if booking['advance_required'] else 0)
-        ws.cell(row=row_idx, column=9, value=booking['status'])
-        ws.cell(row=row_idx, column=10, value=booking['payment_screenshot'] if booking['payment_screenshot'] else 'N/A')
-        ws.cell(row=row_idx, column=11, value=booking['created_at'])
-        ws.cell(row=row_idx, column=12, value=booking['admin_notes'] if booking['admin_notes'] else '')
-    
-    # Adjust column widths
-    for col in range(1, len(headers) + 1):
-        ws.column_dimensions[chr(64 + col)].width = 18
-    
-    # Save to BytesIO
-    output = BytesIO()
-    wb.save(output)
-    output.seek(0)
-    
-    filename = f"salon_bookings_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+    if job['status'] in ('queued', 'running'):
+        # The worker that queued it may have restarted; make sure someone runs it
+        job_runner.kick()
+        job = db.get_export_job(job_id)
+    
+    if request.args.get('format') == 'json':
+        return jsonify({
+            'id': job['id'],
+            'status': job['status'],
+            'error': job['error'],
+            'download_url': url_for('download_job', job_id=job_id) if job['status'] == 'done' else None
+        })
     
-    return send_file(
-        output,
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        as_attachment=True,
-        download_name=filename
-    )
+    return render_template('admin.html', page='job', job=job)
 
-@app.route('/admin/export/pdf')
-def export_pdf():
-    """Export bookings to PDF"""
+@app.route('/admin/jobs/<int:job_id>/download')
+def download_job(job_id):
     if 'admin_logged_in' not in session:
         return redirect(url_for('admin_login'))
     
-    from reportlab.lib import colors
-    from reportlab.lib.pagesizes import A4, landscape
-    from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
-    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-    from reportlab.lib.units import inch
-    from io import BytesIO
     from flask import send_file
     
-    # Get bookings
-    bookings = db.get_bookings()
-    
-    # Create PDF
-    buffer = BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=landscape(A4))
-    elements = []
-    
-    # Styles
-    styles = getSampleStyleSheet()
-    title_style = ParagraphStyle(
-        'CustomTitle',
-        parent=styles['Heading1'],
-        fontSize=24,
-        textColor=colors.HexColor('#667eea'),
-        spaceAfter=30,
-        alignment=1  # Center
-    )
+    job = db.get_export_job(job_id)
+    if not job or job['status'] != 'done' or not os.path.exists(job['result_path']):
+        flash('Export is not ready!', 'error')
+        return redirect(url_for('admin_dashboard'))
     
-    # Title
-    title = Paragraph(f"<b>{Config.SALON_NAME}</b><br/>Booking Report", title_style)
-    elements.append(title)
-    elements.append(Spacer(1, 0.2*inch))
-    
-    # Stats summary
-    stats_data = [
-        ['Total Bookings', 'Confirmed', 'Pending Payment', 'Cancelled'],
-        [
-            str(len(bookings)),
-            str(len([b for b in bookings if b['status'] == 'confirmed'])),
-            str(len([b for b in bookings if b['status'] == 'payment_pending'])),
-            str(len([b for b in bookings if b['status'] in ['cancelled', 'rejected']]))
-        ]
-    ]
+    return send_file(job['result_path'], as_attachment=True, download_name=job['filename'])
+
+@app.route('/admin/screenshots/<path:filename>')
+def screenshot_file(filename):
+    """A payment screenshot, whether it is still on disk or archived"""
+    if 'admin_logged_in' not in session:
+        return redirect(url_for('admin_login'))
     
-    stats_table = Table(stats_data)
-    stats_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#667eea')),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, 0), 12),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-        ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-        ('GRID', (0, 0), (-1, -1), 1, colors.black)
-    ]))
-    elements.append(stats_table)
-    elements.append(Spacer(1, 0.3*inch))
-    
-    # Bookings table
-    data = [['ID', 'Date', 'Time', 'Customer', 'Phone', 'Services', 'Amount', 'Status']]
-    
-    for booking in bookings[:50]:  # Limit to 50 for PDF
-        services = json.loads(booking['services'])
-        service_names = ', '.join([Config.SERVICES[s]['name'] for s in services])
-        
-        data.append([
-            str(booking['id']),
-            booking['date'],
-            booking['time'],
-            booking['name'],
-            booking['phone'][-4:],  # Last 4 digits
-            service_names[:30] + '...' if len(service_names) > 30 else service_names,
-            f"₹{booking['total']}",
-            booking['status']
-        ])
-    
-    table = Table(data)
-    table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#667eea')),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, 0), 10),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-        ('BACKGROUND', (0, 1), (-1, -1), colors.white),
-        ('GRID', (0, 0), (-1, -1), 1, colors.grey),
-        ('FONTSIZE', (0, 1), (-1, -1), 8),
-    ]))
-    elements.append(table)
-    
-    # Footer
-    elements.append(Spacer(1, 0.3*inch))
-    footer_text = f"Generated on {datetime.now().strftime('%d %B %Y, %I:%M %p')}"
-    footer = Paragraph(footer_text, styles['Normal'])
-    elements.append(footer)
-    
-    # Build PDF
-    doc.build(elements)
-    buffer.seek(0)
-    
-    filename = f"salon_bookings_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
+    from flask import send_file, abort
     
-    return send_file(
-        buffer,
-        mimetype='application/pdf',
-        as_attachment=True,
-        download_name=filename
-    )
+    opened = upload_store.open(filename)
+    if not opened:
+        abort(404)
+    
+    file, mimetype = opened
+    return send_file(file, mimetype=mimetype, download_name=os.path.basename(filename), conditional=True)
+
+@app.route('/admin/screenshots/<path:filename>/thumbnail')
+def screenshot_thumbnail(filename):
+    """Small version of a payment screenshot for the dashboard"""
+    if 'admin_logged_in' not in session:
+        return redirect(url_for('admin_login'))
+    
+    from flask import send_file, abort
+    
+    if not upload_store.path_of(filename):
+        abort(404)
+    
+    path = thumbnails.thumbnail_path(filename)
+    if not os.path.exists(path):
+        opened = upload_store.open(filename)
+        if not opened:
+            abort(404)
+        with opened[0] as source:
+            path = thumbnails.make_thumbnail(filename, source)
+        if not path:
+            return redirect(url_for('screenshot_file', filename=filename))
+    
+    response = send_file(os.path.abspath(path), max_age=Config.THUMBNAIL_MAX_AGE, conditional=True)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    return response
+
+@app.route('/admin/export/excel')
+def export_excel():
+    """Export bookings to Excel (accepts status/start_date/end_date filters)"""
+    if 'admin_logged_in' not in session:
+        return redirect(url_for('admin_login'))
+    
+    return run_export('excel', get_booking_filters(), exports.export_filename('xlsx'))
+
+@app.route('/admin/export/pdf')
+def export_pdf():
+    """Export bookings to PDF (accepts status/start_date/end_date filters)"""
+    if 'admin_logged_in' not in session:
+        return redirect(url_for('admin_login'))
+    
+    return run_export('pdf', get_booking_filters(), exports.export_filename('pdf'))
 
 @app.route('/admin/booking/<int:booking_id>/print')
 def print_booking(booking_id):
@@ -848,141 +1046,16 @@ def print_booking(booking_id):
     if 'admin_logged_in' not in session:
         return redirect(url_for('admin_login'))
     
-    from reportlab.lib.pagesizes import A4
-    from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
-    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-    from reportlab.lib.units import inch
-    from reportlab.lib import colors
-    from io import BytesIO
-    from flask import send_file
-    
-    booking = db.get_booking(booking_id)
-    
-    if not booking:
+    if not db.get_booking(booking_id):
         flash('Booking not found!', 'error')
         return redirect(url_for('admin_dashboard'))
     
-    # Create PDF
-    buffer = BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=A4, rightMargin=72, leftMargin=72, topMargin=72, bottomMargin=18)
-    elements = []
-    
-    styles = getSampleStyleSheet()
-    
-    # Header style
-    header_style = ParagraphStyle(
-        'CustomHeader',
-        parent=styles['Heading1'],
-        fontSize=26,
-        textColor=colors.HexColor('#667eea'),
-        spaceAfter=12,
-        alignment=1
-    )
-    
-    # Salon name
-    header = Paragraph(f"<b>{Config.SALON_NAME}</b>", header_style)
-    elements.append(header)
-    
-    # Salon details
-    salon_info = Paragraph(
-        f"{Config.SALON_ADDRESS}<br/>{Config.SALON_PHONE}",
-        styles['Normal']
-    )
-    elements.append(salon_info)
-    elements.append(Spacer(1, 0.3*inch))
-    
-    # Invoice title
-    invoice_title = Paragraph(
-        f"<b>BOOKING INVOICE</b><br/>Booking ID: #{booking_id}",
-        ParagraphStyle('InvoiceTitle', parent=styles['Heading2'], alignment=1, fontSize=18, spaceAfter=20)
-    )
-    elements.append(invoice_title)
-    elements.append(Spacer(1, 0.2*inch))
-    
-    # Customer details
-    customer_data = [
-        ['Customer Name:', booking['name']],
-        ['Phone:', booking['phone']],
-        ['Date:', booking['date']],
-        ['Time:', booking['time']],
-        ['Booking Status:', booking['status'].replace('_', ' ').title()]
-    ]
-    
-    customer_table = Table(customer_data, colWidths=[2*inch, 4*inch])
-    customer_table.setStyle(TableStyle([
-        ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, -1), 11),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
-    ]))
-    elements.append(customer_table)
-    elements.append(Spacer(1, 0.3*inch))
-    
-    # Services table
-    services = json.loads(booking['services'])
-    service_data = [['Service', 'Duration', 'Price']]
-    
-    for s_id in services:
-        service = Config.SERVICES[s_id]
-        service_data.append([
-            service['name'],
-            service['duration'],
-            f"₹{service['price']}"
-        ])
-    
-    # Add total row
-    service_data.append(['', 'TOTAL:', f"₹{booking['total']}"])
-    
-    service_table = Table(service_data, colWidths=[3*inch, 1.5*inch, 1.5*inch])
-    service_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#667eea')),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-        ('ALIGN', (2, 0), (2, -1), 'RIGHT'),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, 0), 12),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-        ('BACKGROUND', (0, 1), (-1, -2), colors.white),
-        ('GRID', (0, 0), (-1, -2), 1, colors.grey),
-        ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, -1), (-1, -1), 14),
-        ('BACKGROUND', (0, -1), (-1, -1), colors.lightgrey),
-        ('LINEABOVE', (0, -1), (-1, -1), 2, colors.black),
-    ]))
-    elements.append(service_table)
-    elements.append(Spacer(1, 0.3*inch))
-    
-    # Payment info
-    if booking['advance_required'] > 0:
-        payment_info = Paragraph(
-            f"<b>Advance Paid:</b> ₹{booking['advance_required']}<br/>"
-            f"<b>Balance Due:</b> ₹{booking['total'] - booking['advance_required']}",
-            styles['Normal']
-        )
-        elements.append(payment_info)
-        elements.append(Spacer(1, 0.2*inch))
-    
-    # Footer
-    footer = Paragraph(
-        f"<i>Thank you for choosing {Config.SALON_NAME}!<br/>"
-        f"We look forward to serving you.<br/>"
-        f"Generated on {datetime.now().strftime('%d %B %Y, %I:%M %p')}</i>",
-        ParagraphStyle('Footer', parent=styles['Normal'], alignment=1, fontSize=9)
-    )
-    elements.append(Spacer(1, 0.5*inch))
-    elements.append(footer)
-    
-    # Build PDF
-    doc.build(elements)
-    buffer.seek(0)
+    cached = invoice_cache.get(booking_id)
+    if cached:
+        from flask import send_file
+        return send_file(cached, as_attachment=True, download_name=f"booking_{booking_id}_invoice.pdf")
     
-    filename = f"booking_{booking_id}_invoice.pdf"
-    
-    return send_file(
-        buffer,
-        mimetype='application/pdf',
-        as_attachment=True,
-        download_name=filename
-    )
+    return run_export('invoice', {'booking_id': booking_id}, f"booking_{booking_id}_invoice.pdf")
 
 @app.route('/admin/reports')
 def admin_reports():
@@ -991,58 +1064,31 @@ def admin_reports():
         return redirect(url_for('admin_login'))
     
     # Get filter parameters
-    start_date = request.args.get('start_date')
-    end_date = request.args.get('end_date')
-    status_filter = request.args.get('status')
-    
-    bookings = db.get_bookings()
-    
-    # Apply filters
-    if start_date:
-        bookings = [b for b in bookings if b['date'] >= start_date]
-    if end_date:
-        bookings = [b for b in bookings if b['date'] <= end_date]
-    if status_filter:
-        bookings = [b for b in bookings if b['status'] == status_filter]
-    
-    # Calculate statistics
-    total_revenue = sum([b['total'] for b in bookings if b['status'] == 'confirmed'])
-    total_advance = sum([b['advance_required'] for b in bookings if b['advance_required']])
-    
-    # Service popularity
-    service_count = {}
-    for booking in bookings:
-        services = json.loads(booking['services'])
-        for s_id in services:
-            service_name = Config.SERVICES[s_id]['name']
-            service_count[service_name] = service_count.get(service_name, 0) + 1
-    
-    # Most popular services
-    popular_services = sorted(service_count.items(), key=lambda x: x[1], reverse=True)[:5]
-    
-    # Date-wise bookings
-    date_bookings = {}
-    for booking in bookings:
-        date = booking['date']
-        date_bookings[date] = date_bookings.get(date, 0) + 1
+    filters = get_booking_filters()
+    start_date = filters['start_date']
+    end_date = filters['end_date']
+    status_filter = filters['status']
+    
+    # All figures are aggregated in SQL over the selected range only
+    stats = db.get_booking_summary(start_date, end_date, status_filter)
+    stats['popular_services'] = [
+        (s['name'], s['count'])
+        for s in db.get_service_stats(start_date, end_date, status_filter, limit=5)
+    ]
+    stats['date_bookings'] = db.get_bookings_per_date(start_date, end_date, status_filter)
     
-    stats = {
-        'total_bookings': len(bookings),
-        'confirmed': len([b for b in bookings if b['status'] == 'confirmed']),
-        'pending': len([b for b in bookings if b['status'] == 'payment_pending']),
-        'cancelled': len([b for b in bookings if b['status'] in ['cancelled', 'rejected']]),
-        'total_revenue': total_revenue,
-        'total_advance': total_advance,
-        'popular_services': popular_services,
-        'date_bookings': date_bookings
-    }
+    # Bookings in the range, one keyset page at a time like the dashboard
+    bookings, next_cursor = get_bookings_page(filters, Config.REPORT_PAGE_SIZE)
     
     return render_template('reports.html', 
                          stats=stats, 
                          bookings=bookings,
                          start_date=start_date,
                          end_date=end_date,
-                         status_filter=status_filter)
+                         status_filter=status_filter,
+                         filters={k: v for k, v in filters.items() if v},
+                         cursor=request.args.get('cursor'),
+                         next_cursor=next_cursor)
 
 @app.route('/admin/backup')
 def backup_database():
@@ -1052,6 +1098,9 @@ def backup_database():
     
     from flask import send_file
     
+    # Recent writes may still be in the WAL file
+    db.checkpoint()
+    
     db_path = db.db_name
     filename = f"salon_db_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
     
@@ -1092,6 +1141,12 @@ def home():
 def health():
     return jsonify({'status': 'healthy'}), 200
 
+@app.cli.command('maintain-uploads')
+def maintain_uploads():
+    """Shard, purge, archive and expire payment screenshots (run daily from cron)"""
+    for step, count in upload_store.maintain().items():
+        print(f"{step}: {count}")
+
 if __name__ == '__main__':
     import os
     port = int(os.environ.get("PORT",5000))
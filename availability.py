@@ -0,0 +1,87 @@
+import threading
+import time
+from datetime import datetime, timedelta
+from config import Config
+from scheduling import DaySchedule
+
+class SlotIndex:
+    """In-memory index of free start times for the booking window.
+
+    Each date keeps a DaySchedule of its active bookings; live holds are
+    kept per phone and laid over the schedule when a date is looked up.
+    Writes made through this process patch the index directly via
+    Database.slot_listeners; writes from other worker processes are caught
+    by comparing slots_version, a single primary-key read, and reloading
+    the window when it moved.
+    """
+
+    def __init__(self, db, days=7):
+        self.db = db
+        self.days = days
+        self.slots = list(Config.TIME_SLOTS)
+        self._lock = threading.Lock()
+        self._version = None
+        self._start = None
+        self._schedules = {}  # date -> DaySchedule of active bookings
+        self._holds = {}      # phone -> hold row
+        db.slot_listeners.append(self.apply)
+
+    def available_slots(self, date, phone=None, duration=None):
+        """Start times on a date with a chair free for `duration` minutes (phone's own hold excluded)"""
+        duration = duration or Config.DEFAULT_SERVICE_MINUTES
+        start, end = self._window()
+        if not start <= date <= end:
+            # Outside the booking window; not worth keeping in memory
+            return self.db.get_day_schedule(date, phone).free_starts(self.slots, duration)
+
+        version = self.db.get_slots_version()
+        with self._lock:
+            if version != self._version or start != self._start:
+                self._load(start, end)
+            schedule = self._schedules[date]
+            now = time.time()
+            holds = [h for p, h in self._holds.items() if p != phone and h['date'] == date and h['expires_at'] > now]
+            if holds:
+                schedule = schedule.copy()
+                for hold in holds:
+                    schedule.add(hold['time'], hold['duration'])
+            return schedule.free_starts(self.slots, duration)
+
+    def apply(self, change, before, after):
+        """Patch the index after a write; reload next time if we missed a change"""
+        with self._lock:
+            if self._version is None or self._version != before:
+                self._version = None
+                return
+
+            action = change['action']
+            if action not in ('book', 'hold', 'release'):
+                self._version = None
+                return
+
+            # Booking or re-holding drops the phone's earlier hold
+            self._holds.pop(change['phone'], None)
+            if action == 'book' and change['date'] in self._schedules:
+                self._schedules[change['date']].add(change['time'], change['duration'])
+            elif action == 'hold':
+                now = time.time()
+                self._holds = {p: h for p, h in self._holds.items() if h['expires_at'] > now}
+                self._holds[change['phone']] = change
+
+            self._version = after
+
+    def _window(self):
+        today = datetime.now()
+        return today.strftime("%Y-%m-%d"), (today + timedelta(days=self.days - 1)).strftime("%Y-%m-%d")
+
+    def _load(self, start, end):
+        bookings, holds, version = self.db.get_slot_state(start, end)
+
+        first = datetime.strptime(start, "%Y-%m-%d")
+        self._schedules = {(first + timedelta(days=i)).strftime("%Y-%m-%d"): DaySchedule() for i in range(self.days)}
+        for booking in bookings:
+            self._schedules[booking['date']].add(booking['time'], booking['duration'] or Config.DEFAULT_SERVICE_MINUTES)
+        self._holds = {hold['phone']: hold for hold in holds}
+
+        self._version = version
+        self._start = start
@@ -8,14 +8,74 @@ class Config:
     SECRET_KEY = os.getenv('SECRET_KEY', 'salon_secret_key_change_me')
     UPLOAD_FOLDER = 'static/uploads'
     MAX_CONTENT_LENGTH = 5 * 1024 * 1024  # 5MB
+    UPLOAD_ARCHIVE_FOLDER = 'uploads_archive'  # outside static/, served only through the admin
+    UPLOAD_REJECTED_RETENTION_DAYS = int(os.getenv('UPLOAD_REJECTED_RETENTION_DAYS', 30))
+    UPLOAD_ARCHIVE_AFTER_DAYS = int(os.getenv('UPLOAD_ARCHIVE_AFTER_DAYS', 90))  # 0 = never archive
+    UPLOAD_RETENTION_DAYS = int(os.getenv('UPLOAD_RETENTION_DAYS', 3 * 365))  # 0 = keep forever
+    THUMBNAIL_FOLDER = 'static/uploads/thumbs'
+    THUMBNAIL_SIZE = (320, 320)
+    THUMBNAIL_QUALITY = 70
+    THUMBNAIL_MAX_AGE = 365 * 24 * 3600  # upload names are unique, so thumbnails never change
+    
+    # SQLite tuning (connections are kept open per thread)
+    DB_BUSY_TIMEOUT = float(os.getenv('DB_BUSY_TIMEOUT', 5))  # seconds to wait for a lock
+    DB_CACHE_SIZE_KB = int(os.getenv('DB_CACHE_SIZE_KB', 8192))
+    DB_STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', 128))
     
     # WhatsApp API (Meta)
     WHATSAPP_TOKEN = os.getenv('WHATSAPP_TOKEN')
     WHATSAPP_PHONE_ID = os.getenv('WHATSAPP_PHONE_ID')
     VERIFY_TOKEN = os.getenv('VERIFY_TOKEN', 'salon_verify_token_123')
     
+    # Graph API HTTP client (pool sizes are per worker process)
+    WHATSAPP_CONNECT_TIMEOUT = float(os.getenv('WHATSAPP_CONNECT_TIMEOUT', 3.05))
+    WHATSAPP_READ_TIMEOUT = float(os.getenv('WHATSAPP_READ_TIMEOUT', 15))
+    WHATSAPP_POOL_CONNECTIONS = int(os.getenv('WHATSAPP_POOL_CONNECTIONS', 2))
+    WHATSAPP_POOL_MAXSIZE = int(os.getenv('WHATSAPP_POOL_MAXSIZE', 10))
+    
+    # Background export jobs (Excel/PDF reports, invoices)
+    EXPORT_FOLDER = 'exports'
+    EXPORT_WORKERS = int(os.getenv('EXPORT_WORKERS', 1))  # processes per gunicorn worker
+    EXPORT_JOB_TIMEOUT = 15 * 60  # seconds before an unfinished job is considered lost
+    EXPORT_JOB_MAX_ATTEMPTS = 2  # runs of a job whose worker died before it is marked failed
+    EXPORT_RETENTION = 24 * 3600  # seconds to keep generated files
+    INVOICE_CACHE_FOLDER = 'exports/invoices'
+    INVOICE_CACHE_MAX_BYTES = 50 * 1024 * 1024  # least recently used invoices are evicted beyond this
+    
+    # Outbound send queue
+    SEND_QUEUE_WORKERS = int(os.getenv('SEND_QUEUE_WORKERS', 4))
+    SEND_QUEUE_MAX_ATTEMPTS = int(os.getenv('SEND_QUEUE_MAX_ATTEMPTS', 5))
+    SEND_QUEUE_BACKOFF_SECONDS = float(os.getenv('SEND_QUEUE_BACKOFF_SECONDS', 2))
+    SEND_QUEUE_POLL_SECONDS = float(os.getenv('SEND_QUEUE_POLL_SECONDS', 1))
+    SEND_QUEUE_LEASE_SECONDS = int(os.getenv('SEND_QUEUE_LEASE_SECONDS', 60))
+    # Messages per second to the Graph API, shared by all workers (the budget is kept
+    # in the database). Meta allows 80/s per business number by default, up to 1000/s
+    # once upgraded.
+    WHATSAPP_SEND_RATE = float(os.getenv('WHATSAPP_SEND_RATE', 80))
+    WHATSAPP_SEND_BURST = int(os.getenv('WHATSAPP_SEND_BURST', 80))
+    
+    # Inbound flood protection per customer; messages over the limit are queued
+    SENDER_RATE_PER_MINUTE = float(os.getenv('SENDER_RATE_PER_MINUTE', 20))
+    SENDER_BURST = int(os.getenv('SENDER_BURST', 8))
+    SENDER_NOTICE_SECONDS = 60  # at most one slow-down reply per customer this often
+    SENDER_MAX_BACKLOG_SECONDS = 10 * 60  # beyond this, queued text is dropped (images never are)
+    
+    # Conversation sessions; use the redis backend to run the bot on several hosts
+    SESSION_BACKEND = os.getenv('SESSION_BACKEND', 'sqlite')  # 'sqlite' or 'redis'
+    REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+    SESSION_TTL_SECONDS = int(os.getenv('SESSION_TTL_SECONDS', 24 * 3600))  # idle time before a chat restarts
+    SESSION_SWEEP_SECONDS = int(os.getenv('SESSION_SWEEP_SECONDS', 10 * 60))
+    SESSION_CACHE_SIZE = int(os.getenv('SESSION_CACHE_SIZE', 10000))
+    
+    # Webhook retries: message IDs already handled are skipped for this long
+    MESSAGE_DEDUP_WINDOW_SECONDS = int(os.getenv('MESSAGE_DEDUP_WINDOW_SECONDS', 7 * 24 * 3600))  # Meta retries for up to 7 days
+    MESSAGE_DEDUP_CACHE_SIZE = int(os.getenv('MESSAGE_DEDUP_CACHE_SIZE', 10000))
+    MESSAGE_DEDUP_PRUNE_SECONDS = 3600
+    
     # Business Settings
     ADMIN_PASSWORD = os.getenv('ADMIN_PASSWORD', 'admin123')
+    REPORT_PAGE_SIZE = 50
+    DASHBOARD_PAGE_SIZE = 50
     SALON_NAME = "Smart Salon"
     SALON_ADDRESS = "123 Main Street, City"
     SALON_PHONE = "+91 9876543210"
@@ -23,6 +83,7 @@ class Config:
     # Payment
     UPI_ID = os.getenv('UPI_ID', 'salon@upi')
     QR_CODE_PATH = 'static/qr_code.jpg'  # Upload your QR code here
+    MEDIA_ID_TTL_SECONDS = 29 * 24 * 3600  # Meta keeps uploaded media for 30 days
     
     # Services
     SERVICES = {
@@ -43,6 +104,15 @@ class Config:
         "04:00 PM", "05:00 PM", "06:00 PM", "07:00 PM"
     ]
     
+    # Appointments run on any free chair and must finish by closing time
+    CHAIRS = int(os.getenv('CHAIRS', 1))
+    CLOSING_TIME = os.getenv('CLOSING_TIME', "08:00 PM")
+    SCHEDULE_TICK_MINUTES = int(os.getenv('SCHEDULE_TICK_MINUTES', 15))
+    DEFAULT_SERVICE_MINUTES = 60
+    
     # Payment threshold
     ADVANCE_PAYMENT_THRESHOLD = 1000
     ADVANCE_PERCENTAGE = 0.5  # 50%
+    
+    # How long a chosen slot is reserved while the customer confirms or pays
+    SLOT_HOLD_SECONDS = int(os.getenv('SLOT_HOLD_SECONDS', 20 * 60))
@@ -1,33 +1,30 @@
 import sqlite3
+import os
+import threading
+import time
 from datetime import datetime, timedelta
 import json
 from config import Config
+from scheduling import DaySchedule, parse_duration, services_duration
+from sessions import SessionStore, create_backend
 
-class Database:
-    def __init__(self, db_name="salon.db"):
-        self.db_name = db_name
-        self.init_db()
-    
-    def get_connection(self):
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
-        return conn
-    
-    def init_db(self):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
+# Schema migrations, applied in order by Database.init_db.
+# Each entry is (version, description, steps); a step is either an SQL
+# string or a callable that receives the cursor. Never edit a migration
+# that has shipped - add a new one instead.
+MIGRATIONS = [
+    (1, "Base schema", [
         # Users table
-        cursor.execute('''
+        '''
             CREATE TABLE IF NOT EXISTS users (
                 phone TEXT PRIMARY KEY,
                 name TEXT,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
-        ''')
+        ''',
         
         # Bookings table
-        cursor.execute('''
+        '''
             CREATE TABLE IF NOT EXISTS bookings (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 phone TEXT,
@@ -43,132 +40,1125 @@ class Database:
                 admin_notes TEXT,
                 FOREIGN KEY (phone) REFERENCES users(phone)
             )
-        ''')
+        ''',
         
         # Sessions table
-        cursor.execute('''
+        '''
             CREATE TABLE IF NOT EXISTS sessions (
                 phone TEXT PRIMARY KEY,
                 step TEXT,
                 data TEXT,
                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
-        ''')
+        ''',
         
-        conn.commit()
-        conn.close()
+        # Outbound send queue
+        '''
+            CREATE TABLE IF NOT EXISTS outbound_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                phone TEXT,
+                kind TEXT,
+                payload TEXT,
+                status TEXT DEFAULT 'queued',
+                attempts INTEGER DEFAULT 0,
+                next_attempt_at REAL,
+                locked_at REAL,
+                last_error TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''',
+        
+        # Uploaded media IDs, keyed by file content hash
+        '''
+            CREATE TABLE IF NOT EXISTS media_cache (
+                file_hash TEXT PRIMARY KEY,
+                media_id TEXT,
+                uploaded_at REAL
+            )
+        ''',
+    ]),
+    (2, "Indexes for booking lookups and the send queue", [
+        'CREATE INDEX IF NOT EXISTS idx_bookings_date_status ON bookings (date, status)',
+        'CREATE INDEX IF NOT EXISTS idx_bookings_phone_created ON bookings (phone, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_bookings_status_created ON bookings (status, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_bookings_created ON bookings (created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_outbound_jobs_status ON outbound_jobs (status, next_attempt_at)',
+        'CREATE INDEX IF NOT EXISTS idx_outbound_jobs_phone ON outbound_jobs (phone, status)',
+    ]),
+    (3, "Normalize booking services into booking_services", [
+        # WITHOUT ROWID keeps each booking's rows stored in position order
+        '''
+            CREATE TABLE IF NOT EXISTS booking_services (
+                booking_id INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                service_id TEXT NOT NULL,
+                name TEXT,
+                price INTEGER,
+                duration TEXT,
+                PRIMARY KEY (booking_id, position)
+            ) WITHOUT ROWID
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_booking_services_service ON booking_services (service_id)',
+        lambda cursor: backfill_booking_services(cursor),
+    ]),
+    (4, "Background export jobs and a bookings change counter", [
+        '''
+            CREATE TABLE IF NOT EXISTS export_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT,
+                params TEXT,
+                cache_key TEXT,
+                filename TEXT,
+                status TEXT DEFAULT 'queued',
+                result_path TEXT,
+                error TEXT,
+                created_at REAL,
+                finished_at REAL
+            )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_export_jobs_cache_key ON export_jobs (cache_key)',
+        
+        # Bumped on every booking change so cached artifacts know when they are stale
+        'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)',
+        "INSERT OR IGNORE INTO meta (key, value) VALUES ('bookings_version', 0)",
+        '''
+            CREATE TRIGGER IF NOT EXISTS bookings_version_insert AFTER INSERT ON bookings
+            BEGIN
+                UPDATE meta SET value = value + 1 WHERE key = 'bookings_version';
+            END
+        ''',
+        '''
+            CREATE TRIGGER IF NOT EXISTS bookings_version_update AFTER UPDATE ON bookings
+            BEGIN
+                UPDATE meta SET value = value + 1 WHERE key = 'bookings_version';
+            END
+        ''',
+        '''
+            CREATE TRIGGER IF NOT EXISTS bookings_version_delete AFTER DELETE ON bookings
+            BEGIN
+                UPDATE meta SET value = value + 1 WHERE key = 'bookings_version';
+            END
+        ''',
+    ]),
+    (5, "Short-lived slot holds", [
+        # One row per held slot; the primary key makes two holds on a slot impossible
+        '''
+            CREATE TABLE IF NOT EXISTS slot_holds (
+                date TEXT NOT NULL,
+                time TEXT NOT NULL,
+                phone TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (date, time)
+            )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_slot_holds_phone ON slot_holds (phone)',
+        'CREATE INDEX IF NOT EXISTS idx_slot_holds_expires ON slot_holds (expires_at)',
+    ]),
+    (6, "Slot availability change counter", [
+        # Bumped by any write that can change which slots are free
+        "INSERT OR IGNORE INTO meta (key, value) VALUES ('slots_version', 0)",
+        '''
+            CREATE TRIGGER IF NOT EXISTS slots_version_booking_insert AFTER INSERT ON bookings
+            BEGIN
+                UPDATE meta SET value = value + 1 WHERE key = 'slots_version';
+            END
+        ''',
+        '''
+            CREATE TRIGGER IF NOT EXISTS slots_version_booking_update AFTER UPDATE OF date, time, status ON bookings
+            BEGIN
+                UPDATE meta SET value = value + 1 WHERE key = 'slots_version';
+            END
+        ''',
+        '''
+            CREATE TRIGGER IF NOT EXISTS slots_version_booking_delete AFTER DELETE ON bookings
+            BEGIN
+                UPDATE meta SET value = value + 1 WHERE key = 'slots_version';
+            END
+        ''',
+        '''
+            CREATE TRIGGER IF NOT EXISTS slots_version_hold_insert AFTER INSERT ON slot_holds
+            BEGIN
+                UPDATE meta SET value = value + 1 WHERE key = 'slots_version';
+            END
+        ''',
+        '''
+            CREATE TRIGGER IF NOT EXISTS slots_version_hold_update AFTER UPDATE ON slot_holds
+            BEGIN
+                UPDATE meta SET value = value + 1 WHERE key = 'slots_version';
+            END
+        ''',
+        '''
+            CREATE TRIGGER IF NOT EXISTS slots_version_hold_delete AFTER DELETE ON slot_holds
+            BEGIN
+                UPDATE meta SET value = value + 1 WHERE key = 'slots_version';
+            END
+        ''',
+    ]),
+    (7, "Appointment durations and holds on any free chair", [
+        'ALTER TABLE bookings ADD COLUMN duration INTEGER',
+        lambda cursor: backfill_booking_durations(cursor),
+        # Several customers may now hold the same start time on different chairs,
+        # so holds are keyed by phone; existing holds covered one hourly slot
+        '''
+            CREATE TABLE slot_holds_new (
+                phone TEXT PRIMARY KEY,
+                date TEXT NOT NULL,
+                time TEXT NOT NULL,
+                duration INTEGER NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        ''',
+        '''
+            INSERT OR REPLACE INTO slot_holds_new (phone, date, time, duration, expires_at)
+            SELECT phone, date, time, 60, expires_at FROM slot_holds
+        ''',
+        'DROP TABLE slot_holds',
+        'ALTER TABLE slot_holds_new RENAME TO slot_holds',
+        'CREATE INDEX IF NOT EXISTS idx_slot_holds_date ON slot_holds (date, expires_at)',
+        'CREATE INDEX IF NOT EXISTS idx_slot_holds_expires ON slot_holds (expires_at)',
+        '''
+            CREATE TRIGGER IF NOT EXISTS slots_version_hold_insert AFTER INSERT ON slot_holds
+            BEGIN
+                UPDATE meta SET value = value + 1 WHERE key = 'slots_version';
+            END
+        ''',
+        '''
+            CREATE TRIGGER IF NOT EXISTS slots_version_hold_update AFTER UPDATE ON slot_holds
+            BEGIN
+                UPDATE meta SET value = value + 1 WHERE key = 'slots_version';
+            END
+        ''',
+        '''
+            CREATE TRIGGER IF NOT EXISTS slots_version_hold_delete AFTER DELETE ON slot_holds
+            BEGIN
+                UPDATE meta SET value = value + 1 WHERE key = 'slots_version';
+            END
+        ''',
+    ]),
+    (8, "Session revisions and idle expiry", [
+        'ALTER TABLE sessions ADD COLUMN rev INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE sessions ADD COLUMN touched_at REAL',
+        "UPDATE sessions SET touched_at = CAST(strftime('%s', updated_at) AS REAL)",
+        'CREATE INDEX IF NOT EXISTS idx_sessions_touched ON sessions (touched_at)',
+    ]),
+    (9, "Received payment screenshots by content hash", [
+        '''
+            CREATE TABLE IF NOT EXISTS screenshots (
+                sha256 TEXT PRIMARY KEY,
+                filename TEXT NOT NULL,
+                phone TEXT NOT NULL,
+                booking_id INTEGER,
+                size INTEGER,
+                created_at REAL NOT NULL
+            )
+        ''',
+    ]),
+    (10, "Archived payment screenshots", [
+        # Where a screenshot went when it was moved into a zip archive
+        '''
+            CREATE TABLE IF NOT EXISTS archived_uploads (
+                filename TEXT PRIMARY KEY,
+                archive TEXT NOT NULL,
+                member TEXT NOT NULL,
+                archived_at REAL NOT NULL
+            )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_archived_uploads_archive ON archived_uploads (archive)',
+        'CREATE INDEX IF NOT EXISTS idx_screenshots_filename ON screenshots (filename)',
+    ]),
+    (11, "Processed webhook message IDs", [
+        '''
+            CREATE TABLE IF NOT EXISTS processed_messages (
+                message_id TEXT PRIMARY KEY,
+                received_at REAL NOT NULL
+            )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_processed_messages_received ON processed_messages (received_at)',
+    ]),
+    (12, "Export jobs claimed from the table by any worker", [
+        'ALTER TABLE export_jobs ADD COLUMN worker_pid INTEGER',
+        'ALTER TABLE export_jobs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0',
+        'CREATE INDEX IF NOT EXISTS idx_export_jobs_status ON export_jobs (status)',
+    ]),
+    (13, "Rate limit buckets shared by all workers", [
+        '''
+            CREATE TABLE IF NOT EXISTS rate_limits (
+                key TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                noticed_at REAL
+            )
+        ''',
+    ]),
+]
+
+# Booking statuses that occupy their time slot
+ACTIVE_STATUSES = ('confirmed', 'pending', 'payment_pending')
+
+# Booking columns whose change can free or take a slot
+SLOT_COLUMNS = {'date', 'time', 'status'}
+
+# Comma-separated service names of a booking, in the order they were chosen
+# GROUP_CONCAT has no ORDER BY here; it concatenates in the order the ordered subquery yields
+SERVICE_NAMES_SQL = '''(
+    SELECT COALESCE(GROUP_CONCAT(name, ', '), '')
+    FROM (
+        SELECT bs.name FROM booking_services bs
+        WHERE bs.booking_id = bookings.id
+        ORDER BY bs.position
+    )
+)'''
+
+def service_rows(booking_id, service_ids):
+    """booking_services rows for a booking, snapshotting the current catalogue"""
+    rows = []
+    for position, service_id in enumerate(service_ids):
+        service = Config.SERVICES.get(service_id, {})
+        rows.append((
+            booking_id,
+            position,
+            service_id,
+            service.get('name', f"Service {service_id}"),
+            service.get('price', 0),
+            service.get('duration', '')
+        ))
+    return rows
+
+def backfill_booking_durations(cursor):
+    """Set the duration of existing bookings from their service snapshots"""
+    bookings = cursor.execute('SELECT id FROM bookings WHERE duration IS NULL').fetchall()
+    for booking in bookings:
+        cursor.execute('SELECT duration FROM booking_services WHERE booking_id = ?', (booking['id'],))
+        duration = sum(parse_duration(s['duration']) for s in cursor.fetchall())
+        cursor.execute('UPDATE bookings SET duration = ? WHERE id = ?',
+                       (duration or Config.DEFAULT_SERVICE_MINUTES, booking['id']))
+
+def backfill_booking_services(cursor):
+    """Copy the JSON services column of existing bookings into booking_services"""
+    bookings = cursor.execute('SELECT id, services FROM bookings').fetchall()
+    for booking in bookings:
+        try:
+            service_ids = json.loads(booking['services'] or '[]')
+        except ValueError:
+            service_ids = []
+        cursor.executemany('''
+            INSERT OR IGNORE INTO booking_services (booking_id, position, service_id, name, price, duration)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', service_rows(booking['id'], service_ids))
+
+class Database:
+    def __init__(self, db_name="salon.db"):
+        self.db_name = db_name
+        self._local = threading.local()
+        # Callables run with the booking ID after a booking is updated or deleted
+        self.booking_listeners = []
+        # Callables run as listener(change, before, after) after a write that can
+        # change free slots; before/after are slots_version around that write
+        self.slot_listeners = []
+        self.init_db()
+        self.sessions = SessionStore(create_backend(self))
     
-    def save_user(self, phone, name=None):
+    def get_connection(self):
+        """Return this thread's connection, opening it on first use.
+        
+        Connections are kept open for the life of the thread so SQLite's
+        page cache and prepared-statement cache are reused across calls.
+        A forked worker never reuses a connection opened by its parent.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        
+        conn = sqlite3.connect(
+            self.db_name,
+            timeout=Config.DB_BUSY_TIMEOUT,
+            cached_statements=Config.DB_STATEMENT_CACHE_SIZE
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute(f'PRAGMA cache_size = -{Config.DB_CACHE_SIZE_KB}')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+    
+    def init_db(self):
+        """Create or upgrade the schema in place to the latest migration"""
         conn = self.get_connection()
+        # WAL lets readers run while another worker writes; the mode is stored in the file
+        conn.execute('PRAGMA journal_mode = WAL')
         cursor = conn.cursor()
-        cursor.execute('''
-            INSERT OR REPLACE INTO users (phone, name)
-            VALUES (?, ?)
-        ''', (phone, name))
-        conn.commit()
-        conn.close()
+        
+        for version, description, steps in MIGRATIONS:
+            if self.schema_version() >= version:
+                continue
+            
+            with conn:
+                # Several workers may start at once; only one applies each migration
+                cursor.execute('BEGIN IMMEDIATE')
+                if self.schema_version() >= version:
+                    continue
+                
+                for step in steps:
+                    if callable(step):
+                        step(cursor)
+                    else:
+                        cursor.execute(step)
+                cursor.execute(f'PRAGMA user_version = {version}')
+            
+            print(f"Database migrated to v{version}: {description}")
+    
+    def schema_version(self):
+        return self.get_connection().execute('PRAGMA user_version').fetchone()[0]
+    
+    def checkpoint(self):
+        """Fold the WAL back into the main database file (e.g. before copying it)"""
+        self.get_connection().execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    
+    def save_user(self, phone, name=None):
+        conn = self.get_connection()
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT OR REPLACE INTO users (phone, name)
+                VALUES (?, ?)
+            ''', (phone, name))
     
     def get_user(self, phone):
         conn = self.get_connection()
         cursor = conn.cursor()
         cursor.execute('SELECT * FROM users WHERE phone = ?', (phone,))
         user = cursor.fetchone()
-        conn.close()
         return dict(user) if user else None
     
-    def save_booking(self, phone, name, services, date, time, total, advance_required=0, status='pending'):
+    def save_booking(self, phone, name, services, date, time, total, advance_required=0, status='pending', check_slot=True, duration=None):
+        """Insert a booking and release the customer's hold.
+        
+        The duration defaults to the services' total. Returns None without
+        saving if check_slot is set and no chair is free for that long.
+        """
+        duration = duration or services_duration(services)
         conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO bookings (phone, name, services, date, time, total, advance_required, status)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (phone, name, json.dumps(services), date, time, total, advance_required, status))
-        booking_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        with conn:
+            cursor = conn.cursor()
+            # Check and insert under one write lock so two customers cannot both get the slot
+            cursor.execute('BEGIN IMMEDIATE')
+            if check_slot and not self._slot_is_free(cursor, phone, date, time, duration):
+                return None
+            before = self._slots_version(cursor)
+            
+            cursor.execute('''
+                INSERT INTO bookings (phone, name, services, date, time, duration, total, advance_required, status)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (phone, name, json.dumps(services), date, time, duration, total, advance_required, status))
+            booking_id = cursor.lastrowid
+            
+            cursor.executemany('''
+                INSERT INTO booking_services (booking_id, position, service_id, name, price, duration)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', service_rows(booking_id, services))
+            
+            cursor.execute('DELETE FROM slot_holds WHERE phone = ?', (phone,))
+            after = self._slots_version(cursor)
+        
+        if status in ACTIVE_STATUSES:
+            self._slots_changed({
+                'action': 'book', 'date': date, 'time': time, 'duration': duration, 'phone': phone
+            }, before, after)
+        else:
+            self._slots_changed({'action': 'release', 'phone': phone}, before, after)
         return booking_id
     
-    def get_bookings(self, phone=None, status=None):
+    def get_bookings(self, phone=None, status=None, start_date=None, end_date=None, before=None, limit=None):
+        """Bookings newest first.
+        
+        For keyset pagination pass limit, then pass the (created_at, id) of
+        the last booking returned as `before` to get the next page.
+        """
         conn = self.get_connection()
         cursor = conn.cursor()
-        query = 'SELECT * FROM bookings WHERE 1=1'
-        params = []
+        where, params = self._booking_filters(start_date, end_date, status)
+        query = f'SELECT bookings.*, {SERVICE_NAMES_SQL} AS service_names FROM bookings WHERE {where}'
         
         if phone:
             query += ' AND phone = ?'
             params.append(phone)
-        if status:
-            query += ' AND status = ?'
-            params.append(status)
+        if before:
+            query += ' AND (created_at, id) < (?, ?)'
+            params.extend(before)
+        
+        query += ' ORDER BY created_at DESC, id DESC'
+        if limit:
+            query += ' LIMIT ?'
+            params.append(limit)
         
-        query += ' ORDER BY created_at DESC'
         cursor.execute(query, params)
         bookings = cursor.fetchall()
-        conn.close()
         return [dict(b) for b in bookings]
     
     def update_booking(self, booking_id, **kwargs):
         conn = self.get_connection()
-        cursor = conn.cursor()
+        moves_slot = bool(SLOT_COLUMNS & kwargs.keys())
+        with conn:
+            cursor = conn.cursor()
+            if moves_slot:
+                cursor.execute('BEGIN IMMEDIATE')
+                before = self._slots_version(cursor)
+            
+            set_clause = ', '.join([f"{k} = ?" for k in kwargs.keys()])
+            values = list(kwargs.values()) + [booking_id]
+            
+            cursor.execute(f'''
+                UPDATE bookings 
+                SET {set_clause}
+                WHERE id = ?
+            ''', values)
+            
+            if moves_slot:
+                after = self._slots_version(cursor)
         
-        set_clause = ', '.join([f"{k} = ?" for k in kwargs.keys()])
-        values = list(kwargs.values()) + [booking_id]
-        
-        cursor.execute(f'''
-            UPDATE bookings 
-            SET {set_clause}
-            WHERE id = ?
-        ''', values)
-        conn.commit()
-        conn.close()
+        if moves_slot:
+            self._slots_changed({'action': 'reload'}, before, after)
+        self._booking_changed(booking_id)
     
     def get_booking(self, booking_id):
         conn = self.get_connection()
         cursor = conn.cursor()
-        cursor.execute('SELECT * FROM bookings WHERE id = ?', (booking_id,))
+        cursor.execute(f'''
+            SELECT bookings.*, {SERVICE_NAMES_SQL} AS service_names
+            FROM bookings WHERE id = ?
+        ''', (booking_id,))
         booking = cursor.fetchone()
-        conn.close()
         return dict(booking) if booking else None
     
-    def save_session(self, phone, step, data):
+    def find_pending_booking(self, phone, date, time):
+        """The customer's booking awaiting payment review for this slot, if any"""
         conn = self.get_connection()
         cursor = conn.cursor()
         cursor.execute('''
-            INSERT OR REPLACE INTO sessions (phone, step, data, updated_at)
-            VALUES (?, ?, ?, CURRENT_TIMESTAMP)
-        ''', (phone, step, json.dumps(data)))
-        conn.commit()
-        conn.close()
+            SELECT id FROM bookings
+            WHERE phone = ? AND date = ? AND time = ? AND status = 'payment_pending'
+            ORDER BY id LIMIT 1
+        ''', (phone, date, time))
+        row = cursor.fetchone()
+        return row['id'] if row else None
     
-    def get_session(self, phone):
+    def get_booking_services(self, booking_id):
+        """Services of a booking, with the price and duration charged at booking time"""
         conn = self.get_connection()
         cursor = conn.cursor()
-        cursor.execute('SELECT * FROM sessions WHERE phone = ?', (phone,))
-        session = cursor.fetchone()
-        conn.close()
-        if session:
-            return {
-                'step': session['step'],
-                'data': json.loads(session['data'])
-            }
-        return {'step': 'menu', 'data': {}}
-    
-    def get_booked_slots(self, date):
-        """Get already booked time slots for a date"""
+        cursor.execute('''
+            SELECT service_id, name, price, duration FROM booking_services
+            WHERE booking_id = ?
+            ORDER BY position
+        ''', (booking_id,))
+        return [dict(s) for s in cursor.fetchall()]
+    
+    def get_service_stats(self, start_date=None, end_date=None, status=None, limit=None):
+        """Bookings and revenue per service, most booked first"""
         conn = self.get_connection()
         cursor = conn.cursor()
+        where, params = self._booking_filters(start_date, end_date, status)
+        query = f'''
+            SELECT bs.service_id, MAX(bs.name) AS name, COUNT(*) AS count, SUM(bs.price) AS revenue
+            FROM booking_services bs
+            JOIN bookings ON bookings.id = bs.booking_id
+            WHERE {where}
+            GROUP BY bs.service_id
+            ORDER BY count DESC, bs.service_id
+        '''
+        if limit:
+            query += ' LIMIT ?'
+            params.append(limit)
+        
+        cursor.execute(query, params)
+        return [dict(s) for s in cursor.fetchall()]
+    
+    def iter_bookings(self, start_date=None, end_date=None, status=None, batch_size=500):
+        """Yield filtered bookings newest first, fetching batch_size rows at a time"""
+        cursor = self.get_connection().cursor()
+        where, params = self._booking_filters(start_date, end_date, status)
+        cursor.execute(f'''
+            SELECT bookings.*, {SERVICE_NAMES_SQL} AS service_names
+            FROM bookings
+            WHERE {where}
+            ORDER BY created_at DESC, id DESC
+        ''', params)
+        
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield dict(row)
+    
+    # =================== REPORTS ===================
+    
+    def _booking_filters(self, start_date=None, end_date=None, status=None):
+        """WHERE clause and params for the report filters (all indexed columns)"""
+        clauses = ['1=1']
+        params = []
+        
+        if start_date:
+            clauses.append('bookings.date >= ?')
+            params.append(start_date)
+        if end_date:
+            clauses.append('bookings.date <= ?')
+            params.append(end_date)
+        if status:
+            clauses.append('bookings.status = ?')
+            params.append(status)
+        
+        return ' AND '.join(clauses), params
+    
+    def get_booking_summary(self, start_date=None, end_date=None, status=None):
+        """Counts by status and revenue totals in a single pass"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        where, params = self._booking_filters(start_date, end_date, status)
+        cursor.execute(f'''
+            SELECT
+                COUNT(*) AS total_bookings,
+                COALESCE(SUM(status = 'confirmed'), 0) AS confirmed,
+                COALESCE(SUM(status = 'payment_pending'), 0) AS pending,
+                COALESCE(SUM(status IN ('cancelled', 'rejected')), 0) AS cancelled,
+                COALESCE(SUM(CASE WHEN status = 'confirmed' THEN total END), 0) AS total_revenue,
+                COALESCE(SUM(advance_required), 0) AS total_advance
+            FROM bookings
+            WHERE {where}
+        ''', params)
+        return dict(cursor.fetchone())
+    
+    def get_bookings_per_date(self, start_date=None, end_date=None, status=None):
+        """Number of bookings on each date, as {date: count}"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        where, params = self._booking_filters(start_date, end_date, status)
+        cursor.execute(f'''
+            SELECT date, COUNT(*) AS count FROM bookings
+            WHERE {where}
+            GROUP BY date
+        ''', params)
+        return {row['date']: row['count'] for row in cursor.fetchall()}
+    
+    def save_session(self, phone, step, data, rev=None):
+        return self.sessions.save(phone, step, data, rev)
+    
+    def get_session(self, phone):
+        return self.sessions.get(phone)
+    
+    # =================== SESSION ROWS ===================
+    
+    def get_session_head(self, phone):
+        """Revision and last activity of a session, without its data"""
+        cursor = self.get_connection().cursor()
+        cursor.execute('SELECT rev, touched_at FROM sessions WHERE phone = ?', (phone,))
+        row = cursor.fetchone()
+        return dict(row) if row and row['touched_at'] is not None else None
+    
+    def load_session(self, phone):
+        cursor = self.get_connection().cursor()
+        cursor.execute('SELECT rev, step, data, touched_at FROM sessions WHERE phone = ?', (phone,))
+        row = cursor.fetchone()
+        return dict(row) if row and row['touched_at'] is not None else None
+    
+    def store_session(self, phone, step, data_json, touched_at, rev=None):
+        """Write a session and return its new revision.
+        
+        With `rev`, only write if the session is still at that revision (0 for
+        no session); returns None if it is not.
+        """
+        conn = self.get_connection()
+        with conn:
+            cursor = conn.cursor()
+            if rev:
+                cursor.execute('''
+                    UPDATE sessions SET step = ?, data = ?, rev = rev + 1,
+                        touched_at = ?, updated_at = CURRENT_TIMESTAMP
+                    WHERE phone = ? AND rev = ?
+                    RETURNING rev
+                ''', (step, data_json, touched_at, phone, rev))
+            else:
+                cursor.execute(f'''
+                    INSERT INTO sessions (phone, step, data, rev, touched_at, updated_at)
+                    VALUES (?, ?, ?, 1, ?, CURRENT_TIMESTAMP)
+                    ON CONFLICT (phone) DO UPDATE SET
+                        step = excluded.step, data = excluded.data, rev = rev + 1,
+                        touched_at = excluded.touched_at, updated_at = CURRENT_TIMESTAMP
+                    {'' if rev is None else 'WHERE sessions.rev = 0 OR sessions.touched_at IS NULL'}
+                    RETURNING rev
+                ''', (phone, step, data_json, touched_at))
+            row = cursor.fetchone()
+        return row['rev'] if row else None
+    
+    def touch_session(self, phone, touched_at):
+        conn = self.get_connection()
+        with conn:
+            conn.execute('UPDATE sessions SET touched_at = ? WHERE phone = ?', (touched_at, phone))
+    
+    def delete_session(self, phone, rev=None):
+        """Delete a session; with `rev`, only if it is still at that revision. False if it was not."""
+        conn = self.get_connection()
+        with conn:
+            if rev is None:
+                conn.execute('DELETE FROM sessions WHERE phone = ?', (phone,))
+                return True
+            cursor = conn.execute('DELETE FROM sessions WHERE phone = ? AND rev = ?', (phone, rev))
+        return cursor.rowcount == 1 or self.get_session_head(phone) is None
+    
+    def delete_idle_sessions(self, idle_before):
+        """Delete sessions not touched since idle_before; returns how many"""
+        conn = self.get_connection()
+        with conn:
+            cursor = conn.execute('DELETE FROM sessions WHERE touched_at < ? OR touched_at IS NULL', (idle_before,))
+        return cursor.rowcount
+    
+    def get_day_schedule(self, date, phone=None):
+        """DaySchedule of a date's active bookings and of live holds by anyone but `phone`"""
+        return self._day_schedule(self.get_connection().cursor(), date, phone)
+    
+    def _day_schedule(self, cursor, date, phone):
         cursor.execute('''
-            SELECT time FROM bookings 
+            SELECT time, duration FROM bookings
             WHERE date = ? AND status IN ('confirmed', 'pending', 'payment_pending')
-        ''', (date,))
-        slots = cursor.fetchall()
-        conn.close()
-        return [s['time'] for s in slots]
+            UNION ALL
+            SELECT time, duration FROM slot_holds
+            WHERE date = ? AND phone IS NOT ? AND expires_at > ?
+        ''', (date, date, phone, time.time()))
+        
+        schedule = DaySchedule()
+        for row in cursor.fetchall():
+            schedule.add(row['time'], row['duration'] or Config.DEFAULT_SERVICE_MINUTES)
+        return schedule
+    
+    # =================== SLOT HOLDS ===================
+    
+    def _slot_is_free(self, cursor, phone, date, slot_time, duration):
+        """True if a chair is free for the appointment, ignoring this phone's own hold"""
+        return self._day_schedule(cursor, date, phone).fits(slot_time, duration)
+    
+    def hold_slot(self, phone, date, slot_time, ttl, duration):
+        """Reserve a chair from slot_time for `duration` minutes for ttl seconds; False if none is free.
+        
+        A phone holds at most one slot, so taking a new hold drops the old one.
+        """
+        now = time.time()
+        conn = self.get_connection()
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            before = self._slots_version(cursor)
+            cursor.execute('DELETE FROM slot_holds WHERE expires_at <= ?', (now,))
+            
+            if not self._slot_is_free(cursor, phone, date, slot_time, duration):
+                return False
+            
+            cursor.execute('''
+                INSERT OR REPLACE INTO slot_holds (phone, date, time, duration, expires_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (phone, date, slot_time, duration, now + ttl))
+            after = self._slots_version(cursor)
+        
+        self._slots_changed({
+            'action': 'hold', 'date': date, 'time': slot_time, 'duration': duration,
+            'phone': phone, 'expires_at': now + ttl
+        }, before, after)
+        return True
+    
+    def release_hold(self, phone):
+        """Drop any slot hold of this phone"""
+        conn = self.get_connection()
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            before = self._slots_version(cursor)
+            cursor.execute('DELETE FROM slot_holds WHERE phone = ?', (phone,))
+            after = self._slots_version(cursor)
+        
+        self._slots_changed({'action': 'release', 'phone': phone}, before, after)
+    
+    def get_slots_version(self):
+        """Counter that changes whenever a booking or hold that affects free slots changes"""
+        return self._slots_version(self.get_connection().cursor())
+    
+    def _slots_version(self, cursor):
+        cursor.execute("SELECT value FROM meta WHERE key = 'slots_version'")
+        return cursor.fetchone()['value']
+    
+    def _slots_changed(self, change, before, after):
+        if before == after:
+            return
+        for listener in self.slot_listeners:
+            try:
+                listener(change, before, after)
+            except Exception as e:
+                print(f"Slot listener error: {e}")
+    
+    def get_slot_state(self, start_date, end_date):
+        """Active bookings, live holds and slots_version for a date range, from one snapshot"""
+        conn = self.get_connection()
+        with conn:
+            cursor = conn.cursor()
+            # A read transaction so all three queries see the same database state
+            cursor.execute('BEGIN')
+            version = self._slots_version(cursor)
+            cursor.execute('''
+                SELECT date, time, duration FROM bookings
+                WHERE date BETWEEN ? AND ? AND status IN ('confirmed', 'pending', 'payment_pending')
+            ''', (start_date, end_date))
+            bookings = [dict(b) for b in cursor.fetchall()]
+            cursor.execute('''
+                SELECT date, time, duration, phone, expires_at FROM slot_holds
+                WHERE date BETWEEN ? AND ? AND expires_at > ?
+            ''', (start_date, end_date, time.time()))
+            holds = [dict(h) for h in cursor.fetchall()]
+        return bookings, holds, version
     
     def delete_booking(self, booking_id):
         """Delete a booking"""
         conn = self.get_connection()
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            before = self._slots_version(cursor)
+            cursor.execute('DELETE FROM booking_services WHERE booking_id = ?', (booking_id,))
+            cursor.execute('DELETE FROM bookings WHERE id = ?', (booking_id,))
+            after = self._slots_version(cursor)
+        
+        self._slots_changed({'action': 'reload'}, before, after)
+        self._booking_changed(booking_id)
+    
+    def _booking_changed(self, booking_id):
+        for listener in self.booking_listeners:
+            try:
+                listener(booking_id)
+            except Exception as e:
+                print(f"Booking listener error: {e}")
+    
+    def enqueue_outbound(self, phone, kind, payload, delay=0):
+        """Add a job to the outbound send queue, due after `delay` seconds"""
+        conn = self.get_connection()
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO outbound_jobs (phone, kind, payload, next_attempt_at)
+                VALUES (?, ?, ?, ?)
+            ''', (phone, kind, json.dumps(payload), time.time() + delay))
+            job_id = cursor.lastrowid
+        return job_id
+    
+    def has_pending_outbound(self, phone, kind):
+        """True if a job of this kind for the phone is still queued or in flight"""
+        cursor = self.get_connection().cursor()
+        cursor.execute('''
+            SELECT 1 FROM outbound_jobs
+            WHERE phone = ? AND status IN ('queued', 'sending') AND kind = ?
+            LIMIT 1
+        ''', (phone, kind))
+        return cursor.fetchone() is not None
+    
+    def claim_outbound_job(self, lease_seconds):
+        """Claim the next due job whose phone has nothing older still queued or in flight"""
+        now = time.time()
+        conn = self.get_connection()
         cursor = conn.cursor()
-        cursor.execute('DELETE FROM bookings WHERE id = ?', (booking_id,))
-        conn.commit()
-        conn.close()
+        with conn:
+            # Take the write lock up front so two dispatchers never claim the same job
+            cursor.execute('BEGIN IMMEDIATE')
+            
+            # Jobs whose dispatcher died mid-send go back to the queue
+            cursor.execute('''
+                UPDATE outbound_jobs SET status = 'queued'
+                WHERE status = 'sending' AND locked_at < ?
+            ''', (now - lease_seconds,))
+            
+            cursor.execute('''
+                SELECT * FROM outbound_jobs j
+                WHERE j.status = 'queued' AND j.next_attempt_at <= ?
+                AND NOT EXISTS (
+                    SELECT 1 FROM outbound_jobs o
+                    WHERE o.phone = j.phone AND o.id < j.id
+                    AND o.status IN ('queued', 'sending')
+                )
+                ORDER BY j.id
+                LIMIT 1
+            ''', (now,))
+            job = cursor.fetchone()
+            
+            if job:
+                cursor.execute('''
+                    UPDATE outbound_jobs SET status = 'sending', locked_at = ?
+                    WHERE id = ?
+                ''', (now, job['id']))
+        
+        if not job:
+            return None
+        job = dict(job)
+        job['payload'] = json.loads(job['payload'])
+        return job
+    
+    def complete_outbound_job(self, job_id):
+        """Remove a job that was sent successfully"""
+        conn = self.get_connection()
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM outbound_jobs WHERE id = ?', (job_id,))
+    
+    def fail_outbound_job(self, job_id, error, retry_at=None):
+        """Schedule a retry for a failed job, or mark it failed when retry_at is None"""
+        conn = self.get_connection()
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE outbound_jobs
+                SET status = ?, attempts = attempts + 1, next_attempt_at = ?,
+                    locked_at = NULL, last_error = ?
+                WHERE id = ?
+            ''', ('queued' if retry_at else 'failed', retry_at, error, job_id))
+    
+    def get_cached_media(self, file_hash, max_age):
+        """Get a media ID uploaded for this file less than max_age seconds ago"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT media_id FROM media_cache
+            WHERE file_hash = ? AND uploaded_at > ?
+        ''', (file_hash, time.time() - max_age))
+        row = cursor.fetchone()
+        return row['media_id'] if row else None
+    
+    def save_cached_media(self, file_hash, media_id):
+        conn = self.get_connection()
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT OR REPLACE INTO media_cache (file_hash, media_id, uploaded_at)
+                VALUES (?, ?, ?)
+            ''', (file_hash, media_id, time.time()))
+    
+    def delete_cached_media(self, file_hash):
+        conn = self.get_connection()
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM media_cache WHERE file_hash = ?', (file_hash,))
+    
+    # =================== SCREENSHOTS ===================
+    
+    def get_screenshot(self, sha256):
+        cursor = self.get_connection().cursor()
+        cursor.execute('SELECT * FROM screenshots WHERE sha256 = ?', (sha256,))
+        row = cursor.fetchone()
+        return dict(row) if row else None
+    
+    def save_screenshot(self, sha256, filename, phone, size):
+        """Record a received screenshot; False if one with this content already exists"""
+        conn = self.get_connection()
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT OR IGNORE INTO screenshots (sha256, filename, phone, size, created_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (sha256, filename, phone, size, time.time()))
+            return cursor.rowcount == 1
+    
+    def link_screenshot(self, sha256, booking_id):
+        conn = self.get_connection()
+        with conn:
+            conn.execute('UPDATE screenshots SET booking_id = ? WHERE sha256 = ?', (booking_id, sha256))
+    
+    # =================== PROCESSED MESSAGES ===================
+    
+    def claim_message(self, message_id, received_at):
+        """Record an inbound message ID; False if it was already recorded"""
+        conn = self.get_connection()
+        with conn:
+            cursor = conn.execute('''
+                INSERT OR IGNORE INTO processed_messages (message_id, received_at) VALUES (?, ?)
+            ''', (message_id, received_at))
+            return cursor.rowcount == 1
+    
+    def delete_processed_messages(self, received_before):
+        conn = self.get_connection()
+        with conn:
+            cursor = conn.execute('DELETE FROM processed_messages WHERE received_at < ?', (received_before,))
+        return cursor.rowcount
+    
+    def release_message(self, message_id):
+        """Forget a claimed message ID, so a redelivery is processed"""
+        conn = self.get_connection()
+        with conn:
+            conn.execute('DELETE FROM processed_messages WHERE message_id = ?', (message_id,))
+    
+    # =================== RATE LIMITS ===================
+    
+    def take_tokens(self, key, rate, burst, count):
+        """Refill a token bucket and take `count` from it in one statement; returns what is left.
+        
+        The result may be negative: the bucket is in debt until refilled.
+        """
+        conn = self.get_connection()
+        with conn:
+            cursor = conn.execute('''
+                INSERT INTO rate_limits (key, tokens, updated_at) VALUES (:key, :burst - :count, :now)
+                ON CONFLICT (key) DO UPDATE SET
+                    tokens = MIN(:burst, tokens + MAX(:now - updated_at, 0) * :rate) - :count,
+                    updated_at = MAX(updated_at, :now)
+                RETURNING tokens
+            ''', {'key': key, 'rate': rate, 'burst': burst, 'count': count, 'now': time.time()})
+            return cursor.fetchone()['tokens']
+    
+    def mark_rate_notice(self, key, every):
+        """Record a notice for a bucket; False if one was recorded less than `every` seconds ago"""
+        now = time.time()
+        conn = self.get_connection()
+        with conn:
+            cursor = conn.execute('''
+                UPDATE rate_limits SET noticed_at = ?
+                WHERE key = ? AND (noticed_at IS NULL OR noticed_at < ?)
+            ''', (now, key, now - every))
+        return cursor.rowcount == 1
+    
+    def delete_idle_rate_limits(self, idle_before):
+        conn = self.get_connection()
+        with conn:
+            cursor = conn.execute('DELETE FROM rate_limits WHERE updated_at < ?', (idle_before,))
+        return cursor.rowcount
+    
+    # =================== UPLOAD LIFECYCLE ===================
+    
+    def get_screenshot_usage(self):
+        """Per screenshot file: latest booking date and how many bookings using it are still live"""
+        cursor = self.get_connection().cursor()
+        cursor.execute('''
+            SELECT payment_screenshot AS filename,
+                   MAX(date) AS last_date,
+                   SUM(status NOT IN ('rejected', 'cancelled')) AS live
+            FROM bookings
+            WHERE payment_screenshot IS NOT NULL AND payment_screenshot != ''
+            GROUP BY payment_screenshot
+        ''')
+        return [dict(row) for row in cursor.fetchall()]
+    
+    def rename_payment_screenshot(self, old_name, new_name):
+        conn = self.get_connection()
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('UPDATE bookings SET payment_screenshot = ? WHERE payment_screenshot = ?', (new_name, old_name))
+            cursor.execute('UPDATE screenshots SET filename = ? WHERE filename = ?', (new_name, old_name))
+    
+    def forget_payment_screenshot(self, filename):
+        """Drop every reference to a deleted screenshot"""
+        conn = self.get_connection()
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('UPDATE bookings SET payment_screenshot = NULL WHERE payment_screenshot = ?', (filename,))
+            cursor.execute('DELETE FROM screenshots WHERE filename = ?', (filename,))
+            cursor.execute('DELETE FROM archived_uploads WHERE filename = ?', (filename,))
+    
+    def save_archived_upload(self, filename, archive, member):
+        conn = self.get_connection()
+        with conn:
+            conn.execute('''
+                INSERT OR REPLACE INTO archived_uploads (filename, archive, member, archived_at)
+                VALUES (?, ?, ?, ?)
+            ''', (filename, archive, member, time.time()))
+    
+    def get_archived_upload(self, filename):
+        cursor = self.get_connection().cursor()
+        cursor.execute('SELECT * FROM archived_uploads WHERE filename = ?', (filename,))
+        row = cursor.fetchone()
+        return dict(row) if row else None
+    
+    def get_upload_archives(self):
+        cursor = self.get_connection().cursor()
+        cursor.execute('SELECT DISTINCT archive FROM archived_uploads ORDER BY archive')
+        return [row['archive'] for row in cursor.fetchall()]
+    
+    def pop_archived_uploads(self, archive):
+        """Remove and return the filenames stored in an archive"""
+        conn = self.get_connection()
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT filename FROM archived_uploads WHERE archive = ?', (archive,))
+            filenames = [row['filename'] for row in cursor.fetchall()]
+            cursor.execute('DELETE FROM archived_uploads WHERE archive = ?', (archive,))
+        return filenames
+    
+    # =================== EXPORT JOBS ===================
+    
+    def get_bookings_version(self):
+        """Counter that changes whenever any booking is inserted, updated or deleted"""
+        cursor = self.get_connection().cursor()
+        cursor.execute("SELECT value FROM meta WHERE key = 'bookings_version'")
+        return cursor.fetchone()['value']
+    
+    def create_export_job(self, kind, params, cache_key, filename):
+        conn = self.get_connection()
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO export_jobs (kind, params, cache_key, filename, created_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (kind, json.dumps(params), cache_key, filename, time.time()))
+            job_id = cursor.lastrowid
+        return job_id
+    
+    def get_export_job(self, job_id):
+        cursor = self.get_connection().cursor()
+        cursor.execute('SELECT * FROM export_jobs WHERE id = ?', (job_id,))
+        job = cursor.fetchone()
+        return dict(job) if job else None
+    
+    def find_export_job(self, cache_key, stale_after):
+        """Latest finished, or still live, job for this cache key"""
+        cursor = self.get_connection().cursor()
+        cursor.execute('''
+            SELECT * FROM export_jobs
+            WHERE cache_key = ?
+            AND (status = 'done' OR (status IN ('queued', 'running') AND created_at > ?))
+            ORDER BY id DESC
+            LIMIT 1
+        ''', (cache_key, time.time() - stale_after))
+        job = cursor.fetchone()
+        return dict(job) if job else None
+    
+    def claim_export_job(self, worker_pid):
+        """Mark the oldest queued job as running in worker_pid and return it; None if none is queued"""
+        conn = self.get_connection()
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE export_jobs SET status = 'running', worker_pid = ?, attempts = attempts + 1
+                WHERE id = (SELECT id FROM export_jobs WHERE status = 'queued' ORDER BY id LIMIT 1)
+                RETURNING *
+            ''', (worker_pid,))
+            job = cursor.fetchone()
+        return dict(job) if job else None
+    
+    def get_running_export_jobs(self):
+        cursor = self.get_connection().cursor()
+        cursor.execute("SELECT * FROM export_jobs WHERE status = 'running'")
+        return [dict(j) for j in cursor.fetchall()]
+    
+    def count_queued_export_jobs(self):
+        cursor = self.get_connection().cursor()
+        cursor.execute("SELECT COUNT(*) FROM export_jobs WHERE status = 'queued'")
+        return cursor.fetchone()[0]
+    
+    def update_export_job(self, job_id, **kwargs):
+        conn = self.get_connection()
+        with conn:
+            set_clause = ', '.join([f"{k} = ?" for k in kwargs.keys()])
+            conn.execute(f'UPDATE export_jobs SET {set_clause} WHERE id = ?', list(kwargs.values()) + [job_id])
+    
+    def pop_expired_export_jobs(self, max_age):
+        """Delete jobs created more than max_age seconds ago and return them"""
+        conn = self.get_connection()
+        with conn:
+            cursor = conn.cursor()
+            cutoff = time.time() - max_age
+            cursor.execute('SELECT * FROM export_jobs WHERE created_at < ?', (cutoff,))
+            jobs = [dict(j) for j in cursor.fetchall()]
+            cursor.execute('DELETE FROM export_jobs WHERE created_at < ?', (cutoff,))
+        return jobs
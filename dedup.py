@@ -0,0 +1,52 @@
+import threading
+import time
+from collections import OrderedDict
+from config import Config
+
+class ProcessedMessages:
+    """IDs of inbound messages already handled, so webhook retries are skipped.
+
+    Meta redelivers a webhook when we answer slowly or with an error, with
+    the same message IDs. Each ID is claimed in the database (so every
+    worker and restart sees it) and remembered in a bounded in-memory
+    window that answers most repeats without a query. IDs older than the
+    window are pruned from both.
+    """
+
+    def __init__(self, db, window=None, cache_size=None):
+        self.db = db
+        self.window = window or Config.MESSAGE_DEDUP_WINDOW_SECONDS
+        self.cache_size = cache_size or Config.MESSAGE_DEDUP_CACHE_SIZE
+        self._seen = OrderedDict()  # message ID -> time first seen, oldest first
+        self._lock = threading.Lock()
+        self._pruned_at = 0
+
+    def claim(self, message_id):
+        """True if this message is new and should be processed; False for a repeat"""
+        now = time.time()
+        with self._lock:
+            if message_id in self._seen:
+                return False
+
+        claimed = self.db.claim_message(message_id, now)
+        with self._lock:
+            self._seen[message_id] = now
+            self._forget(now)
+        if now - self._pruned_at > Config.MESSAGE_DEDUP_PRUNE_SECONDS:
+            self._pruned_at = now
+            self.prune(now)
+        return claimed
+
+    def release(self, message_id):
+        """Un-claim a message that will not be processed after all"""
+        with self._lock:
+            self._seen.pop(message_id, None)
+        self.db.release_message(message_id)
+
+    def prune(self, now=None):
+        """Delete stored IDs older than the window; returns how many"""
+        return self.db.delete_processed_messages((now or time.time()) - self.window)
+
+    def _forget(self, now):
+        while self._seen and (len(self._seen) > self.cache_size or next(iter(self._seen.values())) < now - self.window):
+            self._seen.popitem(last=False)
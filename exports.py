@@ -0,0 +1,304 @@
+import os
+from datetime import datetime
+from config import Config
+
+EXCEL_HEADERS = ['Booking ID', 'Date', 'Time', 'Customer Name', 'Phone', 'Services',
+                 'Total Amount', 'Advance', 'Status', 'Payment Screenshot', 'Created At', 'Admin Notes']
+
+def write_bookings_excel(db, path, start_date=None, end_date=None, status=None):
+    """Write filtered bookings to an .xlsx file without holding them all in memory"""
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font, Alignment, PatternFill
+    from openpyxl.utils import get_column_letter
+    
+    # Write-only mode streams rows to a temp file instead of building a cell tree
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Salon Bookings")
+    
+    # Column widths must be set before the first row is written
+    for col in range(1, len(EXCEL_HEADERS) + 1):
+        ws.column_dimensions[get_column_letter(col)].width = 18
+    
+    # Style headers
+    header_fill = PatternFill(start_color="667eea", end_color="667eea", fill_type="solid")
+    header_font = Font(bold=True, color="FFFFFF")
+    header_row = []
+    for header in EXCEL_HEADERS:
+        cell = WriteOnlyCell(ws, value=header)
+        cell.fill = header_fill
+        cell.font = header_font
+        cell.alignment = Alignment(horizontal='center', vertical='center')
+        header_row.append(cell)
+    ws.append(header_row)
+    
+    try:
+        # Data rows, read from the database in batches
+        for booking in db.iter_bookings(start_date, end_date, status):
+            ws.append([
+                booking['id'],
+                booking['date'],
+                booking['time'],
+                booking['name'],
+                booking['phone'],
+                booking['service_names'],
+                booking['total'],
+                booking['advance_required'] if booking['advance_required'] else 0,
+                booking['status'],
+                booking['payment_screenshot'] if booking['payment_screenshot'] else 'N/A',
+                booking['created_at'],
+                booking['admin_notes'] if booking['admin_notes'] else ''
+            ])
+        
+        wb.save(path)
+    except Exception:
+        # The sheet's rows are buffered in a temp file that only save() removes
+        if not ws.closed:
+            ws.close()
+        if os.path.exists(ws._writer.out):
+            os.unlink(ws._writer.out)
+        if os.path.exists(path):
+            os.unlink(path)
+        raise
+    return path
+
+def export_filename(extension):
+    return f"salon_bookings_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{extension}"
+
+PDF_COLUMNS = ['ID', 'Date', 'Time', 'Customer', 'Phone', 'Services', 'Amount', 'Status']
+PDF_COLUMN_WIDTHS = [40, 70, 60, 130, 50, 250, 70, 100]
+PDF_ROW_HEIGHT = 16
+
+def _truncate(text, length):
+    text = text or ''
+    return text[:length] + '...' if len(text) > length else text
+
+def write_bookings_pdf(db, path, start_date=None, end_date=None, status=None):
+    """Write a PDF report of all filtered bookings, one page at a time.
+    
+    Rows are read from the database in batches and drawn straight onto
+    the canvas as a fixed-height table per page, so memory use does not
+    grow with the number of bookings and reportlab never has to split a
+    huge table.
+    """
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import A4, landscape
+    from reportlab.pdfgen import canvas
+    from reportlab.platypus import Table, TableStyle, Paragraph
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    from reportlab.lib.units import inch
+    
+    page_width, page_height = landscape(A4)
+    margin = 0.5 * inch
+    bottom = margin + 0.3 * inch  # room for the footer
+    generated_on = f"Generated on {datetime.now().strftime('%d %B %Y, %I:%M %p')}"
+    
+    pdf = canvas.Canvas(path, pagesize=landscape(A4))
+    pdf.setTitle(f"{Config.SALON_NAME} Booking Report")
+    
+    # Styles
+    styles = getSampleStyleSheet()
+    title_style = ParagraphStyle(
+        'CustomTitle',
+        parent=styles['Heading1'],
+        fontSize=24,
+        textColor=colors.HexColor('#667eea'),
+        alignment=1  # Center
+    )
+    table_style = TableStyle([
+        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#667eea')),
+        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ('FONTSIZE', (0, 0), (-1, 0), 10),
+        ('BACKGROUND', (0, 1), (-1, -1), colors.white),
+        ('GRID', (0, 0), (-1, -1), 1, colors.grey),
+        ('FONTSIZE', (0, 1), (-1, -1), 8),
+    ])
+    
+    def draw(flowable, y):
+        width, height = flowable.wrapOn(pdf, page_width - 2 * margin, y - bottom)
+        flowable.drawOn(pdf, (page_width - width) / 2, y - height)
+        return y - height
+    
+    def finish_page():
+        pdf.setFont('Helvetica', 9)
+        pdf.drawString(margin, margin, generated_on)
+        pdf.drawRightString(page_width - margin, margin, f"Page {pdf.getPageNumber()}")
+        pdf.showPage()
+    
+    # Title
+    y = page_height - margin
+    y = draw(Paragraph(f"<b>{Config.SALON_NAME}</b><br/>Booking Report", title_style), y) - 0.2 * inch
+    
+    # Stats summary, from one aggregate query
+    summary = db.get_booking_summary(start_date, end_date, status)
+    stats_table = Table([
+        ['Total Bookings', 'Confirmed', 'Pending Payment', 'Cancelled'],
+        [str(summary['total_bookings']), str(summary['confirmed']),
+         str(summary['pending']), str(summary['cancelled'])]
+    ])
+    stats_table.setStyle(TableStyle([
+        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#667eea')),
+        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ('FONTSIZE', (0, 0), (-1, 0), 12),
+        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+        ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
+        ('GRID', (0, 0), (-1, -1), 1, colors.black)
+    ]))
+    y = draw(stats_table, y) - 0.3 * inch
+    
+    # Bookings table, one page-sized chunk at a time
+    rows = []
+    
+    def flush(y):
+        table = Table([PDF_COLUMNS] + rows, colWidths=PDF_COLUMN_WIDTHS, rowHeights=PDF_ROW_HEIGHT)
+        table.setStyle(table_style)
+        draw(table, y)
+        rows.clear()
+        finish_page()
+        return page_height - margin
+    
+    for booking in db.iter_bookings(start_date, end_date, status):
+        rows.append([
+            str(booking['id']),
+            booking['date'],
+            booking['time'],
+            _truncate(booking['name'], 25),
+            (booking['phone'] or '')[-4:],  # Last 4 digits
+            _truncate(booking['service_names'], 50),
+            f"₹{booking['total']}",
+            booking['status']
+        ])
+        # One row is taken by the header
+        if len(rows) >= int((y - bottom) / PDF_ROW_HEIGHT) - 1:
+            y = flush(y)
+    
+    if rows or summary['total_bookings'] == 0:
+        flush(y)
+    
+    pdf.save()
+    return path
+
+def write_invoice_pdf(db, path, booking_id):
+    """Write the printable invoice for a booking; returns None if it does not exist"""
+    from reportlab.lib.pagesizes import A4
+    from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    from reportlab.lib.units import inch
+    from reportlab.lib import colors
+    
+    booking = db.get_booking(booking_id)
+    if not booking:
+        return None
+    
+    doc = SimpleDocTemplate(path, pagesize=A4, rightMargin=72, leftMargin=72, topMargin=72, bottomMargin=18)
+    elements = []
+    
+    styles = getSampleStyleSheet()
+    
+    # Header style
+    header_style = ParagraphStyle(
+        'CustomHeader',
+        parent=styles['Heading1'],
+        fontSize=26,
+        textColor=colors.HexColor('#667eea'),
+        spaceAfter=12,
+        alignment=1
+    )
+    
+    # Salon name
+    header = Paragraph(f"<b>{Config.SALON_NAME}</b>", header_style)
+    elements.append(header)
+    
+    # Salon details
+    salon_info = Paragraph(
+        f"{Config.SALON_ADDRESS}<br/>{Config.SALON_PHONE}",
+        styles['Normal']
+    )
+    elements.append(salon_info)
+    elements.append(Spacer(1, 0.3*inch))
+    
+    # Invoice title
+    invoice_title = Paragraph(
+        f"<b>BOOKING INVOICE</b><br/>Booking ID: #{booking_id}",
+        ParagraphStyle('InvoiceTitle', parent=styles['Heading2'], alignment=1, fontSize=18, spaceAfter=20)
+    )
+    elements.append(invoice_title)
+    elements.append(Spacer(1, 0.2*inch))
+    
+    # Customer details
+    customer_data = [
+        ['Customer Name:', booking['name']],
+        ['Phone:', booking['phone']],
+        ['Date:', booking['date']],
+        ['Time:', booking['time']],
+        ['Booking Status:', booking['status'].replace('_', ' ').title()]
+    ]
+    
+    customer_table = Table(customer_data, colWidths=[2*inch, 4*inch])
+    customer_table.setStyle(TableStyle([
+        ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
+        ('FONTSIZE', (0, 0), (-1, -1), 11),
+        ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
+    ]))
+    elements.append(customer_table)
+    elements.append(Spacer(1, 0.3*inch))
+    
+    # Services table
+    service_data = [['Service', 'Duration', 'Price']]
+    
+    for service in db.get_booking_services(booking_id):
+        service_data.append([
+            service['name'],
+            service['duration'],
+            f"₹{service['price']}"
+        ])
+    
+    # Add total row
+    service_data.append(['', 'TOTAL:', f"₹{booking['total']}"])
+    
+    service_table = Table(service_data, colWidths=[3*inch, 1.5*inch, 1.5*inch])
+    service_table.setStyle(TableStyle([
+        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#667eea')),
+        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+        ('ALIGN', (2, 0), (2, -1), 'RIGHT'),
+        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ('FONTSIZE', (0, 0), (-1, 0), 12),
+        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+        ('BACKGROUND', (0, 1), (-1, -2), colors.white),
+        ('GRID', (0, 0), (-1, -2), 1, colors.grey),
+        ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
+        ('FONTSIZE', (0, -1), (-1, -1), 14),
+        ('BACKGROUND', (0, -1), (-1, -1), colors.lightgrey),
+        ('LINEABOVE', (0, -1), (-1, -1), 2, colors.black),
+    ]))
+    elements.append(service_table)
+    elements.append(Spacer(1, 0.3*inch))
+    
+    # Payment info
+    if booking['advance_required'] > 0:
+        payment_info = Paragraph(
+            f"<b>Advance Paid:</b> ₹{booking['advance_required']}<br/>"
+            f"<b>Balance Due:</b> ₹{booking['total'] - booking['advance_required']}",
+            styles['Normal']
+        )
+        elements.append(payment_info)
+        elements.append(Spacer(1, 0.2*inch))
+    
+    # Footer
+    footer = Paragraph(
+        f"<i>Thank you for choosing {Config.SALON_NAME}!<br/>"
+        f"We look forward to serving you.<br/>"
+        f"Generated on {datetime.now().strftime('%d %B %Y, %I:%M %p')}</i>",
+        ParagraphStyle('Footer', parent=styles['Normal'], alignment=1, fontSize=9)
+    )
+    elements.append(Spacer(1, 0.5*inch))
+    elements.append(footer)
+    
+    doc.build(elements)
+    return path
@@ -0,0 +1,96 @@
+import glob
+import hashlib
+import json
+import os
+from config import Config
+import exports
+
+def salon_config_version():
+    """Fingerprint of the salon settings that are printed on invoices"""
+    settings = [Config.SALON_NAME, Config.SALON_ADDRESS, Config.SALON_PHONE]
+    return hashlib.sha256(json.dumps(settings).encode()).hexdigest()[:16]
+
+class InvoiceCache:
+    """Rendered invoice PDFs on disk, addressed by booking content.
+
+    Files are named <booking_id>_<key>.pdf where the key hashes the booking
+    row, its services and the salon settings, so a changed booking can never
+    be served a stale invoice. The folder is kept under max_bytes by evicting
+    the least recently used files (a hit refreshes the file's mtime).
+    """
+
+    def __init__(self, db, folder=None, max_bytes=None):
+        self.db = db
+        self.folder = os.path.abspath(folder or Config.INVOICE_CACHE_FOLDER)
+        self.max_bytes = max_bytes or Config.INVOICE_CACHE_MAX_BYTES
+        os.makedirs(self.folder, exist_ok=True)
+
+    def path_for(self, booking_id):
+        """Cache path for the booking as it is now, or None if it does not exist"""
+        booking = self.db.get_booking(booking_id)
+        if not booking:
+            return None
+
+        content = json.dumps({
+            'booking': booking,
+            'services': self.db.get_booking_services(booking_id),
+            'config': salon_config_version()
+        }, sort_keys=True, default=str)
+        key = hashlib.sha256(content.encode()).hexdigest()
+        return os.path.join(self.folder, f"{booking_id}_{key}.pdf")
+
+    def get(self, booking_id):
+        """Path of a cached invoice, or None on a miss"""
+        path = self.path_for(booking_id)
+        if not path or not os.path.exists(path):
+            return None
+        os.utime(path)  # mark as recently used
+        return path
+
+    def render(self, booking_id):
+        """Render the invoice into the cache and return its path"""
+        path = self.path_for(booking_id)
+        if not path:
+            return None
+
+        # Write under a temporary name so readers never see a partial file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        exports.write_invoice_pdf(self.db, tmp_path, booking_id)
+        os.replace(tmp_path, path)
+
+        self.invalidate(booking_id, keep=path)
+        self.evict()
+        return path
+
+    def invalidate(self, booking_id, keep=None):
+        """Remove cached invoices of a booking (except `keep`)"""
+        for path in glob.glob(os.path.join(self.folder, f"{booking_id}_*.pdf")):
+            if path != keep:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def evict(self):
+        """Delete least recently used invoices until the cache fits in max_bytes"""
+        files = []
+        for path in glob.glob(os.path.join(self.folder, '*.pdf')):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+def render_invoice(db, path, booking_id):
+    """Job writer for invoices: renders into the invoice cache, not `path`"""
+    return InvoiceCache(db).render(booking_id)
@@ -0,0 +1,126 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor
+from config import Config
+from database import Database
+import exports
+import invoices
+
+# kind -> (writer, file extension); writers are called as writer(db, path, **params)
+# and return the path they wrote, which may be elsewhere, or None if there was nothing to write
+JOB_KINDS = {
+    'excel': (exports.write_bookings_excel, '.xlsx'),
+    'pdf': (exports.write_bookings_pdf, '.pdf'),
+    'invoice': (invoices.render_invoice, '.pdf'),
+}
+
+def run_queued_jobs(db_name, folder):
+    """Claim and run queued jobs until none are left; runs in a pool process"""
+    db = Database(db_name)
+    while True:
+        job = db.claim_export_job(os.getpid())
+        if not job:
+            return
+        run_job(db, job, folder)
+
+def run_job(db, job, folder):
+    """Generate one artifact and record the outcome"""
+    writer, extension = JOB_KINDS[job['kind']]
+    path = os.path.join(folder, f"{job['id']}_{job['cache_key'][:16]}{extension}")
+    try:
+        result_path = writer(db, path, **json.loads(job['params']))
+        if not result_path or not os.path.exists(result_path):
+            raise RuntimeError("Nothing to export (the booking may no longer exist)")
+        db.update_export_job(job['id'], status='done', result_path=result_path, finished_at=time.time())
+    except Exception as e:
+        print(f"Export job #{job['id']} failed: {e}")
+        db.update_export_job(job['id'], status='failed', error=str(e), finished_at=time.time())
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class JobRunner:
+    """Runs heavy admin exports in a process pool, off the request workers.
+
+    Job state lives in the export_jobs table, so any gunicorn worker can
+    report on or serve a job another worker submitted. Pools claim queued
+    rows from the table rather than being handed jobs, so a job whose
+    worker restarted is picked up by whichever worker next kicks the queue
+    (a new export, or the progress page polling). A finished artifact is
+    reused for identical requests until a booking changes.
+    """
+
+    def __init__(self, db, folder=None, workers=None):
+        self.db = db
+        self.folder = os.path.abspath(folder or Config.EXPORT_FOLDER)
+        self.workers = workers or Config.EXPORT_WORKERS
+        self._pool = None
+        self._pool_pid = None
+        os.makedirs(self.folder, exist_ok=True)
+
+    def submit(self, kind, params, filename):
+        """Return a job for this export, reusing a cached or in-progress one if possible"""
+        self.prune()
+
+        cache_key = self.cache_key(kind, params)
+        job = self.db.find_export_job(cache_key, Config.EXPORT_JOB_TIMEOUT)
+        if job and (job['status'] != 'done' or os.path.exists(job['result_path'])):
+            return job
+
+        job_id = self.db.create_export_job(kind, params, cache_key, filename)
+        self.kick()
+        return self.db.get_export_job(job_id)
+
+    def kick(self):
+        """Requeue jobs whose process died and have this process's pool run the queue"""
+        self.recover()
+        if not self.db.count_queued_export_jobs():
+            return
+        try:
+            self._executor().submit(run_queued_jobs, self.db.db_name, self.folder)
+        except BrokenExecutor:
+            # A pool process died; start a fresh pool
+            self._pool = None
+            self._executor().submit(run_queued_jobs, self.db.db_name, self.folder)
+
+    def recover(self):
+        """Put running jobs whose pool process is gone back in the queue, or fail them"""
+        for job in self.db.get_running_export_jobs():
+            if job['worker_pid'] and pid_alive(job['worker_pid']):
+                continue
+            if job['attempts'] >= Config.EXPORT_JOB_MAX_ATTEMPTS:
+                print(f"Export job #{job['id']} lost its worker {job['attempts']} times; giving up")
+                self.db.update_export_job(job['id'], status='failed', error="Export worker stopped", finished_at=time.time())
+            else:
+                self.db.update_export_job(job['id'], status='queued', worker_pid=None)
+
+    def cache_key(self, kind, params):
+        key = json.dumps([kind, params, self.db.get_bookings_version()], sort_keys=True)
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def prune(self):
+        """Delete expired jobs and their files"""
+        for job in self.db.pop_expired_export_jobs(Config.EXPORT_RETENTION):
+            # Files stored outside our folder (e.g. cached invoices) are not ours to remove
+            path = job['result_path']
+            if path and os.path.dirname(path) == self.folder and os.path.exists(path):
+                os.remove(path)
+
+    def _executor(self):
+        # Pools are not fork-safe; each worker process starts its own on first use
+        if self._pool is None or self._pool_pid != os.getpid():
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+            self._pool_pid = os.getpid()
+        return self._pool
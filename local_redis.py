@@ -0,0 +1,241 @@
+"""Small in-process stand-in for a Redis server.
+
+Speaks enough of the Redis protocol for the session backend (strings,
+hashes, key expiry and MULTI/EXEC with WATCH), so the bot can be run or tried out
+with SESSION_BACKEND=redis without installing Redis:
+
+    python local_redis.py --port 6379
+
+Data lives in memory only. Use a real Redis server in production.
+"""
+import argparse
+import socketserver
+import threading
+import time
+from redis_client import RedisError, encode, read_reply
+
+# Commands that modify the key(s) they are given, for WATCH
+WRITE_COMMANDS = {'SET', 'DEL', 'EXPIRE', 'HSET', 'HINCRBY'}
+
+class LocalRedis:
+    """Keyspace shared by all connections, guarded by one (re-entrant) lock"""
+
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+        self.versions = {}  # key -> number of modifications, for WATCH
+        self.lock = threading.RLock()
+
+    def run(self, args):
+        name = args[0].upper()
+        handler = getattr(self, f"cmd_{name.lower()}", None)
+        if handler is None:
+            return RedisError(f"ERR unknown command '{args[0]}'")
+        with self.lock:
+            try:
+                reply = handler(*args[1:])
+                if name in WRITE_COMMANDS:
+                    for key in (args[1:] if name == 'DEL' else args[1:2]):
+                        self._modified(key)
+                return reply
+            except TypeError:
+                return RedisError(f"ERR wrong number of arguments for '{args[0]}' command")
+            except ValueError:
+                return RedisError("ERR value is not an integer or out of range")
+            except RedisError as e:
+                return e
+
+    def _get(self, key):
+        expires_at = self.expires.get(key)
+        if expires_at is not None and expires_at <= time.time():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+            self._modified(key)
+        return self.data.get(key)
+
+    def _modified(self, key):
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def version(self, key):
+        return self.versions.get(key, 0)
+
+    def _hash(self, key, create=False):
+        value = self._get(key)
+        if value is None:
+            value = {}
+            if create:
+                self.data[key] = value
+        elif not isinstance(value, dict):
+            raise WrongType()
+        return value
+
+    # Connection
+
+    def cmd_ping(self, message=None):
+        return message if message is not None else 'PONG'
+
+    def cmd_select(self, db):
+        return 'OK'
+
+    def cmd_auth(self, *args):
+        return 'OK'
+
+    # Keys
+
+    def cmd_exists(self, *keys):
+        return sum(1 for key in keys if self._get(key) is not None)
+
+    def cmd_del(self, *keys):
+        removed = 0
+        for key in keys:
+            if self._get(key) is not None:
+                del self.data[key]
+                self.expires.pop(key, None)
+                removed += 1
+        return removed
+
+    def cmd_expire(self, key, seconds):
+        if self._get(key) is None:
+            return 0
+        self.expires[key] = time.time() + int(seconds)
+        return 1
+
+    def cmd_ttl(self, key):
+        if self._get(key) is None:
+            return -2
+        expires_at = self.expires.get(key)
+        return -1 if expires_at is None else max(0, int(expires_at - time.time()))
+
+    # Strings
+
+    def cmd_get(self, key):
+        return self._get(key)
+
+    def cmd_set(self, key, value, *options):
+        self.data[key] = value
+        self.expires.pop(key, None)
+        options = [o.upper() if isinstance(o, str) else o for o in options]
+        if 'EX' in options:
+            self.expires[key] = time.time() + int(options[options.index('EX') + 1])
+        return 'OK'
+
+    # Hashes
+
+    def cmd_hset(self, key, *pairs):
+        if not pairs or len(pairs) % 2:
+            raise TypeError()
+        fields = self._hash(key, create=True)
+        added = sum(1 for field in pairs[::2] if field not in fields)
+        fields.update(zip(pairs[::2], pairs[1::2]))
+        return added
+
+    def cmd_hget(self, key, field):
+        return self._hash(key).get(field)
+
+    def cmd_hmget(self, key, *fields):
+        values = self._hash(key)
+        return [values.get(field) for field in fields]
+
+    def cmd_hgetall(self, key):
+        return [item for pair in self._hash(key).items() for item in pair]
+
+    def cmd_hincrby(self, key, field, amount):
+        fields = self._hash(key, create=True)
+        fields[field] = str(int(fields.get(field, 0)) + int(amount))
+        return int(fields[field])
+
+class WrongType(RedisError):
+    def __init__(self):
+        super().__init__("WRONGTYPE Operation against a key holding the wrong kind of value")
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        queued = None  # commands inside MULTI
+        watched = {}  # key -> version when WATCHed
+        while True:
+            try:
+                args = read_reply(self.rfile)
+            except (EOFError, OSError):
+                return
+            if not isinstance(args, list) or not args:
+                self.reply(RedisError("ERR protocol error"))
+                continue
+
+            name = args[0].upper()
+            store = self.server.store
+            if name == 'WATCH' and queued is None:
+                with store.lock:
+                    for key in args[1:]:
+                        store._get(key)
+                        watched.setdefault(key, store.version(key))
+                self.reply('OK')
+            elif name == 'UNWATCH':
+                watched = {}
+                self.reply('OK')
+            elif name == 'MULTI':
+                queued = []
+                self.reply('OK')
+            elif name == 'EXEC':
+                if queued is None:
+                    self.reply(RedisError("ERR EXEC without MULTI"))
+                    continue
+                # Hold the lock across the batch so it runs atomically
+                with store.lock:
+                    for key in watched:
+                        store._get(key)
+                    if any(store.version(key) != version for key, version in watched.items()):
+                        replies = None  # a watched key changed: abort
+                    else:
+                        replies = [store.run(command) for command in queued]
+                self.reply(replies)
+                queued = None
+                watched = {}
+            elif name == 'DISCARD':
+                queued = None
+                watched = {}
+                self.reply('OK')
+            elif queued is not None:
+                queued.append(args)
+                self.reply('QUEUED')
+            else:
+                self.reply(store.run(args))
+
+    def reply(self, value):
+        self.wfile.write(serialize(value))
+        self.wfile.flush()
+
+def serialize(value):
+    if isinstance(value, RedisError):
+        return b'-%s\r\n' % str(value).encode()
+    if value is None:
+        return b'$-1\r\n'
+    if isinstance(value, int):
+        return b':%d\r\n' % value
+    if isinstance(value, list):
+        return b'*%d\r\n' % len(value) + b''.join(serialize(item) for item in value)
+    if value == 'OK' or value == 'PONG' or value == 'QUEUED':
+        return b'+%s\r\n' % value.encode()
+    return encode([value])[len(b'*1\r\n'):]
+
+class LocalRedisServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=6379):
+        super().__init__((host, port), RequestHandler)
+        self.store = LocalRedis()
+
+    def start(self):
+        """Serve from a background thread; returns the bound port"""
+        threading.Thread(target=self.serve_forever, name="local-redis", daemon=True).start()
+        return self.server_address[1]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run an in-memory Redis stand-in")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6379)
+    options = parser.parse_args()
+
+    server = LocalRedisServer(options.host, options.port)
+    print(f"Local Redis stand-in listening on {options.host}:{options.port}")
+    server.serve_forever()
@@ -0,0 +1,68 @@
+import time
+from config import Config
+
+class TokenBucket:
+    """Token bucket kept in the database, so every worker process draws from one budget.
+
+    `rate` tokens per second, up to `burst` saved up. Taking always
+    succeeds but may leave the bucket in debt; the caller then waits, or
+    puts the work off, until the debt is paid back.
+    """
+
+    def __init__(self, db, key, rate, burst):
+        self.db = db
+        self.key = key
+        self.rate = rate
+        self.burst = burst
+
+    def take(self, count=1):
+        """Take `count` tokens; returns the seconds until they are actually available"""
+        tokens = self.db.take_tokens(self.key, self.rate, self.burst, count)
+        return max(0.0, -tokens / self.rate)
+
+    def acquire(self):
+        """Take one token, sleeping until it is available"""
+        wait = self.take()
+        if wait:
+            time.sleep(wait)
+
+class SenderLimiter:
+    """A shared token bucket per phone, for inbound messages.
+
+    admit() splits a batch into the messages that may be handled now and
+    the seconds until the rest may; those are meant to be put off, not
+    dropped. Senders are told to slow down at most once per
+    SENDER_NOTICE_SECONDS.
+    """
+
+    def __init__(self, db, rate=None, burst=None):
+        self.db = db
+        self.rate = rate or Config.SENDER_RATE_PER_MINUTE / 60
+        self.burst = burst or Config.SENDER_BURST
+        self._pruned_at = 0
+
+    def admit(self, phone, count):
+        """(messages of `count` allowed now, seconds until the rest are)"""
+        self._prune()
+        tokens = self.db.take_tokens(self.key(phone), self.rate, self.burst, count)
+        if tokens >= 0:
+            return count, 0.0
+        return max(0, int(tokens + count)), -tokens / self.rate
+
+    def refund(self, phone, count):
+        """Give back the tokens of messages that were taken but will never be handled"""
+        self.db.take_tokens(self.key(phone), self.rate, self.burst, -count)
+
+    def should_notify(self, phone):
+        """True at most once per SENDER_NOTICE_SECONDS for a phone"""
+        return self.db.mark_rate_notice(self.key(phone), Config.SENDER_NOTICE_SECONDS)
+
+    def key(self, phone):
+        return f"sender:{phone}"
+
+    def _prune(self):
+        # A bucket idle this long is full again, which is what a missing row means
+        now = time.time()
+        if now - self._pruned_at > 3600:
+            self._pruned_at = now
+            self.db.delete_idle_rate_limits(now - max(self.burst / self.rate, Config.SENDER_NOTICE_SECONDS))
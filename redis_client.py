@@ -0,0 +1,107 @@
+import os
+import socket
+import threading
+from urllib.parse import urlparse
+
+class RedisError(Exception):
+    pass
+
+class RedisClient:
+    """Minimal Redis (RESP2) client: one socket per thread, commands and pipelines.
+
+    Only what the bot needs; any server speaking the Redis protocol works,
+    including local_redis.py for development.
+    """
+
+    def __init__(self, host='localhost', port=6379, db=0, password=None, timeout=5):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self._local = threading.local()
+
+    @classmethod
+    def from_url(cls, url, timeout=5):
+        parsed = urlparse(url)
+        db = int(parsed.path.lstrip('/') or 0)
+        return cls(parsed.hostname or 'localhost', parsed.port or 6379, db, parsed.password, timeout)
+
+    def execute(self, *args):
+        """Run one command and return its reply"""
+        return self.pipeline([args])[0]
+
+    def pipeline(self, commands):
+        """Send several commands in one round trip; returns their replies in order"""
+        try:
+            sock, reader = self._connection()
+            sock.sendall(b''.join(encode(command) for command in commands))
+            replies = [read_reply(reader) for _ in commands]
+        except (OSError, EOFError):
+            # Drop the broken socket so the next call reconnects
+            self.close()
+            raise
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            self._local.conn = None
+            try:
+                conn[0].close()
+            except OSError:
+                pass
+
+    def _connection(self):
+        # A forked worker never reuses its parent's socket
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        conn = (sock, sock.makefile('rb'))
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        if self.password:
+            self.execute('AUTH', self.password)
+        if self.db:
+            self.execute('SELECT', self.db)
+        return conn
+
+def encode(args):
+    """Encode a command as a RESP array of bulk strings"""
+    parts = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode()
+        parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+    return b''.join(parts)
+
+def read_reply(stream):
+    """Read one RESP reply; errors are returned as RedisError instances"""
+    line = stream.readline()
+    if not line:
+        raise EOFError("Connection closed")
+    kind, rest = line[:1], line[1:-2]
+
+    if kind == b'+':
+        return rest.decode()
+    if kind == b'-':
+        return RedisError(rest.decode())
+    if kind == b':':
+        return int(rest)
+    if kind == b'$':
+        length = int(rest)
+        if length < 0:
+            return None
+        data = stream.read(length + 2)
+        return data[:-2].decode()
+    if kind == b'*':
+        count = int(rest)
+        if count < 0:
+            return None
+        return [read_reply(stream) for _ in range(count)]
+    raise RedisError(f"Unexpected reply: {line!r}")
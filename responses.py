@@ -0,0 +1,158 @@
+import threading
+from config import Config
+
+# Reply templates. The salon details from static_fields() and the rendered
+# service list are filled in once per catalogue; the rest are filled per
+# message by a single format pass.
+TEMPLATES = {
+    'service_list': "{service_list}",
+    'choose_services': (
+        "{service_list}"
+        "📝 *How to select:*\n"
+        "Reply with service numbers separated by commas\n"
+        "Example: 1,3,5\n\n"
+        "Type *Menu* to {menu_action}"
+    ),
+    'greet_and_choose_services': (
+        "Nice to meet you, *{name}*! 😊\n\n"
+        "{service_list}"
+        "📝 *How to select:*\n"
+        "Reply with service numbers separated by commas\n"
+        "Example: 1,3,5\n\n"
+        "Type *Menu* to cancel"
+    ),
+    'invalid_services': (
+        "❌ *Invalid format!*\n\n"
+        "Please enter service numbers separated by commas.\n"
+        "Example: 1,3,5\n\n"
+        "{service_list}"
+        "Or type *Menu* to cancel"
+    ),
+    'selected_services': (
+        "✅ *Selected Services:*\n\n"
+        "{service_details}"
+        "*Total Amount:* ₹{total}\n\n"
+        "{advance_note}"
+        "📅 *Select your preferred date:*"
+    ),
+    'advance_note': "💳 *Advance Payment Required:* ₹{advance} (50%)\n\n",
+    'booking_summary': (
+        "*📋 Booking Summary:*\n\n"
+        "👤 *Name:* {name}\n"
+        "📅 *Date:* {date}\n"
+        "⏰ *Time:* {time}\n\n"
+        "*Services:*\n"
+        "{service_items}"
+        "\n💰 *Total:* ₹{total}\n\n"
+        "{next_action}"
+    ),
+    'summary_with_payment': "💳 *Advance Required:* ₹{advance}\n\nClick *Proceed to Payment* to continue",
+    'summary_without_payment': "✅ No advance payment required!\n\nClick *Confirm Now* to book your appointment",
+    'booking_confirmed': (
+        "🎉 *Booking Confirmed!*\n\n"
+        "*Booking ID:* #{booking_id}\n"
+        "*Name:* {name}\n"
+        "*Date:* {date}\n"
+        "*Time:* {time}\n"
+        "*Services:* {service_names}\n"
+        "*Total:* ₹{total}\n\n"
+        "✨ See you at *{salon_name}*!\n\n"
+        "📍 {salon_address}\n"
+        "📞 {salon_phone}\n\n"
+        "Type *Menu* for more options"
+    ),
+    'slow_down': (
+        "⏳ You're sending messages faster than we can reply.\n\n"
+        "We'll answer them in order in a moment; please wait before sending more."
+    ),
+    'contact': (
+        "*📞 Contact {salon_name}*\n\n"
+        "📍 *Address:*\n{salon_address}\n\n"
+        "📱 *Phone:*\n{salon_phone}\n\n"
+        "💳 *UPI ID:*\n{upi_id}\n\n"
+        "*🕐 Working Hours:*\n"
+        "Monday - Sunday\n"
+        "10:00 AM - 8:00 PM\n\n"
+        "Type *Menu* to go back"
+    ),
+}
+
+SERVICE_LINE = "{key}. {name}\n   💰 ₹{price} | ⏱️ {duration}\n\n"
+SERVICE_DETAIL = "{name}\n   💰 ₹{price} | ⏱️ {duration}\n\n"
+SERVICE_ITEM = "• {name} - ₹{price}\n"
+
+def static_fields():
+    return {
+        'salon_name': Config.SALON_NAME,
+        'salon_address': Config.SALON_ADDRESS,
+        'salon_phone': Config.SALON_PHONE,
+        'upi_id': Config.UPI_ID,
+    }
+
+class _KeepMissing(dict):
+    """Leaves unknown placeholders in place for the per-message pass"""
+
+    def __missing__(self, key):
+        return '{' + key + '}'
+
+def escape(text):
+    return str(text).replace('{', '{{').replace('}', '}}')
+
+class ResponseTemplates:
+    """Reply texts with the catalogue and salon details rendered in ahead of time.
+
+    The compiled templates are rebuilt when Config.SERVICES or the salon
+    settings are replaced; call invalidate() after editing them in place.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._key = None
+        self._compiled = {}
+        self._details = {}
+        self._items = {}
+
+    def render(self, template, /, **values):
+        """Fill a template's per-message placeholders"""
+        return self._templates()[template].format_map(values)
+
+    def service_list(self):
+        return self.render('service_list')
+
+    def service_details(self, service_ids):
+        """Numbered lines of the chosen services with price and duration"""
+        self._templates()
+        return ''.join(f"{i}. {self._details[s]}" for i, s in enumerate(service_ids, 1))
+
+    def service_items(self, service_ids):
+        """Bullet list of the chosen services with prices"""
+        self._templates()
+        return ''.join(self._items[s] for s in service_ids)
+
+    def invalidate(self):
+        with self._lock:
+            self._key = None
+
+    def _templates(self):
+        settings = static_fields()
+        key = (id(Config.SERVICES), len(Config.SERVICES), tuple(settings.values()))
+        if key != self._key:
+            with self._lock:
+                if key != self._key:
+                    self._compile(settings)
+                    self._key = key
+        return self._compiled
+
+    def _compile(self, settings):
+        services = Config.SERVICES
+        service_list = "*📋 Our Services:*\n\n" + ''.join(
+            SERVICE_LINE.format(key=key, **service) for key, service in services.items()
+        )
+
+        fields = _KeepMissing({name: escape(value) for name, value in settings.items()})
+        fields['service_list'] = escape(service_list)
+        self._compiled = {name: template.format_map(fields) for name, template in TEMPLATES.items()}
+        self._details = {key: SERVICE_DETAIL.format(**service) for key, service in services.items()}
+        self._items = {key: SERVICE_ITEM.format(**service) for key, service in services.items()}
+
+templates = ResponseTemplates()
@@ -0,0 +1,84 @@
+import re
+from datetime import datetime
+from config import Config
+
+TICK = Config.SCHEDULE_TICK_MINUTES
+
+def parse_duration(text):
+    """Minutes in a service duration such as "45 min" or "1.5 hr" (default if unreadable)"""
+    match = re.match(r'\s*(\d+(?:\.\d+)?)\s*(h|hr|hrs|hour|hours|m|min|mins|minutes)?\s*$', str(text or ''), re.I)
+    if not match:
+        return Config.DEFAULT_SERVICE_MINUTES
+    value = float(match.group(1))
+    if (match.group(2) or 'min').lower().startswith('h'):
+        value *= 60
+    return int(round(value))
+
+def services_duration(service_ids):
+    """Total minutes for a list of service IDs done back to back"""
+    return sum(parse_duration(Config.SERVICES.get(s, {}).get('duration')) for s in service_ids) \
+        or Config.DEFAULT_SERVICE_MINUTES
+
+def to_minutes(slot_time):
+    """Minutes since midnight for a time like "10:00 AM" """
+    parsed = datetime.strptime(slot_time, "%I:%M %p")
+    return parsed.hour * 60 + parsed.minute
+
+def to_ticks(slot_time, duration):
+    """(first tick, number of ticks) covered by an appointment"""
+    start = to_minutes(slot_time)
+    return start // TICK, -(-(start % TICK + duration) // TICK)
+
+class DaySchedule:
+    """Chair occupancy of one day on a grid of TICK-minute ticks.
+
+    Chairs are interchangeable, so an appointment fits if at every tick it
+    covers fewer than `chairs` appointments are running (intervals can then
+    always be laid out on the chairs). `full` is a bitmask of the ticks
+    where every chair is busy, so a fit check is a single AND.
+    """
+
+    def __init__(self, chairs=None, closing_time=None):
+        self.chairs = chairs or Config.CHAIRS
+        self.closing_tick = to_minutes(closing_time or Config.CLOSING_TIME) // TICK
+        self.counts = {}
+        self.full = 0
+
+    def add(self, slot_time, duration, delta=1):
+        """Occupy one chair for the appointment (delta=-1 frees it again)"""
+        try:
+            first, length = to_ticks(slot_time, duration)
+        except ValueError:
+            print(f"Unreadable appointment time: {slot_time}")
+            return
+        for tick in range(first, first + length):
+            count = self.counts.get(tick, 0) + delta
+            self.counts[tick] = count
+            if count >= self.chairs:
+                self.full |= 1 << tick
+            else:
+                self.full &= ~(1 << tick)
+
+    def remove(self, slot_time, duration):
+        self.add(slot_time, duration, -1)
+
+    def fits(self, slot_time, duration):
+        """True if a chair is free for the whole appointment, ending by closing time"""
+        try:
+            first, length = to_ticks(slot_time, duration)
+        except ValueError:
+            return False
+        if first + length > self.closing_tick:
+            return False
+        return not self.full & (((1 << length) - 1) << first)
+
+    def free_starts(self, slot_times, duration):
+        return [slot for slot in slot_times if self.fits(slot, duration)]
+
+    def copy(self):
+        schedule = DaySchedule.__new__(DaySchedule)
+        schedule.chairs = self.chairs
+        schedule.closing_tick = self.closing_tick
+        schedule.counts = dict(self.counts)
+        schedule.full = self.full
+        return schedule
@@ -0,0 +1,120 @@
+import threading
+import time
+from config import Config
+from ratelimit import TokenBucket
+
+class SendQueue:
+    """Durable outbound queue drained by a pool of background dispatchers.
+
+    Jobs are stored in the database so they survive restarts and can be
+    picked up by any worker process. Jobs for the same phone are always
+    sent in the order they were queued; failed jobs are retried with
+    exponential backoff. Sends from every dispatcher in every worker draw
+    from one token bucket in the database, so bursts stay within the Graph
+    API throughput (WHATSAPP_SEND_RATE).
+    """
+
+    SEND_METHODS = ('send_message', 'send_interactive_buttons', 'send_interactive_list', 'send_image')
+
+    def __init__(self, db, whatsapp, workers=None):
+        self.db = db
+        self.workers = workers or Config.SEND_QUEUE_WORKERS
+        self.max_attempts = Config.SEND_QUEUE_MAX_ATTEMPTS
+        self.backoff = Config.SEND_QUEUE_BACKOFF_SECONDS
+        self.poll_interval = Config.SEND_QUEUE_POLL_SECONDS
+        self.lease = Config.SEND_QUEUE_LEASE_SECONDS
+        self.handlers = {name: getattr(whatsapp, name) for name in self.SEND_METHODS}
+        self.governor = TokenBucket(db, 'whatsapp_send', Config.WHATSAPP_SEND_RATE, Config.WHATSAPP_SEND_BURST)
+        self.give_up_handlers = {}
+        self._wakeup = threading.Event()
+        self._threads = []
+
+    def register(self, kind, handler, on_give_up=None):
+        """Register a handler for a job kind.
+
+        `on_give_up` is called with the job's arguments when its last attempt fails.
+        """
+        self.handlers[kind] = handler
+        if on_give_up:
+            self.give_up_handlers[kind] = on_give_up
+
+    def enqueue(self, phone, kind, *args, delay=0):
+        """Queue a job, due after `delay` seconds, and wake up a dispatcher"""
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        job_id = self.db.enqueue_outbound(phone, kind, list(args), delay)
+        self._wakeup.set()
+        return job_id
+
+    # Same signatures as WhatsAppHandler, so callers can swap one for the other
+
+    def send_message(self, to_phone, message):
+        return self.enqueue(to_phone, 'send_message', to_phone, message)
+
+    def send_interactive_buttons(self, to_phone, body_text, buttons):
+        return self.enqueue(to_phone, 'send_interactive_buttons', to_phone, body_text, buttons)
+
+    def send_interactive_list(self, to_phone, body_text, button_text, sections):
+        return self.enqueue(to_phone, 'send_interactive_list', to_phone, body_text, button_text, sections)
+
+    def send_image(self, to_phone, image_path, caption=""):
+        return self.enqueue(to_phone, 'send_image', to_phone, image_path, caption)
+
+    # =================== DISPATCHERS ===================
+
+    def start(self):
+        """Start the dispatcher threads"""
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._dispatch_loop, name=f"send-queue-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _dispatch_loop(self):
+        while True:
+            try:
+                job = self.db.claim_outbound_job(self.lease)
+            except Exception as e:
+                print(f"Send queue error: {e}")
+                job = None
+
+            if not job:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+
+            self.run_job(job)
+
+    def run_job(self, job):
+        """Run one claimed job and record the outcome"""
+        error = None
+        try:
+            if job['kind'] in self.SEND_METHODS:
+                self.governor.acquire()
+            result = self.handlers[job['kind']](*job['payload'])
+            if result is None:
+                error = "No response"
+            elif isinstance(result, dict) and result.get('error'):
+                error = str(result['error'])
+        except Exception as e:
+            error = str(e)
+
+        if error is None:
+            self.db.complete_outbound_job(job['id'])
+            return True
+
+        attempts = job['attempts'] + 1
+        if attempts >= self.max_attempts:
+            print(f"Send queue: giving up on job #{job['id']} ({job['kind']} to {job['phone']}): {error}")
+            self.db.fail_outbound_job(job['id'], error)
+            on_give_up = self.give_up_handlers.get(job['kind'])
+            if on_give_up:
+                try:
+                    on_give_up(*job['payload'])
+                except Exception as e:
+                    print(f"Send queue: give-up handler for job #{job['id']} failed: {e}")
+        else:
+            retry_at = time.time() + min(self.backoff * (2 ** (attempts - 1)), 300)
+            self.db.fail_outbound_job(job['id'], error, retry_at)
+        return False
@@ -0,0 +1,221 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from config import Config
+from redis_client import RedisClient
+
+DEFAULT_STEP = 'menu'
+
+class SQLiteSessionBackend:
+    """Sessions in the bot's own database; fine for a single host"""
+
+    sweeps = True  # idle rows must be deleted by the sweeper
+
+    def __init__(self, db):
+        self.db = db
+
+    def head(self, phone):
+        return self.db.get_session_head(phone)
+
+    def load(self, phone):
+        return self.db.load_session(phone)
+
+    def store(self, phone, step, data_json, touched_at, rev=None):
+        return self.db.store_session(phone, step, data_json, touched_at, rev)
+
+    def touch(self, phone, touched_at):
+        self.db.touch_session(phone, touched_at)
+
+    def delete(self, phone, rev=None):
+        return self.db.delete_session(phone, rev)
+
+    def delete_idle(self, idle_before):
+        return self.db.delete_idle_sessions(idle_before)
+
+class RedisSessionBackend:
+    """Sessions in Redis, shared by bot instances on any number of hosts.
+
+    Each session is a hash under session:<phone>; Redis expires idle keys
+    itself, so there is nothing to sweep.
+    """
+
+    sweeps = False
+
+    def __init__(self, client, ttl, prefix='session:'):
+        self.client = client
+        self.ttl = int(ttl)
+        self.prefix = prefix
+
+    def head(self, phone):
+        rev, touched_at = self.client.execute('HMGET', self.prefix + phone, 'rev', 'touched_at')
+        if rev is None or touched_at is None:
+            return None
+        return {'rev': int(rev), 'touched_at': float(touched_at)}
+
+    def load(self, phone):
+        values = self.client.execute('HMGET', self.prefix + phone, 'rev', 'step', 'data', 'touched_at')
+        if None in values:
+            return None
+        rev, step, data, touched_at = values
+        return {'rev': int(rev), 'step': step, 'data': data, 'touched_at': float(touched_at)}
+
+    def store(self, phone, step, data_json, touched_at, rev=None):
+        key = self.prefix + phone
+        if rev is not None and not self._watch(key, rev):
+            return None
+        replies = self.client.pipeline([
+            ('MULTI',),
+            ('HINCRBY', key, 'rev', 1),
+            ('HSET', key, 'step', step, 'data', data_json, 'touched_at', touched_at),
+            ('EXPIRE', key, self.ttl),
+            ('EXEC',),
+        ])
+        # EXEC replies nil when a watched key changed
+        return int(replies[-1][0]) if replies[-1] is not None else None
+
+    def touch(self, phone, touched_at):
+        key = self.prefix + phone
+        # Only refresh a session that still exists, never create a partial one
+        if self.client.execute('EXPIRE', key, self.ttl):
+            self.client.execute('HSET', key, 'touched_at', touched_at)
+
+    def delete(self, phone, rev=None):
+        key = self.prefix + phone
+        if rev is None:
+            self.client.execute('DEL', key)
+            return True
+        if not self._watch(key, rev):
+            return self.client.execute('EXISTS', key) == 0
+        replies = self.client.pipeline([('MULTI',), ('DEL', key), ('EXEC',)])
+        return replies[-1] is not None
+
+    def delete_idle(self, idle_before):
+        return 0
+
+    def _watch(self, key, rev):
+        """WATCH a session for a MULTI that must only run at revision `rev` (0: no session)"""
+        self.client.execute('WATCH', key)
+        current = self.client.execute('HGET', key, 'rev')
+        if int(current or 0) != rev:
+            self.client.execute('UNWATCH')
+            return False
+        return True
+
+def create_backend(db):
+    """Session backend selected by Config.SESSION_BACKEND"""
+    if Config.SESSION_BACKEND == 'redis':
+        return RedisSessionBackend(RedisClient.from_url(Config.REDIS_URL), Config.SESSION_TTL_SECONDS)
+    return SQLiteSessionBackend(db)
+
+class SessionStore:
+    """Conversation state per phone, with a read-through cache and idle expiry.
+
+    The cache keeps the last state this process read or wrote for a phone.
+    Every row carries a revision bumped on each write, so a read only
+    has to fetch the (rev, touched_at) pair to know whether the cached copy
+    is still current when another worker may have handled the phone.
+    Saving an unchanged state skips the write, and a session back at the
+    menu with no data is deleted rather than stored. Passing the revision
+    get() returned makes a save compare-and-set, so a state computed from
+    a stale read never overwrites a newer one. Rows live in a backend
+    (SQLite or Redis) with the interface of SQLiteSessionBackend.
+    """
+
+    def __init__(self, backend, ttl=None, cache_size=None):
+        self.backend = backend
+        self.ttl = ttl or Config.SESSION_TTL_SECONDS
+        self.cache_size = cache_size or Config.SESSION_CACHE_SIZE
+        self._cache = OrderedDict()  # phone -> {'rev', 'step', 'data' (JSON), 'touched_at'}
+        self._lock = threading.Lock()
+        self._sweeper = None
+
+    def get(self, phone):
+        """{'step', 'data', 'rev'} for a phone; a fresh menu session if none or it went idle"""
+        head = self.backend.head(phone)
+        if head is None or head['touched_at'] < time.time() - self.ttl:
+            self._remember(phone, None)
+            return {'step': DEFAULT_STEP, 'data': {}, 'rev': head['rev'] if head else 0}
+
+        with self._lock:
+            entry = self._cache.get(phone)
+            if entry and entry['rev'] == head['rev']:
+                self._cache.move_to_end(phone)
+                entry['touched_at'] = head['touched_at']
+                # Callers mutate data, so hand out a copy
+                return {'step': entry['step'], 'data': json.loads(entry['data']), 'rev': entry['rev']}
+
+        row = self.backend.load(phone)
+        if row is None:
+            self._remember(phone, None)
+            return {'step': DEFAULT_STEP, 'data': {}, 'rev': 0}
+        self._remember(phone, row)
+        return {'step': row['step'], 'data': json.loads(row['data']), 'rev': row['rev']}
+
+    def save(self, phone, step, data, rev=None):
+        """Store a phone's state unless it is what we already have.
+
+        With `rev` from get(), nothing is written if the session changed
+        since; returns False in that case, True otherwise.
+        """
+        data_json = json.dumps(data, sort_keys=True)
+        now = time.time()
+
+        with self._lock:
+            entry = self._cache.get(phone, False)
+        if entry is None and step == DEFAULT_STEP and not data:
+            if rev is None or self.backend.head(phone) is None:
+                return True  # no row, and none needed
+        if entry and entry['step'] == step and entry['data'] == data_json:
+            # Unchanged, unless another worker wrote since we cached it
+            head = self.backend.head(phone)
+            if head and head['rev'] == entry['rev'] and rev in (None, head['rev']):
+                # Only refresh the idle clock now and then
+                if head['touched_at'] < now - self.ttl / 4:
+                    self.backend.touch(phone, now)
+                    entry['touched_at'] = now
+                return True
+
+        if step == DEFAULT_STEP and not data:
+            if not self.backend.delete(phone, rev):
+                self._forget(phone)
+                return False
+            self._remember(phone, None)
+            return True
+
+        new_rev = self.backend.store(phone, step, data_json, now, rev)
+        if new_rev is None:
+            self._forget(phone)
+            return False
+        self._remember(phone, {'rev': new_rev, 'step': step, 'data': data_json, 'touched_at': now})
+        return True
+
+    def sweep(self):
+        """Delete sessions idle for longer than the TTL"""
+        return self.backend.delete_idle(time.time() - self.ttl)
+
+    def start(self):
+        """Start the background sweeper, if the backend needs one"""
+        if self._sweeper or not self.backend.sweeps:
+            return
+        self._sweeper = threading.Thread(target=self._sweep_loop, name="session-sweeper", daemon=True)
+        self._sweeper.start()
+
+    def _sweep_loop(self):
+        while True:
+            time.sleep(Config.SESSION_SWEEP_SECONDS)
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"Session sweep error: {e}")
+
+    def _forget(self, phone):
+        with self._lock:
+            self._cache.pop(phone, None)
+
+    def _remember(self, phone, entry):
+        with self._lock:
+            self._cache[phone] = entry
+            self._cache.move_to_end(phone)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
@@ -0,0 +1,13 @@
+import os
+import sys
+
+# The bot's modules live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from database import Database
+
+@pytest.fixture
+def db(tmp_path):
+    """A fresh, fully migrated database"""
+    return Database(str(tmp_path / 'salon.db'))
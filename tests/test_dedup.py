@@ -0,0 +1,63 @@
+import time
+from dedup import ProcessedMessages
+
+# =================== DATABASE ===================
+
+def test_claim_message_once(db):
+    assert db.claim_message('wamid.1', 100.0)
+    assert not db.claim_message('wamid.1', 101.0)
+    assert db.claim_message('wamid.2', 101.0)
+
+def test_release_message_allows_claim_again(db):
+    db.claim_message('wamid.1', 100.0)
+    db.release_message('wamid.1')
+    assert db.claim_message('wamid.1', 101.0)
+
+def test_delete_processed_messages_before(db):
+    db.claim_message('wamid.old', 100.0)
+    db.claim_message('wamid.new', 200.0)
+
+    assert db.delete_processed_messages(150.0) == 1
+    assert db.claim_message('wamid.old', 300.0)
+    assert not db.claim_message('wamid.new', 300.0)
+
+# =================== PROCESSED MESSAGES ===================
+
+def test_repeat_is_skipped(db):
+    messages = ProcessedMessages(db, window=60, cache_size=10)
+    assert messages.claim('wamid.1')
+    assert not messages.claim('wamid.1')
+
+def test_claims_are_shared_through_the_database(db):
+    # A second worker has its own cache but shares the database
+    assert ProcessedMessages(db, window=60, cache_size=10).claim('wamid.1')
+    assert not ProcessedMessages(db, window=60, cache_size=10).claim('wamid.1')
+
+def test_repeat_beyond_cache_is_still_skipped(db):
+    messages = ProcessedMessages(db, window=60, cache_size=2)
+    for n in range(5):
+        messages.claim(f'wamid.{n}')
+
+    assert len(messages._seen) == 2
+    assert not messages.claim('wamid.0')
+
+def test_release_allows_claim_again(db):
+    messages = ProcessedMessages(db, window=60, cache_size=10)
+    messages.claim('wamid.1')
+    messages.release('wamid.1')
+
+    assert messages.claim('wamid.1')
+    assert not ProcessedMessages(db, window=60, cache_size=10).claim('wamid.1')
+
+def test_release_of_unknown_id_is_harmless(db):
+    messages = ProcessedMessages(db, window=60, cache_size=10)
+    messages.release('wamid.1')
+    assert messages.claim('wamid.1')
+
+def test_prune_forgets_ids_older_than_window(db):
+    messages = ProcessedMessages(db, window=60, cache_size=10)
+    messages.claim('wamid.1')
+
+    assert messages.prune(time.time() + 30) == 0
+    assert messages.prune(time.time() + 120) == 1
+    assert ProcessedMessages(db, window=60, cache_size=10).claim('wamid.1')
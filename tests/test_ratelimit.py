@@ -0,0 +1,151 @@
+import time
+import pytest
+from config import Config
+from dedup import ProcessedMessages
+from ratelimit import SenderLimiter, TokenBucket
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    return now
+
+# =================== TOKEN BUCKETS ===================
+
+def test_new_bucket_starts_full(db, clock):
+    assert db.take_tokens('k', 1.0, 5, 1) == 4
+
+def test_taking_past_empty_goes_into_debt(db, clock):
+    assert db.take_tokens('k', 1.0, 5, 7) == -2
+    assert db.take_tokens('k', 1.0, 5, 1) == -3
+
+def test_bucket_refills_up_to_burst(db, clock):
+    db.take_tokens('k', 1.0, 5, 5)
+
+    clock[0] += 2
+    assert db.take_tokens('k', 1.0, 5, 0) == 2
+
+    clock[0] += 3600
+    assert db.take_tokens('k', 1.0, 5, 0) == 5
+
+def test_debt_is_paid_back_by_refill(db, clock):
+    db.take_tokens('k', 1.0, 5, 8)
+
+    clock[0] += 3
+    assert db.take_tokens('k', 1.0, 5, 0) == 0
+
+def test_refund_gives_tokens_back(db, clock):
+    db.take_tokens('k', 1.0, 5, 7)
+    assert db.take_tokens('k', 1.0, 5, -2) == 0
+
+def test_clock_going_back_does_not_drain(db, clock):
+    db.take_tokens('k', 1.0, 5, 3)
+
+    clock[0] -= 10
+    assert db.take_tokens('k', 1.0, 5, 0) == 2
+    clock[0] += 11
+    assert db.take_tokens('k', 1.0, 5, 0) == 3
+
+def test_buckets_are_separate(db, clock):
+    db.take_tokens('a', 1.0, 5, 5)
+    assert db.take_tokens('b', 1.0, 5, 1) == 4
+
+def test_token_bucket_take_returns_wait(db, clock):
+    bucket = TokenBucket(db, 'k', 2.0, 2)
+    assert bucket.take() == 0
+    assert bucket.take() == 0
+    assert bucket.take() == pytest.approx(0.5)
+
+def test_idle_buckets_are_deleted(db, clock):
+    db.take_tokens('old', 1.0, 5, 1)
+    clock[0] += 100
+    db.take_tokens('new', 1.0, 5, 1)
+
+    assert db.delete_idle_rate_limits(clock[0] - 50) == 1
+    assert db.take_tokens('old', 1.0, 5, 0) == 5
+
+# =================== SENDERS ===================
+
+def test_admit_splits_batch(db, clock):
+    limiter = SenderLimiter(db, rate=0.5, burst=3)
+
+    assert limiter.admit('911', 2) == (2, 0.0)
+    assert limiter.admit('911', 3) == (1, 4.0)
+    assert limiter.admit('911', 1) == (0, 6.0)
+    assert limiter.admit('912', 1) == (1, 0.0)
+
+def test_refund_restores_admission(db, clock):
+    limiter = SenderLimiter(db, rate=0.5, burst=3)
+    limiter.admit('911', 5)
+    limiter.refund('911', 2)
+
+    assert limiter.admit('911', 0) == (0, 0.0)
+
+def test_sender_is_notified_once_per_period(db, clock):
+    limiter = SenderLimiter(db, rate=0.5, burst=3)
+    limiter.admit('911', 5)
+
+    assert limiter.should_notify('911')
+    assert not limiter.should_notify('911')
+
+    clock[0] += Config.SENDER_NOTICE_SECONDS + 1
+    assert limiter.should_notify('911')
+
+def test_unknown_sender_is_not_notified(db, clock):
+    assert not SenderLimiter(db, rate=0.5, burst=3).should_notify('911')
+
+# =================== WEBHOOK THROTTLING ===================
+
+@pytest.fixture
+def throttle_sender(db, tmp_path, monkeypatch):
+    # Importing the app opens salon.db in the working directory
+    monkeypatch.chdir(tmp_path)
+    import app
+    monkeypatch.setattr(app, 'db', db)
+    monkeypatch.setattr(app, 'sender_limiter', SenderLimiter(db, rate=1 / 60, burst=3))
+    monkeypatch.setattr(app, 'processed_messages', ProcessedMessages(db, window=60, cache_size=10))
+    return app.throttle_sender
+
+def text(message_id):
+    return {'id': message_id, 'type': 'text', 'text': {'body': 'hi'}}
+
+def image(message_id):
+    return {'id': message_id, 'type': 'image', 'image': {'id': 'media'}}
+
+def test_throttle_keeps_batch_in_order(throttle_sender):
+    messages = [text(f'wamid.{n}') for n in range(5)]
+
+    now, later, delay = throttle_sender('911', messages)
+
+    assert now == messages[:3]
+    assert later == messages[3:]
+    assert delay == pytest.approx(120, abs=1)
+
+def test_throttle_within_budget_handles_all(throttle_sender):
+    messages = [text('wamid.1'), text('wamid.2')]
+    assert throttle_sender('911', messages) == (messages, [], 0.0)
+
+def test_throttle_waits_behind_deferred_messages(throttle_sender, db):
+    db.enqueue_outbound('911', 'handle_deferred_messages', ['911', [text('wamid.0')]], 60)
+
+    now, later, delay = throttle_sender('911', [text('wamid.1')])
+
+    assert now == []
+    assert later == [text('wamid.1')]
+
+def test_throttle_drops_text_beyond_backlog(throttle_sender, db, monkeypatch):
+    monkeypatch.setattr(Config, 'SENDER_MAX_BACKLOG_SECONDS', 60)
+    import app
+    for n in range(6):
+        app.processed_messages.claim(f'wamid.{n}')
+    messages = [text('wamid.0'), text('wamid.1'), text('wamid.2'), text('wamid.3'), image('wamid.4'), text('wamid.5')]
+
+    now, later, delay = throttle_sender('911', messages)
+
+    assert now == messages[:3]
+    assert later == [image('wamid.4')]
+    # Dropped messages give back their tokens and may be delivered again
+    assert db.take_tokens(app.sender_limiter.key('911'), 1 / 60, 3, 0) == pytest.approx(-1, abs=0.1)
+    assert app.processed_messages.claim('wamid.3')
+    assert app.processed_messages.claim('wamid.5')
+    assert not app.processed_messages.claim('wamid.4')
@@ -0,0 +1,97 @@
+import pytest
+from config import Config
+from scheduling import DaySchedule, parse_duration, services_duration, to_ticks, TICK
+
+# =================== DURATIONS ===================
+
+@pytest.mark.parametrize('text, minutes', [
+    ('45 min', 45),
+    ('30', 30),
+    ('90 mins', 90),
+    ('1.5 hr', 90),
+    ('2 hours', 120),
+    (' 1 H ', 60),
+])
+def test_parse_duration(text, minutes):
+    assert parse_duration(text) == minutes
+
+@pytest.mark.parametrize('text', [None, '', 'about an hour', '45 min approx', '-30 min'])
+def test_unreadable_duration_falls_back_to_default(text):
+    assert parse_duration(text) == Config.DEFAULT_SERVICE_MINUTES
+
+def test_services_duration_adds_up_services():
+    assert services_duration(['1', '3']) == parse_duration(Config.SERVICES['1']['duration']) \
+        + parse_duration(Config.SERVICES['3']['duration'])
+
+def test_services_duration_of_nothing_known_is_default():
+    assert services_duration([]) == Config.DEFAULT_SERVICE_MINUTES
+    assert services_duration(['no such service']) == Config.DEFAULT_SERVICE_MINUTES
+
+def test_ticks_cover_partial_ticks():
+    first, length = to_ticks('10:00 AM', TICK + 1)
+    assert first == 10 * 60 // TICK
+    assert length == 2
+
+# =================== DAY SCHEDULE ===================
+
+def test_empty_day_fits_until_closing():
+    schedule = DaySchedule(chairs=1, closing_time='08:00 PM')
+    assert schedule.fits('10:00 AM', 60)
+    assert schedule.fits('07:00 PM', 60)
+    assert not schedule.fits('07:00 PM', 61)
+    assert not schedule.fits('not a time', 30)
+
+def test_busy_chair_blocks_overlaps_only():
+    schedule = DaySchedule(chairs=1, closing_time='08:00 PM')
+    schedule.add('11:00 AM', 60)
+
+    assert not schedule.fits('11:00 AM', 30)
+    assert not schedule.fits('10:00 AM', 90)  # runs into the booking
+    assert schedule.fits('10:00 AM', 60)  # ends as it starts
+    assert schedule.fits('12:00 PM', 60)
+
+def test_full_bitmask_tracks_busy_ticks():
+    schedule = DaySchedule(chairs=1, closing_time='08:00 PM')
+    first, length = to_ticks('11:00 AM', 60)
+
+    schedule.add('11:00 AM', 60)
+    assert schedule.full == ((1 << length) - 1) << first
+
+    schedule.remove('11:00 AM', 60)
+    assert schedule.full == 0
+    assert schedule.fits('11:00 AM', 60)
+
+def test_each_chair_takes_one_appointment():
+    schedule = DaySchedule(chairs=2, closing_time='08:00 PM')
+    schedule.add('10:00 AM', 120)
+    assert schedule.fits('11:00 AM', 60)
+
+    schedule.add('11:00 AM', 60)
+    assert not schedule.fits('11:00 AM', 30)
+    assert schedule.fits('12:00 PM', 60)
+
+    schedule.remove('10:00 AM', 120)
+    assert schedule.fits('11:00 AM', 30)
+
+def test_free_starts_keeps_slot_order():
+    schedule = DaySchedule(chairs=1, closing_time='08:00 PM')
+    schedule.add('11:00 AM', 60)
+    assert schedule.free_starts(['10:00 AM', '11:00 AM', '12:00 PM'], 60) == ['10:00 AM', '12:00 PM']
+
+def test_copy_is_independent():
+    schedule = DaySchedule(chairs=1, closing_time='08:00 PM')
+    copy = schedule.copy()
+    copy.add('10:00 AM', 60)
+
+    assert schedule.fits('10:00 AM', 60)
+    assert not copy.fits('10:00 AM', 60)
+
+def test_day_schedule_counts_active_bookings(db):
+    db.save_booking(phone='911', name='A', services=['1'], date='2030-01-07', time='10:00 AM',
+                    total=150, duration=60, check_slot=False)
+    db.save_booking(phone='912', name='B', services=['1'], date='2030-01-07', time='12:00 PM',
+                    total=150, duration=60, status='cancelled', check_slot=False)
+
+    schedule = db.get_day_schedule('2030-01-07')
+    assert schedule.counts[to_ticks('10:00 AM', 60)[0]] == 1
+    assert not schedule.counts.get(to_ticks('12:00 PM', 60)[0])
@@ -0,0 +1,166 @@
+import time
+import pytest
+from local_redis import LocalRedisServer
+from redis_client import RedisClient
+from sessions import DEFAULT_STEP, RedisSessionBackend, SessionStore, SQLiteSessionBackend
+
+@pytest.fixture(scope='module')
+def redis_server():
+    server = LocalRedisServer(port=0)
+    server.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def client(redis_server):
+    client = RedisClient('127.0.0.1', redis_server.server_address[1])
+    yield client
+    client.close()
+    with redis_server.store.lock:
+        redis_server.store.data.clear()
+        redis_server.store.expires.clear()
+
+@pytest.fixture
+def backend(client):
+    return RedisSessionBackend(client, ttl=60)
+
+@pytest.fixture(params=['sqlite', 'redis'])
+def any_backend(request):
+    if request.param == 'sqlite':
+        return SQLiteSessionBackend(request.getfixturevalue('db'))
+    return RedisSessionBackend(request.getfixturevalue('client'), ttl=60)
+
+# =================== REDIS BACKEND ===================
+
+def test_missing_session_has_no_head_or_row(backend):
+    assert backend.head('911') is None
+    assert backend.load('911') is None
+
+def test_store_bumps_revision(backend):
+    assert backend.store('911', 'select_date', '{"a": 1}', 100.0) == 1
+    assert backend.store('911', 'select_time', '{"a": 2}', 101.0) == 2
+
+    assert backend.head('911') == {'rev': 2, 'touched_at': 101.0}
+    assert backend.load('911') == {'rev': 2, 'step': 'select_time', 'data': '{"a": 2}', 'touched_at': 101.0}
+
+def test_store_sets_expiry(backend, client):
+    backend.store('911', 'select_date', '{}', 100.0)
+    assert 0 < client.execute('TTL', 'session:911') <= 60
+
+def test_touch_refreshes_clock_and_expiry(backend, client):
+    backend.store('911', 'select_date', '{}', 100.0)
+    client.execute('EXPIRE', 'session:911', 5)
+
+    backend.touch('911', 200.0)
+
+    assert backend.head('911') == {'rev': 1, 'touched_at': 200.0}
+    assert client.execute('TTL', 'session:911') > 5
+
+def test_touch_does_not_create_session(backend):
+    backend.touch('911', 200.0)
+    assert backend.head('911') is None
+    assert backend.load('911') is None
+
+def test_idle_session_expires(client):
+    backend = RedisSessionBackend(client, ttl=1)
+    backend.store('911', 'select_date', '{}', time.time())
+
+    time.sleep(1.1)
+
+    assert backend.head('911') is None
+    assert backend.load('911') is None
+
+def test_store_at_stale_revision_is_refused(backend):
+    assert backend.store('911', 'select_date', '{}', 100.0, rev=0) == 1
+    assert backend.store('911', 'select_time', '{}', 101.0, rev=0) is None
+    assert backend.store('911', 'select_time', '{}', 101.0, rev=1) == 2
+    assert backend.load('911')['step'] == 'select_time'
+
+def test_delete(backend):
+    backend.store('911', 'select_date', '{}', 100.0)
+    backend.delete('911')
+    assert backend.head('911') is None
+
+# =================== SESSION STORE ===================
+
+def test_store_round_trip(backend):
+    store = SessionStore(backend, ttl=60)
+    store.save('911', 'select_date', {'services': ['1', '3']})
+    assert store.get('911') == {'step': 'select_date', 'data': {'services': ['1', '3']}, 'rev': 1}
+
+def test_menu_without_data_is_not_stored(backend):
+    store = SessionStore(backend, ttl=60)
+    store.save('911', 'select_date', {'services': ['1']})
+    store.save('911', DEFAULT_STEP, {})
+
+    assert backend.head('911') is None
+    assert store.get('911') == {'step': DEFAULT_STEP, 'data': {}, 'rev': 0}
+
+def test_unchanged_save_skips_write(backend):
+    store = SessionStore(backend, ttl=60)
+    store.save('911', 'select_date', {'services': ['1']})
+    store.save('911', 'select_date', {'services': ['1']})
+    assert backend.head('911')['rev'] == 1
+
+def test_cached_copy_is_dropped_when_another_store_writes(client):
+    # Two bot instances sharing one Redis, each with its own cache
+    first = SessionStore(RedisSessionBackend(client, ttl=60), ttl=60)
+    second = SessionStore(RedisSessionBackend(client, ttl=60), ttl=60)
+
+    first.save('911', 'select_date', {'services': ['1']})
+    assert second.get('911')['step'] == 'select_date'
+
+    second.save('911', 'select_time', {'services': ['1'], 'date': '2026-10-20'})
+    assert first.get('911') == {'step': 'select_time', 'data': {'services': ['1'], 'date': '2026-10-20'}, 'rev': 2}
+
+def test_save_after_another_store_wrote_is_not_skipped(client):
+    first = SessionStore(RedisSessionBackend(client, ttl=60), ttl=60)
+    second = SessionStore(RedisSessionBackend(client, ttl=60), ttl=60)
+
+    first.save('911', 'select_date', {'services': ['1']})
+    second.get('911')
+    second.save('911', 'select_time', {'services': ['1'], 'date': '2026-10-20'})
+
+    # first's cache still holds select_date; saving that again must reach Redis
+    first.save('911', 'select_date', {'services': ['1']})
+    assert second.get('911') == {'step': 'select_date', 'data': {'services': ['1']}, 'rev': 3}
+
+def test_idle_session_restarts_at_menu(backend):
+    store = SessionStore(backend, ttl=60)
+    backend.store('911', 'select_date', '{}', time.time() - 120)
+    assert store.get('911') == {'step': DEFAULT_STEP, 'data': {}, 'rev': 1}
+
+# =================== COMPARE-AND-SET ===================
+
+def test_save_with_stale_revision_keeps_newer_state(any_backend):
+    webhook = SessionStore(any_backend, ttl=60)
+    job = SessionStore(any_backend, ttl=60)
+    webhook.save('911', 'verifying_payment', {'services': ['1']})
+
+    seen = webhook.get('911')
+    job_seen = job.get('911')
+    assert job.save('911', DEFAULT_STEP, {}, job_seen['rev'])
+
+    # The webhook still holds the state it read before the job moved on
+    assert not webhook.save('911', seen['step'], seen['data'], seen['rev'])
+    assert webhook.get('911') == {'step': DEFAULT_STEP, 'data': {}, 'rev': 0}
+
+def test_save_with_current_revision_writes(any_backend):
+    store = SessionStore(any_backend, ttl=60)
+    store.save('911', 'select_date', {'services': ['1']})
+
+    seen = store.get('911')
+    assert store.save('911', 'select_time', {'services': ['1'], 'date': '2026-10-20'}, seen['rev'])
+    assert not store.save('911', 'select_date', {'services': ['1']}, seen['rev'])
+    assert store.get('911')['step'] == 'select_time'
+
+def test_new_session_cannot_overwrite_one_created_since(any_backend):
+    first = SessionStore(any_backend, ttl=60)
+    second = SessionStore(any_backend, ttl=60)
+    seen = first.get('911')
+
+    second.save('911', 'select_date', {'services': ['2']})
+
+    assert not first.save('911', 'select_date', {'services': ['1']}, seen['rev'])
+    assert first.get('911')['data'] == {'services': ['2']}
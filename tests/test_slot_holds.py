@@ -0,0 +1,90 @@
+import time
+import pytest
+from config import Config
+
+DATE = '2030-01-07'
+
+@pytest.fixture(autouse=True)
+def one_chair(monkeypatch):
+    monkeypatch.setattr(Config, 'CHAIRS', 1)
+    monkeypatch.setattr(Config, 'CLOSING_TIME', '08:00 PM')
+
+def holds(db):
+    return db.get_slot_state(DATE, DATE)[1]
+
+# =================== HOLDING ===================
+
+def test_hold_blocks_other_phones_only(db):
+    assert db.hold_slot('911', DATE, '10:00 AM', 60, 60)
+
+    assert not db.hold_slot('912', DATE, '10:00 AM', 60, 60)
+    assert not db.hold_slot('912', DATE, '09:30 AM', 60, 60)  # overlaps the held hour
+    assert db.hold_slot('912', DATE, '11:00 AM', 60, 60)
+
+    assert db.get_day_schedule(DATE, '911').fits('10:00 AM', 60)
+    assert not db.get_day_schedule(DATE, '912').fits('10:00 AM', 60)
+
+def test_phone_holds_one_slot(db):
+    assert db.hold_slot('911', DATE, '10:00 AM', 60, 60)
+    assert db.hold_slot('911', DATE, '02:00 PM', 60, 60)
+
+    assert [(h['phone'], h['time']) for h in holds(db)] == [('911', '02:00 PM')]
+    assert db.hold_slot('912', DATE, '10:00 AM', 60, 60)
+
+def test_hold_can_move_within_its_own_slot(db):
+    assert db.hold_slot('911', DATE, '10:00 AM', 60, 60)
+    assert db.hold_slot('911', DATE, '10:30 AM', 60, 60)
+    assert len(holds(db)) == 1
+
+def test_hold_refused_over_a_booking(db):
+    db.save_booking(phone='912', name='B', services=['1'], date=DATE, time='10:00 AM',
+                    total=150, duration=60, check_slot=False)
+    assert not db.hold_slot('911', DATE, '10:00 AM', 60, 30)
+
+def test_hold_must_end_by_closing_time(db):
+    assert not db.hold_slot('911', DATE, '07:00 PM', 60, 90)
+    assert holds(db) == []
+
+def test_each_chair_can_be_held(db, monkeypatch):
+    monkeypatch.setattr(Config, 'CHAIRS', 2)
+    assert db.hold_slot('911', DATE, '10:00 AM', 60, 60)
+    assert db.hold_slot('912', DATE, '10:00 AM', 60, 60)
+    assert not db.hold_slot('913', DATE, '10:00 AM', 60, 60)
+
+# =================== RELEASING ===================
+
+def test_release_frees_the_slot(db):
+    db.hold_slot('911', DATE, '10:00 AM', 60, 60)
+    db.release_hold('911')
+
+    assert holds(db) == []
+    assert db.hold_slot('912', DATE, '10:00 AM', 60, 60)
+
+def test_release_without_hold_changes_nothing(db):
+    version = db.get_slots_version()
+    db.release_hold('911')
+    assert db.get_slots_version() == version
+
+def test_booking_releases_own_hold(db):
+    db.hold_slot('911', DATE, '10:00 AM', 60, 60)
+    assert db.save_booking(phone='911', name='A', services=['1'], date=DATE, time='10:00 AM',
+                           total=150, duration=60) is not None
+
+    assert holds(db) == []
+
+def test_expired_hold_frees_the_slot(db):
+    assert db.hold_slot('911', DATE, '10:00 AM', 1, 60)
+    time.sleep(1.1)
+
+    assert holds(db) == []
+    assert db.hold_slot('912', DATE, '10:00 AM', 60, 60)
+
+def test_slot_listeners_see_holds_and_releases(db):
+    changes = []
+    db.slot_listeners.append(lambda change, before, after: changes.append(change['action']))
+
+    db.hold_slot('911', DATE, '10:00 AM', 60, 60)
+    db.hold_slot('912', DATE, '10:00 AM', 60, 60)  # refused, nothing changed
+    db.release_hold('911')
+
+    assert changes == ['hold', 'release']
@@ -0,0 +1,47 @@
+import os
+from config import Config
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:  # thumbnails are optional; the dashboard falls back to the originals
+    Image = None
+
+def thumbnail_format():
+    """WEBP where Pillow supports it, JPEG otherwise (also without Pillow, so paths still resolve)"""
+    if Image is None:
+        return 'JPEG'
+    return 'WEBP' if features.check('webp') else 'JPEG'
+
+def thumbnail_path(filename):
+    """Where the thumbnail of an upload is cached"""
+    extension = '.webp' if thumbnail_format() == 'WEBP' else '.jpg'
+    return os.path.join(Config.THUMBNAIL_FOLDER, os.path.splitext(filename)[0] + extension)
+
+def make_thumbnail(filename, source=None):
+    """Render the thumbnail of an upload and return its path (None if it cannot be made).
+
+    `source` is a path or file object to read instead of the file in the upload folder.
+    """
+    if Image is None:
+        return None
+
+    if source is None:
+        source = os.path.join(Config.UPLOAD_FOLDER, filename)
+    path = thumbnail_path(filename)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+
+    try:
+        with Image.open(source) as image:
+            # Let the JPEG decoder downscale while reading instead of decoding full size
+            image.draft('RGB', Config.THUMBNAIL_SIZE)
+            image = ImageOps.exif_transpose(image).convert('RGB')
+            image.thumbnail(Config.THUMBNAIL_SIZE)
+            image.save(tmp_path, thumbnail_format(), quality=Config.THUMBNAIL_QUALITY)
+        os.replace(tmp_path, path)
+        return path
+    except Exception as e:
+        print(f"Error creating thumbnail for {filename}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return None
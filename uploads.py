@@ -0,0 +1,189 @@
+import hashlib
+import io
+import os
+import zipfile
+from datetime import datetime, timedelta
+from config import Config
+import thumbnails
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+MIMETYPES = {'.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png', '.webp': 'image/webp'}
+
+class UploadStore:
+    """Payment screenshots on disk, and their lifecycle.
+
+    New files go in hash-sharded subdirectories (ab/cd/<name>) so no single
+    directory grows without bound; the relative path is what bookings store
+    in payment_screenshot. maintain() then applies retention and moves old
+    files into monthly zip archives outside the web root. An archived file
+    keeps its name: resolve() finds it in its archive, so references in
+    bookings never have to change.
+    """
+
+    def __init__(self, db, folder=None, archive_folder=None):
+        self.db = db
+        self.folder = folder or Config.UPLOAD_FOLDER
+        self.archive_folder = archive_folder or Config.UPLOAD_ARCHIVE_FOLDER
+        os.makedirs(self.folder, exist_ok=True)
+
+    def store(self, path, sha256):
+        """Move a file into its shard; returns the name to reference it by"""
+        name = os.path.join(sha256[:2], sha256[2:4], os.path.basename(path))
+        target = os.path.join(self.folder, name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(path, target)
+        return name
+
+    def path_of(self, name):
+        """Absolute path of a stored name, or None if it would escape the upload folder"""
+        root = os.path.abspath(self.folder)
+        path = os.path.abspath(os.path.join(root, name))
+        return path if path.startswith(root + os.sep) else None
+
+    def resolve(self, name):
+        """(path, None) for a file on disk, (archive path, member) if archived, or None"""
+        path = self.path_of(name)
+        if path and os.path.isfile(path):
+            return path, None
+
+        archived = self.db.get_archived_upload(name)
+        if archived:
+            return os.path.join(self.archive_folder, archived['archive']), archived['member']
+        return None
+
+    def open(self, name):
+        """(file object, mimetype) for a stored name, wherever it lives; None if it is gone"""
+        location = self.resolve(name)
+        if not location:
+            return None
+        path, member = location
+        if member is None:
+            return open(path, 'rb'), MIMETYPES.get(os.path.splitext(path)[1].lower(), 'application/octet-stream')
+        with zipfile.ZipFile(path) as archive:
+            data = archive.read(member)
+        return io.BytesIO(data), MIMETYPES.get(os.path.splitext(member)[1].lower(), 'application/octet-stream')
+
+    def remove(self, name):
+        """Delete a file and its thumbnail from disk"""
+        for path in (self.path_of(name), thumbnails.thumbnail_path(name)):
+            if path and os.path.exists(path):
+                os.remove(path)
+
+    # =================== MAINTENANCE ===================
+
+    def maintain(self):
+        """Run every lifecycle step; returns counts per step"""
+        return {
+            'sharded': self.shard_legacy(),
+            'purged': self.purge_rejected(),
+            'archived': self.archive_old(),
+            'expired': self.expire_archives(),
+        }
+
+    def shard_legacy(self):
+        """Move files saved flat in the upload folder into their shards"""
+        moved = 0
+        for usage in self.db.get_screenshot_usage():
+            name = usage['filename']
+            path = self.path_of(name)
+            if os.sep in name or '/' in name or not path or not os.path.isfile(path):
+                continue
+            new_name = self.store(path, file_sha256(path))
+            old_thumb = thumbnails.thumbnail_path(name)
+            if os.path.exists(old_thumb):
+                os.makedirs(os.path.dirname(thumbnails.thumbnail_path(new_name)), exist_ok=True)
+                os.replace(old_thumb, thumbnails.thumbnail_path(new_name))
+            self.db.rename_payment_screenshot(name, new_name)
+            moved += 1
+        return moved
+
+    def purge_rejected(self):
+        """Delete screenshots only used by rejected/cancelled bookings past their retention"""
+        cutoff = days_ago(Config.UPLOAD_REJECTED_RETENTION_DAYS)
+        purged = 0
+        for usage in self.db.get_screenshot_usage():
+            if usage['live'] == 0 and usage['last_date'] < cutoff and not self.db.get_archived_upload(usage['filename']):
+                self.remove(usage['filename'])
+                self.db.forget_payment_screenshot(usage['filename'])
+                purged += 1
+        return purged
+
+    def archive_old(self):
+        """Move screenshots of bookings older than the archive age into monthly zips"""
+        if not Config.UPLOAD_ARCHIVE_AFTER_DAYS:
+            return 0
+        cutoff = days_ago(Config.UPLOAD_ARCHIVE_AFTER_DAYS)
+        os.makedirs(self.archive_folder, exist_ok=True)
+        archived = 0
+
+        by_month = {}
+        for usage in self.db.get_screenshot_usage():
+            path = self.path_of(usage['filename'])
+            if usage['last_date'] < cutoff and path and os.path.isfile(path):
+                by_month.setdefault(usage['last_date'][:7], []).append((usage['filename'], path))
+
+        for month, files in sorted(by_month.items()):
+            archive_name = f"screenshots_{month}.zip"
+            with zipfile.ZipFile(os.path.join(self.archive_folder, archive_name), 'a') as archive:
+                existing = set(archive.namelist())
+                for name, path in files:
+                    member, data = compact(path)
+                    member = os.path.join(os.path.dirname(name), member).replace(os.sep, '/')
+                    if member not in existing:
+                        archive.writestr(member, data, compress_type=zipfile.ZIP_DEFLATED)
+                        existing.add(member)
+                    self.db.save_archived_upload(name, archive_name, member)
+                    # Keep the thumbnail so the dashboard stays light
+                    os.remove(path)
+                    archived += 1
+        return archived
+
+    def expire_archives(self):
+        """Delete whole monthly archives once every booking in them is past retention"""
+        if not Config.UPLOAD_RETENTION_DAYS:
+            return 0
+        cutoff_month = days_ago(Config.UPLOAD_RETENTION_DAYS)[:7]
+        expired = 0
+        for archive_name in self.db.get_upload_archives():
+            month = archive_name[len('screenshots_'):-len('.zip')]
+            if month >= cutoff_month:
+                continue
+            for name in self.db.pop_archived_uploads(archive_name):
+                self.remove(name)
+                self.db.forget_payment_screenshot(name)
+                expired += 1
+            path = os.path.join(self.archive_folder, archive_name)
+            if os.path.exists(path):
+                os.remove(path)
+        return expired
+
+def compact(path):
+    """(member name, bytes) to archive: lossless WebP when that beats a PNG, else the file as is"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    name = os.path.basename(path)
+
+    if Image is not None and name.lower().endswith('.png'):
+        try:
+            buffer = io.BytesIO()
+            with Image.open(io.BytesIO(data)) as image:
+                image.save(buffer, 'WEBP', lossless=True, method=4)
+            if buffer.tell() < len(data):
+                return os.path.splitext(name)[0] + '.webp', buffer.getvalue()
+        except Exception as e:
+            print(f"Could not compact {name}: {e}")
+    return name, data
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def days_ago(days):
+    return (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d")
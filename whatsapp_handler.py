@@ -1,10 +1,14 @@
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import os
+import hashlib
 from config import Config
 
 class WhatsAppHandler:
-    def __init__(self):
+    def __init__(self, db=None):
+        self.db = db
+        self._file_hashes = {}
         self.token = Config.WHATSAPP_TOKEN
         self.phone_id = Config.WHATSAPP_PHONE_ID
         self.api_url = f"https://graph.facebook.com/v18.0/{self.phone_id}/messages"
@@ -13,6 +17,18 @@ class WhatsAppHandler:
             "Authorization": f"Bearer {self.token}",
             "Content-Type": "application/json"
         }
+        self.timeout = (Config.WHATSAPP_CONNECT_TIMEOUT, Config.WHATSAPP_READ_TIMEOUT)
+        self.session = self.create_session()
+    
+    def create_session(self):
+        """Create a keep-alive session so repeated calls reuse pooled TLS connections"""
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=Config.WHATSAPP_POOL_CONNECTIONS,
+            pool_maxsize=Config.WHATSAPP_POOL_MAXSIZE
+        )
+        session.mount("https://", adapter)
+        return session
     
     def send_message(self, to_phone, message):
         """Send text message"""
@@ -24,7 +40,7 @@ class WhatsAppHandler:
         }
         
         try:
-            response = requests.post(self.api_url, headers=self.headers, json=payload)
+            response = self.session.post(self.api_url, headers=self.headers, json=payload, timeout=self.timeout)
             return response.json()
         except Exception as e:
             print(f"Error sending message: {e}")
@@ -56,7 +72,7 @@ class WhatsAppHandler:
         }
         
         try:
-            response = requests.post(self.api_url, headers=self.headers, json=payload)
+            response = self.session.post(self.api_url, headers=self.headers, json=payload, timeout=self.timeout)
             return response.json()
         except Exception as e:
             print(f"Error sending buttons: {e}")
@@ -79,7 +95,7 @@ class WhatsAppHandler:
         }
         
         try:
-            response = requests.post(self.api_url, headers=self.headers, json=payload)
+            response = self.session.post(self.api_url, headers=self.headers, json=payload, timeout=self.timeout)
             return response.json()
         except Exception as e:
             print(f"Error sending list: {e}")
@@ -87,12 +103,24 @@ class WhatsAppHandler:
     
     def send_image(self, to_phone, image_path, caption=""):
         """Send image (QR code)"""
-        # First upload image
-        media_id = self.upload_media(image_path)
+        # Reuse the media ID from an earlier upload when we can
+        media_id, cached = self.get_media_id(image_path)
         
         if not media_id:
             return None
         
+        result = self._post_image(to_phone, media_id, caption)
+        
+        # Meta may drop media before our TTL runs out; upload again once
+        if cached and result is not None and result.get('error'):
+            self.db.delete_cached_media(self.file_hash(image_path))
+            media_id, cached = self.get_media_id(image_path)
+            if media_id:
+                result = self._post_image(to_phone, media_id, caption)
+        
+        return result
+    
+    def _post_image(self, to_phone, media_id, caption):
         payload = {
             "messaging_product": "whatsapp",
             "to": to_phone,
@@ -104,12 +132,48 @@ class WhatsAppHandler:
         }
         
         try:
-            response = requests.post(self.api_url, headers=self.headers, json=payload)
+            response = self.session.post(self.api_url, headers=self.headers, json=payload, timeout=self.timeout)
             return response.json()
         except Exception as e:
             print(f"Error sending image: {e}")
             return None
     
+    def get_media_id(self, file_path):
+        """Return (media_id, from_cache), uploading the file only if no fresh ID is cached"""
+        if not self.db:
+            return self.upload_media(file_path), False
+        
+        try:
+            file_hash = self.file_hash(file_path)
+        except OSError as e:
+            print(f"Error reading media: {e}")
+            return None, False
+        
+        media_id = self.db.get_cached_media(file_hash, Config.MEDIA_ID_TTL_SECONDS)
+        if media_id:
+            return media_id, True
+        
+        media_id = self.upload_media(file_path)
+        if media_id:
+            self.db.save_cached_media(file_hash, media_id)
+        return media_id, False
+    
+    def file_hash(self, file_path):
+        """SHA-256 of a file, recomputed only when its size or mtime changes"""
+        stat = os.stat(file_path)
+        signature = (stat.st_size, stat.st_mtime_ns)
+        cached = self._file_hashes.get(file_path)
+        
+        if not cached or cached[0] != signature:
+            digest = hashlib.sha256()
+            with open(file_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(65536), b''):
+                    digest.update(chunk)
+            cached = (signature, digest.hexdigest())
+            self._file_hashes[file_path] = cached
+        
+        return cached[1]
+    
     def upload_media(self, file_path):
         """Upload media to WhatsApp"""
         try:
@@ -121,33 +185,86 @@ class WhatsAppHandler:
                 }
                 headers = {"Authorization": f"Bearer {self.token}"}
                 
-                response = requests.post(self.media_url, headers=headers, files=files)
+                response = self.session.post(self.media_url, headers=headers, files=files, timeout=self.timeout)
                 result = response.json()
                 return result.get('id')
         except Exception as e:
             print(f"Error uploading media: {e}")
             return None
     
-    def download_media(self, media_id, save_path):
-        """Download media from WhatsApp"""
+    def download_media(self, media_id, save_path, max_bytes=None):
+        """Stream media to disk and verify it is an image.
+        
+        The file is written under a temporary name and renamed into place
+        only once complete. Its extension is set from the detected image
+        type. Returns {'path', 'sha256', 'size', 'type'}, or None on failure;
+        raises MediaRejected if the file is too large or not an image.
+        """
+        max_bytes = max_bytes or Config.MAX_CONTENT_LENGTH
+        tmp_path = f"{save_path}.{os.getpid()}.part"
         try:
             # Get media URL
             url = f"https://graph.facebook.com/v18.0/{media_id}"
             headers = {"Authorization": f"Bearer {self.token}"}
             
-            response = requests.get(url, headers=headers)
-            media_url = response.json().get('url')
+            response = self.session.get(url, headers=headers, timeout=self.timeout)
+            info = response.json()
+            media_url = info.get('url')
             
             if not media_url:
                 return None
+            if int(info.get('file_size') or 0) > max_bytes:
+                raise MediaRejected(f"File is larger than {max_bytes} bytes")
             
-            # Download media
-            media_response = requests.get(media_url, headers=headers)
+            # Download media in chunks, never holding the whole file in memory
+            with self.session.get(media_url, headers=headers, timeout=self.timeout, stream=True) as media_response:
+                media_response.raise_for_status()
+                if int(media_response.headers.get('Content-Length') or 0) > max_bytes:
+                    raise MediaRejected(f"File is larger than {max_bytes} bytes")
+                
+                digest = hashlib.sha256()
+                size = 0
+                image_type = None
+                with open(tmp_path, 'wb') as f:
+                    for chunk in media_response.iter_content(chunk_size=65536):
+                        if not chunk:
+                            continue
+                        if image_type is None:
+                            image_type = image_type_of(chunk)
+                            if not image_type:
+                                raise MediaRejected("File is not a JPEG, PNG or WebP image")
+                        size += len(chunk)
+                        if size > max_bytes:
+                            raise MediaRejected(f"File is larger than {max_bytes} bytes")
+                        digest.update(chunk)
+                        f.write(chunk)
             
-            with open(save_path, 'wb') as f:
-                f.write(media_response.content)
+            if not size:
+                raise MediaRejected("File is empty")
             
-            return save_path
+            path = os.path.splitext(save_path)[0] + IMAGE_EXTENSIONS[image_type]
+            os.replace(tmp_path, path)
+            return {'path': path, 'sha256': digest.hexdigest(), 'size': size, 'type': image_type}
+        except MediaRejected:
+            raise
         except Exception as e:
             print(f"Error downloading media: {e}")
             return None
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+class MediaRejected(Exception):
+    """Downloaded media that failed validation; retrying will not help"""
+
+IMAGE_EXTENSIONS = {'jpeg': '.jpg', 'png': '.png', 'webp': '.webp'}
+
+def image_type_of(head):
+    """Image type from a file's first bytes, or None if it is not a supported image"""
+    if head[:3] == b'\xff\xd8\xff':
+        return 'jpeg'
+    if head[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'png'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    return None